@@ -2,13 +2,20 @@ import os
 import os.path
 from pathlib import Path
 import sentry_sdk
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, g, jsonify, send_from_directory
 from flask_cors import CORS
 from dotenv import load_dotenv
 from routes.chat_routes import chat_bp
 from routes.file_routes import file_bp
 from routes.search_routes import search_bp
 from routes.moodboard_routes import board_bp
+from routes.blob_routes import blob_bp
+from routes.job_routes import job_bp
+from routes.metrics_routes import metrics_bp
+from utils.helpers import get_user_id
+from utils.jobs import job_queue
+from utils.model_scheduler import end_model_caller, start_model_caller
+from utils.resilience import end_deadline, start_deadline
 
 # Import MongoDB functionality
 from init_mongo import (
@@ -41,6 +48,8 @@ load_dotenv(dotenv_path=root_env, override=True)
 # Initialize Flask app
 app = Flask(__name__, static_folder="../frontend/dist")
 app.secret_key = os.getenv("SECRET_KEY", os.urandom(24))
+# Let nginx/Apache stream local blobs instead of the Python worker
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "False").lower() == "true"
 CORS(app)  # Enable CORS for development
 
 # Initialize MongoDB connection
@@ -50,6 +59,30 @@ app.register_blueprint(chat_bp)
 app.register_blueprint(file_bp)
 app.register_blueprint(search_bp)
 app.register_blueprint(board_bp)
+app.register_blueprint(blob_bp)
+app.register_blueprint(job_bp)
+app.register_blueprint(metrics_bp)
+
+# Run jobs again that a restarted or crashed worker left behind (see utils/jobs.py)
+job_queue.start_sweeper()
+
+
+@app.before_request
+def start_request_deadline():
+    # Every outbound call of the request shares one deadline budget
+    g.deadline_token = start_deadline()
+    # Its model calls, including those made on worker threads, are interactive
+    g.caller_token = start_model_caller(get_user_id())
+
+
+@app.teardown_request
+def end_request_deadline(exception=None):
+    token = g.pop("caller_token", None)
+    if token is not None:
+        end_model_caller(token)
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        end_deadline(token)
 
 
 @app.route("/health", methods=["GET"])
@@ -0,0 +1,338 @@
+"""
+Bulk ingestion of the shared pinterest-images container.
+
+Streams the container listing page by page and ingests each page in batches: the
+images of a batch are analysed concurrently (bounded by --concurrency), then embedded
+in one call and written with insert_many. The listing position is checkpointed in
+MongoDB after every page so an interrupted run resumes where it stopped, together with
+the blobs whose analysis failed, which the next run retries first. Progress is logged
+as throughput (images/s) and per-stage latencies.
+
+Usage:
+    python ingest_pinterest.py --user-id pinterest --batch-size 32 --concurrency 8
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from azure.core.exceptions import ResourceNotFoundError
+from init_mongo import (
+    find_documents,
+    get_user_collection,
+    initialize_mongo,
+    insert_documents,
+)
+from usecases.image_analysis import analyze_image, parse_analysis
+from utils.blob_storage import blob_storage
+from utils.class_centroids import update_centroids
+from utils.embedding_versions import embedding_fields
+from utils.helpers import MAX_IMAGE_SIZE, allowed_file
+from utils.cohere_client import co
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTAINER = "pinterest-images"
+
+
+class StageTimer:
+    """
+    Collect per-stage latencies from worker threads (list.append is atomic).
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Returns:
+            Dict of stage to count, mean and p95 latency in milliseconds
+        """
+        summary = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            p95_index = max(math.ceil(len(ordered) * 0.95) - 1, 0)
+            summary[stage] = {
+                "count": len(ordered),
+                "mean_ms": round(1000 * sum(ordered) / len(ordered), 1),
+                "p95_ms": round(1000 * ordered[p95_index], 1),
+            }
+        return summary
+
+
+def load_checkpoint(user_id, container):
+    checkpoints = list(
+        find_documents(user_id, "ingest_checkpoints", {"container": container})
+    )
+    return checkpoints[0] if checkpoints else None
+
+
+def save_checkpoint(user_id, container, continuation_token, stats, failed_blobs=()):
+    get_user_collection(user_id, "ingest_checkpoints").update_one(
+        {"container": container},
+        {
+            "$set": {
+                "continuation_token": continuation_token,
+                "completed": continuation_token is None,
+                "processed": stats["processed"],
+                "failed": stats["failed"],
+                "skipped": stats["skipped"],
+                # Retried by the next run, even once the listing is complete
+                "failed_blobs": sorted(failed_blobs),
+                "updated_at": datetime.utcnow(),
+            }
+        },
+        upsert=True,
+    )
+
+
+def analyze_blob(container_client, blob, timer):
+    """
+    Download one blob and turn the vision analysis into a file document.
+    """
+    with timer.time("download"):
+        data = container_client.download_blob(blob.name).readall()
+    with timer.time("analysis"):
+        metadata = parse_analysis(analyze_image(co, data))
+
+    return {
+        "filename": blob.name,
+        "blob_name": blob.name,
+        "blob_url": f"{container_client.url}/{blob.name}",
+        "size_bytes": len(data),
+        "timestamp": datetime.utcnow(),
+        "container": container_client.container_name,
+        "status": "ready",
+        **metadata,
+    }
+
+
+def ingest_batch(container_client, blobs, user_id, executor, timer, stats):
+    """
+    Analyse a batch of blobs concurrently, embed them in one call and insert them
+    with one insert_many.
+
+    Returns:
+        Names of the blobs whose analysis failed
+    """
+    futures = {
+        executor.submit(analyze_blob, container_client, blob, timer): blob
+        for blob in blobs
+    }
+    documents = []
+    failed = []
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            documents.append(future.result())
+        except Exception as e:
+            logger.warning(f"Could not analyse {futures[future].name}: {e}")
+            stats["failed"] += 1
+            failed.append(futures[future].name)
+
+    if not documents:
+        return failed
+
+    with timer.time("embed"):
+        fields = embedding_fields(user_id, documents)
+    for document, document_fields in zip(documents, fields):
+        document.update(document_fields)
+
+    with timer.time("insert"):
+        insert_documents(user_id, "files", documents)
+    update_centroids(user_id, added=documents)
+    stats["processed"] += len(documents)
+    return failed
+
+
+def ingest_blobs(container_client, blobs, user_id, executor, timer, stats, batch_size):
+    """
+    Ingest blobs one batch after another.
+
+    Returns:
+        Set of the names of the blobs whose analysis failed
+    """
+    failed = set()
+    for offset in range(0, len(blobs), batch_size):
+        failed.update(
+            ingest_batch(
+                container_client,
+                blobs[offset : offset + batch_size],
+                user_id,
+                executor,
+                timer,
+                stats,
+            )
+        )
+    return failed
+
+
+def failed_blob_properties(container_client, names):
+    """
+    Look up the blobs an earlier run failed to analyse; deleted ones are dropped.
+    """
+    blobs = []
+    for name in names:
+        try:
+            blobs.append(container_client.get_blob_client(name).get_blob_properties())
+        except ResourceNotFoundError:
+            logger.info(f"Blob {name} was deleted since its analysis failed")
+    return blobs
+
+
+def filter_new_blobs(blobs, user_id, stats):
+    """
+    Drop blobs that are not images, are too large for the vision model, or were
+    already ingested by an earlier run that stopped mid-page.
+    """
+    candidates = [
+        blob
+        for blob in blobs
+        if allowed_file(blob.name) and (blob.size or 0) <= MAX_IMAGE_SIZE
+    ]
+    existing = {
+        doc["blob_name"]
+        for doc in find_documents(
+            user_id,
+            "files",
+            {"blob_name": {"$in": [blob.name for blob in candidates]}},
+        )
+    }
+    new_blobs = [blob for blob in candidates if blob.name not in existing]
+    stats["skipped"] += len(blobs) - len(new_blobs)
+    return new_blobs
+
+
+def ingest(
+    container=DEFAULT_CONTAINER,
+    user_id="pinterest",
+    batch_size=32,
+    concurrency=8,
+    page_size=500,
+    limit=None,
+    reset=False,
+):
+    """
+    Ingest the container, resuming from the stored checkpoint unless reset is set.
+    Blobs whose analysis failed in an earlier run are retried first.
+
+    Returns:
+        Dict with processed/failed/skipped counts, throughput and stage latencies
+    """
+    container_client = blob_storage.get_container_client(container)
+    checkpoint = (None if reset else load_checkpoint(user_id, container)) or {}
+    completed = checkpoint.get("completed", False)
+    failed_blobs = set(checkpoint.get("failed_blobs", []))
+    if completed and not failed_blobs:
+        logger.info(f"Container {container} is already fully ingested")
+        return {"processed": 0, "failed": 0, "skipped": 0}
+
+    stats = {"processed": 0, "failed": 0, "skipped": 0}
+    token = checkpoint.get("continuation_token")
+    if token:
+        logger.info(f"Resuming {container} from checkpoint")
+
+    timer = StageTimer()
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if failed_blobs:
+            logger.info(f"Retrying {len(failed_blobs)} blobs that failed before")
+            with timer.time("list"):
+                blobs = filter_new_blobs(
+                    failed_blob_properties(container_client, sorted(failed_blobs)),
+                    user_id,
+                    stats,
+                )
+            failed_blobs = ingest_blobs(
+                container_client, blobs, user_id, executor, timer, stats, batch_size
+            )
+            save_checkpoint(user_id, container, token, stats, failed_blobs)
+
+        pages = (
+            []
+            if completed
+            else container_client.list_blobs(results_per_page=page_size).by_page(
+                continuation_token=token
+            )
+        )
+        for page in pages:
+            with timer.time("list"):
+                blobs = filter_new_blobs(list(page), user_id, stats)
+
+            failed_blobs |= ingest_blobs(
+                container_client, blobs, user_id, executor, timer, stats, batch_size
+            )
+
+            # Only move the checkpoint once the whole page is stored; its failed
+            # blobs are kept with it for the next run to retry
+            save_checkpoint(
+                user_id, container, pages.continuation_token, stats, failed_blobs
+            )
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"{stats['processed']} images ingested, {stats['failed']} failed, "
+                f"{stats['skipped']} skipped, "
+                f"{stats['processed'] / elapsed:.1f} images/s"
+            )
+
+            if limit and stats["processed"] >= limit:
+                break
+
+    elapsed = time.perf_counter() - start
+    stats["images_per_second"] = (
+        round(stats["processed"] / elapsed, 2) if elapsed else 0
+    )
+    stats["stages"] = timer.summary()
+    for stage, latency in stats["stages"].items():
+        logger.info(
+            f"{stage}: {latency['count']} calls, mean {latency['mean_ms']} ms, "
+            f"p95 {latency['p95_ms']} ms"
+        )
+    return stats
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--container", default=DEFAULT_CONTAINER)
+    parser.add_argument(
+        "--user-id", default="pinterest", help="owner of the ingested file documents"
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="parallel vision analyses"
+    )
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--limit", type=int, help="stop after this many images")
+    parser.add_argument(
+        "--reset", action="store_true", help="ignore the stored checkpoint"
+    )
+    args = parser.parse_args()
+
+    initialize_mongo(force_connect=True)
+    ingest(
+        container=args.container,
+        user_id=args.user_id,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        page_size=args.page_size,
+        limit=args.limit,
+        reset=args.reset,
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
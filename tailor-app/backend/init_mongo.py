@@ -5,6 +5,7 @@ from pathlib import Path
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
+from utils.embedding_models import DEFAULT_EMBEDDING_VERSION, EMBEDDING_VERSIONS
 
 BASE_DIR = Path(__file__).resolve().parent
 backend_env = BASE_DIR / ".env"
@@ -84,6 +85,21 @@ def initialize_mongo(force_connect=False):
     return client, db
 
 
+def search_index_definition(embedding_versions):
+    """
+    Atlas Search index definition for a files collection, with one knnVector field per
+    embedding version. Two versions are indexed while a model migration is backfilling.
+    """
+    fields = {"class": {"type": "token"}, "fullplot": {"type": "string"}}
+    for version in embedding_versions:
+        fields[EMBEDDING_VERSIONS[version]["field"]] = {
+            "dimensions": EMBEDDING_VERSIONS[version]["dimensions"],
+            "similarity": "cosine",
+            "type": "knnVector",
+        }
+    return {"mappings": {"dynamic": True, "fields": fields}}
+
+
 def initialize_atlas_search(user_id, collection_type):
     existing_collections = db.list_collection_names()
     collection_name = f"user_{user_id}_{collection_type}"
@@ -92,20 +108,7 @@ def initialize_atlas_search(user_id, collection_type):
         collection = db.create_collection(collection_name)
         collection.create_search_index(
             {
-                "definition": {
-                    "mappings": {
-                        "dynamic": True,
-                        "fields": {
-                            "class": {"type": "token"},
-                            "embedding": {
-                                "dimensions": 1024,
-                                "similarity": "cosine",
-                                "type": "knnVector",
-                            },
-                            "fullplot": {"type": "string"},
-                        },
-                    }
-                },
+                "definition": search_index_definition([DEFAULT_EMBEDDING_VERSION]),
                 "name": "default",
             }
         )
@@ -113,6 +116,18 @@ def initialize_atlas_search(user_id, collection_type):
     return collection
 
 
+def update_search_index(user_id, embedding_versions):
+    """
+    Replace the definition of a user's files search index. Atlas keeps serving the
+    old index until the new one is built, so the switch is atomic for queries.
+    """
+    collection = get_user_collection(user_id, "files")
+    collection.update_search_index(
+        "default", search_index_definition(embedding_versions)
+    )
+    logger.info(f"Updating search index of user {user_id} to {embedding_versions}")
+
+
 # User collection management
 def get_user_collection(user_id, collection_type):
     if db is None:
@@ -130,6 +145,26 @@ def get_user_collection(user_id, collection_type):
     return initialize_atlas_search(user_id, collection_type)
 
 
+def list_user_ids(collection_type):
+    """
+    Ids of the users that have a collection of collection_type, e.g. "jobs"
+    """
+    if db is None:
+        # Without a connection (e.g. in test mode) there are no users to list
+        if testing_mode:
+            return []
+        initialize_mongo()
+        if db is None:
+            raise RuntimeError("Database connection failed and not in testing mode")
+
+    suffix = f"_{collection_type}"
+    return [
+        name[len("user_") : -len(suffix)]
+        for name in db.list_collection_names()
+        if name.startswith("user_") and name.endswith(suffix)
+    ]
+
+
 # Basic CRUD operations
 def insert_document(user_id, collection_type, document):
     collection = get_user_collection(user_id, collection_type)
@@ -171,6 +206,8 @@ def initialize_user(user_id):
 
     if not testing_mode:
         conversations.create_index("timestamp")
+        # Turns of a chat session in order (see utils/chat_context.py)
+        conversations.create_index([("session_id", 1), ("timestamp", 1)])
 
     logger.info(f"Initialized collections for user: {user_id}")
 
@@ -194,10 +231,21 @@ class MockCollection:
 
         return Result(document_id)
 
-    def find(self):
+    def insert_many(self, documents, ordered=True):
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+            self.data.append(document)
+
+        class Result:
+            def __init__(self, inserted_ids):
+                self.inserted_ids = inserted_ids
+
+        return Result([document["_id"] for document in documents])
+
+    def find(self, query=None, projection=None):
         return []
 
-    def update_one(self, filter_dict, update_dict):
+    def update_one(self, filter_dict, update_dict, upsert=False):
         class Result:
             def __init__(self):
                 self.modified_count = 0
@@ -206,6 +254,9 @@ class MockCollection:
 
         return Result()
 
+    def replace_one(self, filter_dict, replacement, upsert=False):
+        return self.update_one(filter_dict, replacement, upsert)
+
     def delete_one(self, filter_dict):
         class Result:
             def __init__(self):
@@ -214,6 +265,9 @@ class MockCollection:
 
         return Result()
 
+    def delete_many(self, filter_dict):
+        return self.delete_one(filter_dict)
+
     # def create_index(self):
     #     pass
 
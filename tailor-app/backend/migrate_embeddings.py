@@ -0,0 +1,392 @@
+"""
+Migrate a user's stored file embeddings to another embedding version.
+
+A migration runs in three steps, each safe to re-run:
+    start     record the target version and add its shadow field to the search index;
+              from then on every write stores vectors for both versions
+    backfill  embed every file still missing the shadow field, in large batched embed
+              calls whose concurrency backs off when Cohere rate limits
+    cutover   switch searches to the new field once nothing is left to backfill, then
+              drop the old field from the search index
+
+Searches keep reading the old field until cutover.
+
+reembed is a one-off, also safe to re-run: it re-embeds every file whose vectors
+were made from other text than its current description, class and colour, e.g.
+files stored before the class and colour were folded into the embedded text.
+
+Usage:
+    python migrate_embeddings.py start --user-id 123 --target v4
+    python migrate_embeddings.py backfill --user-id 123 --concurrency 4
+    python migrate_embeddings.py cutover --user-id 123
+    python migrate_embeddings.py reembed --user-id 123
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from cohere.errors import ServiceUnavailableError, TooManyRequestsError
+from pymongo import UpdateOne
+from init_mongo import get_user_collection, initialize_mongo, update_search_index
+from utils.class_centroids import rebuild_centroids
+from utils.embedding_versions import (
+    EMBEDDING_STATE_TTL,
+    get_embedding_state,
+    set_embedding_state,
+)
+from utils.cohere_client import EMBED_TIMEOUT, create_cohere_client
+from utils.embedding_models import EMBEDDING_VERSIONS
+from utils.embeddings import MAX_EMBED_BATCH, compose_document_text, document_hash
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Attempts per batch before the backfill gives up on rate limiting
+MAX_EMBED_ATTEMPTS = 6
+# Fields of a file read to embed it
+FILE_PROJECTION = {"description": 1, "class": 1, "colour": 1, "embedding_hash": 1}
+
+# A plain client: the shared one retries on its own and opens its circuit breaker
+# under sustained throttling, which would abort the run instead of slowing it down.
+# Throttling is handled here by embed_with_backoff and the AdaptiveLimiter.
+co = create_cohere_client()
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for embed calls that halves when Cohere rate limits and grows
+    back by one after every successful call, up to max_concurrency.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.limit + 1, self.max_concurrency)
+            self._condition.notify_all()
+
+    def on_rate_limited(self):
+        with self._condition:
+            self.limit = max(self.limit // 2, 1)
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def advance(self, count, limiter):
+        with self._lock:
+            self.done += count
+            elapsed = time.perf_counter() - self.start
+            rate = self.done / elapsed if elapsed else 0
+            remaining = max(self.total - self.done, 0)
+            eta = remaining / rate if rate else 0
+            percent = 100 * self.done / self.total if self.total else 100
+            logger.info(
+                f"{self.done}/{self.total} files ({percent:.0f}%), "
+                f"{rate:.1f} files/s, ETA {eta:.0f}s, concurrency {limiter.limit}"
+            )
+
+
+def embed_with_backoff(texts, model, limiter, base_delay=1.0):
+    """
+    Embed one batch, retrying rate limited and unavailable responses with jittered
+    exponential backoff while the limiter lowers the concurrency.
+    """
+    for attempt in range(MAX_EMBED_ATTEMPTS):
+        try:
+            with limiter.slot():
+                vectors = co.embed(
+                    texts=texts,
+                    model=model,
+                    input_type="search_document",
+                    embedding_types=["float"],
+                    request_options={"timeout_in_seconds": EMBED_TIMEOUT},
+                ).embeddings.float
+            limiter.on_success()
+            return vectors
+        except (TooManyRequestsError, ServiceUnavailableError) as e:
+            if attempt == MAX_EMBED_ATTEMPTS - 1:
+                raise
+            limiter.on_rate_limited()
+            delay = base_delay * 2**attempt * (0.5 + random.random())
+            logger.warning(f"Embed call throttled ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def backfill_batch(collection, files, version, limiter, progress):
+    texts = [
+        compose_document_text(
+            f.get("description", ""), f.get("class", ""), f.get("colour", "")
+        )
+        for f in files
+    ]
+    vectors = embed_with_backoff(texts, version["model"], limiter)
+    # Files re-embedded by a PATCH since they were read already hold a fresher
+    # vector, so only files still missing the field are written
+    collection.bulk_write(
+        [
+            UpdateOne(
+                {"_id": f["_id"], version["field"]: {"$exists": False}},
+                {"$set": {version["field"]: vector}},
+            )
+            for f, vector in zip(files, vectors)
+        ],
+        ordered=False,
+    )
+    progress.advance(len(files), limiter)
+
+
+def start(user_id, target, grace=EMBEDDING_STATE_TTL):
+    state = get_embedding_state(user_id)
+    if target == state["active"]:
+        raise ValueError(f"User {user_id} is already on embedding version {target}")
+
+    set_embedding_state(user_id, state["active"], target)
+    update_search_index(user_id, [state["active"], target])
+    # Wait until every process has picked up the new state and writes both fields,
+    # otherwise a file edited meanwhile could keep a stale shadow vector
+    logger.info(f"Waiting {grace:.0f}s for workers to start dual writes")
+    time.sleep(grace)
+
+
+def backfill(user_id, batch_size=MAX_EMBED_BATCH, concurrency=4):
+    """
+    Embed every file of the user that is missing the target version's field.
+
+    Returns:
+        Number of files backfilled
+    """
+    state = get_embedding_state(user_id)
+    if not state["target"]:
+        raise ValueError(f"No embedding migration started for user {user_id}")
+
+    version = EMBEDDING_VERSIONS[state["target"]]
+    collection = get_user_collection(user_id, "files")
+    query = {version["field"]: {"$exists": False}}
+    progress = Progress(collection.count_documents(query))
+    limiter = AdaptiveLimiter(concurrency)
+
+    run_batches(
+        collection,
+        query,
+        lambda files: backfill_batch(collection, files, version, limiter, progress),
+        batch_size,
+        concurrency,
+    )
+    return progress.done
+
+
+def run_batches(collection, query, process, batch_size, concurrency):
+    """
+    Page through the files matching query in _id order and call process with each
+    page on a pool of concurrency threads, reading at most concurrency pages ahead.
+    """
+    last_id = None
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            page_query = dict(query)
+            if last_id is not None:
+                page_query["_id"] = {"$gt": last_id}
+            files = list(
+                collection.find(page_query, FILE_PROJECTION)
+                .sort("_id", 1)
+                .limit(batch_size)
+            )
+            if not files:
+                break
+            last_id = files[-1]["_id"]
+
+            # Bound the batches read ahead of the embed calls
+            while len(pending) >= concurrency:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+
+            pending.add(executor.submit(process, files))
+
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+
+
+def reembed_batch(collection, files, versions, limiter, progress):
+    """
+    Re-embed the files of a page whose stored hash does not match their composed
+    text, for every version a search may read.
+    """
+    stale = [f for f in files if f.get("embedding_hash") != document_hash(f)]
+    if stale:
+        texts = [
+            compose_document_text(
+                f.get("description", ""), f.get("class", ""), f.get("colour", "")
+            )
+            for f in stale
+        ]
+        vectors = {
+            version["field"]: embed_with_backoff(texts, version["model"], limiter)
+            for version in versions
+        }
+        # A file whose metadata a PATCH changed since it was read already holds
+        # fresher vectors and a new hash, so it no longer matches the filter
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": f["_id"], "embedding_hash": f.get("embedding_hash")},
+                    {
+                        "$set": {
+                            "embedding_hash": document_hash(f),
+                            **{field: vectors[field][i] for field in vectors},
+                        }
+                    },
+                )
+                for i, f in enumerate(stale)
+            ],
+            ordered=False,
+        )
+    progress.advance(len(files), limiter)
+    return len(stale)
+
+
+def reembed(user_id, batch_size=MAX_EMBED_BATCH, concurrency=4):
+    """
+    Re-embed every file of the user whose vectors were made from other text than its
+    current metadata, in the active version and the migration target, if any.
+
+    Returns:
+        Number of files re-embedded
+    """
+    state = get_embedding_state(user_id)
+    versions = [EMBEDDING_VERSIONS[state["active"]]]
+    if state["target"] and state["target"] != state["active"]:
+        versions.append(EMBEDDING_VERSIONS[state["target"]])
+
+    collection = get_user_collection(user_id, "files")
+    progress = Progress(collection.count_documents({}))
+    limiter = AdaptiveLimiter(concurrency)
+    reembedded = []
+    run_batches(
+        collection,
+        {},
+        lambda files: reembedded.append(
+            reembed_batch(collection, files, versions, limiter, progress)
+        ),
+        batch_size,
+        concurrency,
+    )
+
+    # Re-embedded vectors bypassed the incremental centroid updates
+    if sum(reembedded):
+        rebuild_centroids(user_id)
+    return sum(reembedded)
+
+
+def cutover(user_id, grace=EMBEDDING_STATE_TTL, drop_old=False):
+    state = get_embedding_state(user_id)
+    if not state["target"]:
+        raise ValueError(f"No embedding migration started for user {user_id}")
+
+    old, new = EMBEDDING_VERSIONS[state["active"]], EMBEDDING_VERSIONS[state["target"]]
+    collection = get_user_collection(user_id, "files")
+    remaining = collection.count_documents({new["field"]: {"$exists": False}})
+    if remaining:
+        raise RuntimeError(f"{remaining} files still need to be backfilled")
+
+    # Backfilled vectors bypassed the incremental centroid updates
+    rebuild_centroids(user_id)
+
+    # Searches move first while the index still covers both fields; the old field
+    # is only dropped from the index once no process can still be querying it
+    set_embedding_state(user_id, state["target"])
+    logger.info(f"User {user_id} now searches {new['field']}")
+    time.sleep(grace)
+    update_search_index(user_id, [state["target"]])
+
+    if drop_old:
+        collection.update_many({}, {"$unset": {old["field"]: ""}})
+        logger.info(f"Removed {old['field']} from the files of user {user_id}")
+
+
+def status(user_id):
+    state = get_embedding_state(user_id)
+    collection = get_user_collection(user_id, "files")
+    remaining = 0
+    if state["target"]:
+        field = EMBEDDING_VERSIONS[state["target"]]["field"]
+        remaining = collection.count_documents({field: {"$exists": False}})
+    return {**state, "remaining": remaining}
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    start_parser = subparsers.add_parser("start")
+    start_parser.add_argument(
+        "--target", required=True, choices=sorted(EMBEDDING_VERSIONS)
+    )
+    backfill_parser = subparsers.add_parser("backfill")
+    backfill_parser.add_argument("--batch-size", type=int, default=MAX_EMBED_BATCH)
+    backfill_parser.add_argument(
+        "--concurrency", type=int, default=4, help="maximum parallel embed calls"
+    )
+    reembed_parser = subparsers.add_parser("reembed")
+    reembed_parser.add_argument("--batch-size", type=int, default=MAX_EMBED_BATCH)
+    reembed_parser.add_argument(
+        "--concurrency", type=int, default=4, help="maximum parallel embed calls"
+    )
+    cutover_parser = subparsers.add_parser("cutover")
+    cutover_parser.add_argument(
+        "--drop-old", action="store_true", help="unset the old vectors afterwards"
+    )
+    subparsers.add_parser("status")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--user-id", required=True, action="append")
+    args = parser.parse_args()
+
+    initialize_mongo(force_connect=True)
+    for user_id in args.user_id:
+        if args.command == "start":
+            start(user_id, args.target)
+        elif args.command == "backfill":
+            backfill(user_id, batch_size=args.batch_size, concurrency=args.concurrency)
+        elif args.command == "cutover":
+            cutover(user_id, drop_old=args.drop_old)
+        elif args.command == "reembed":
+            count = reembed(
+                user_id, batch_size=args.batch_size, concurrency=args.concurrency
+            )
+            logger.info(f"User {user_id}: re-embedded {count} files")
+        else:
+            logger.info(f"User {user_id}: {status(user_id)}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,31 @@
+import logging
+from flask import Blueprint, jsonify, send_file
+from utils.blob_storage import blob_storage, LocalBlobStorage
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Create Blueprint
+blob_bp = Blueprint("blob_bp", __name__)
+
+# Blob names are random UUIDs and never rewritten, so clients may cache them for a year
+BLOB_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@blob_bp.route("/api/blobs/<container>/<path:blob_name>", methods=["GET"])
+def serve_blob(container, blob_name):
+    """
+    Endpoint to serve a blob from the local blob storage backend.
+
+    send_file handles ETags, If-None-Match and Range requests. When the app is
+    configured with USE_X_SENDFILE, the body is left to the front web server.
+    """
+    if not isinstance(blob_storage, LocalBlobStorage):
+        return jsonify({"error": "Blobs are served by Azure Blob Storage"}), 404
+
+    path = blob_storage.get_blob_path(blob_name, container)
+    if path is None or not path.is_file():
+        return jsonify({"error": "Blob not found"}), 404
+
+    return send_file(path, conditional=True, etag=True, max_age=BLOB_MAX_AGE)
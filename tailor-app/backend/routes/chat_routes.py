@@ -1,31 +1,134 @@
 import time
-import os
-import cohere
+import logging
+from bson.objectid import ObjectId
 from flask import Blueprint, request, jsonify
-from init_mongo import insert_document, update_document, find_documents
+from init_mongo import find_documents
 from utils.helpers import get_user_id
+from utils.cohere_client import CHAT_TIMEOUT, co
+from utils.sse import format_sse, sse_response, stream_chat_text
+from utils.embeddings import embed_texts
+from utils.semantic_cache import semantic_cache
+from utils.conversation_log import conversation_log
+from utils.chat_context import SessionContext
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint("chat", __name__)
 
-co = cohere.ClientV2(api_key=os.getenv("COHERE_API_KEY"))
 CHAT_MODEL = "command-r-08-2024"
 
+# Context of multi-turn sessions, kept within CHAT_CONTEXT_TOKENS
+session_context = SessionContext(CHAT_MODEL)
+
+# "semantic_cache" enables answering near-identical prompts of the template from the
+# semantic cache (when SEMANTIC_CACHE_ENABLED is set), with its similarity threshold.
+# Cached responses are only shared between prompts of the same user.
 TEMPLATES = {
     "basic_chat": {
         "system_prompt": "You are a helpful fashion assistant.",
         "temperature": 0.7,
         "max_tokens": 300,
+        "semantic_cache": {"threshold": 0.95},
     },
     "expert_mode": {
         "system_prompt": "You are an expert programmer focused on providing technical solutions.",
         "temperature": 0.3,
         "max_tokens": 500,
+        "semantic_cache": None,
     },
 }
 
 
+def lookup_cached_response(user_id, template_name, template, prompt):
+    """
+    Look the prompt up in the user's semantic cache namespace of the template.
+
+    Returns:
+        Dict with the namespace, prompt vector and cached response (None on a miss),
+        or None when the cache is not used for this template
+    """
+    settings = template.get("semantic_cache")
+    if not semantic_cache.enabled or not settings:
+        return None
+    try:
+        vector = embed_texts([prompt], input_type="search_query")[0]
+    except Exception as e:
+        # The cache is an optimisation; the request goes on to Cohere without it
+        logger.warning(f"Skipping semantic cache, could not embed prompt: {e}")
+        return None
+    namespace = f"{user_id}:{template_name}"
+    return {
+        "namespace": namespace,
+        "vector": vector,
+        "response": semantic_cache.lookup(namespace, vector, settings.get("threshold")),
+    }
+
+
+def store_cached_response(cache_entry, response_text):
+    if cache_entry and cache_entry["response"] is None:
+        semantic_cache.store(
+            cache_entry["namespace"], cache_entry["vector"], response_text
+        )
+
+
+def stream_generation(user_id, conversation_doc, chat_kwargs, cache_entry=None):
+    """
+    Relay a chat completion as SSE: a "start" event with the conversation and session
+    ids, one "delta" event per text chunk, then "end" with the full response, or
+    "error" if the stream broke off. A semantic cache hit is sent as a single delta.
+    """
+    doc_id = str(conversation_doc["_id"])
+    chunks = []
+    completed = False
+    try:
+        yield format_sse(
+            {
+                "conversation_id": doc_id,
+                "session_id": conversation_doc["session_id"],
+                "user_id": user_id,
+            },
+            "start",
+        )
+        if cache_entry and cache_entry["response"] is not None:
+            chunks.append(cache_entry["response"])
+            yield format_sse({"text": cache_entry["response"]}, "delta")
+        else:
+            for text in stream_chat_text(co.chat_stream(**chat_kwargs)):
+                chunks.append(text)
+                yield format_sse({"text": text}, "delta")
+        completed = True
+    except Exception as e:
+        logger.error(f"Error streaming response: {e}", exc_info=True)
+        yield format_sse({"error": str(e)}, "error")
+    finally:
+        # Runs on completion, on failure and when the client disconnects
+        conversation_doc["response"] = "".join(chunks)
+        if not completed:
+            conversation_doc["incomplete"] = True
+        conversation_log.log(user_id, conversation_doc)
+
+    if completed:
+        store_cached_response(cache_entry, "".join(chunks))
+        yield format_sse(
+            {"conversation_id": doc_id, "response": "".join(chunks)}, "end"
+        )
+
+
 @chat_bp.route("/api/generate", methods=["POST"])
 def generate_response():
+    """
+    Generate a chat response.
+
+    Request:
+    - prompt: The user prompt
+    - template: Name of the template in TEMPLATES, defaults to "basic_chat"
+    - session_id: Session returned by an earlier call, to continue that conversation
+      with its earlier turns as context; a new session is started when omitted
+    - stream: When true, the response is streamed as Server-Sent Events (see
+      stream_generation) instead of returned as one JSON object
+    """
     data = request.json
     user_prompt = data.get("prompt", "")
     template_name = data.get("template", "basic_chat")
@@ -34,28 +137,63 @@ def generate_response():
         template = TEMPLATES[template_name]
         user_id = get_user_id()
 
+        session_id = data.get("session_id")
+        if session_id:
+            messages = session_context.build_messages(
+                user_id, session_id, template["system_prompt"], user_prompt
+            )
+            # A cached answer would ignore the earlier turns
+            cache_entry = None
+        else:
+            session_id = str(ObjectId())
+            messages = [
+                {"role": "system", "content": template["system_prompt"]},
+                {"role": "user", "content": user_prompt},
+            ]
+            cache_entry = lookup_cached_response(
+                user_id, template_name, template, user_prompt
+            )
+
+        # The turn is written once, with its response, by the write-behind log; the
+        # id is assigned here so it can be returned before the write happens
         conversation_doc = {
+            "_id": ObjectId(),
+            "session_id": session_id,
             "prompt": user_prompt,
             "template": template_name,
             "timestamp": time.time(),
         }
-        doc_id = insert_document(user_id, "conversations", conversation_doc)
 
-        response = co.chat(
-            model=CHAT_MODEL,
-            messages=[
-                {"role": "system", "content": template["system_prompt"]},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=template["temperature"],
-            max_tokens=template["max_tokens"],
-        )
+        chat_kwargs = {
+            "model": CHAT_MODEL,
+            "messages": messages,
+            "temperature": template["temperature"],
+            "max_tokens": template["max_tokens"],
+            "request_options": {"timeout_in_seconds": CHAT_TIMEOUT},
+        }
+
+        if data.get("stream"):
+            return sse_response(
+                stream_generation(user_id, conversation_doc, chat_kwargs, cache_entry)
+            )
 
-        response_text = response.message.content[0].text
-        update_document(user_id, "conversations", doc_id, {"response": response_text})
+        cached = cache_entry is not None and cache_entry["response"] is not None
+        if cached:
+            response_text = cache_entry["response"]
+        else:
+            response = co.chat(**chat_kwargs)
+            response_text = response.message.content[0].text
+            store_cached_response(cache_entry, response_text)
+        conversation_log.log(user_id, {**conversation_doc, "response": response_text})
 
         return jsonify(
-            {"response": response_text, "conversation_id": doc_id, "user_id": user_id}
+            {
+                "response": response_text,
+                "conversation_id": str(conversation_doc["_id"]),
+                "session_id": session_id,
+                "user_id": user_id,
+                "cached": cached,
+            }
         )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
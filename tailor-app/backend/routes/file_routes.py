@@ -1,15 +1,38 @@
-import base64
+import concurrent.futures
+import json
+import os
 from datetime import datetime
 import logging
 from werkzeug.utils import secure_filename
 from flask import Blueprint, request, jsonify
 from bson.objectid import ObjectId
-import cohere
-from init_mongo import insert_document, find_documents, delete_document, update_document
-from utils.helpers import ALLOWED_EXTENSIONS, allowed_file
+from pymongo.errors import BulkWriteError
+from init_mongo import (
+    get_user_collection,
+    insert_document,
+    insert_documents,
+    find_documents,
+    delete_document,
+    update_document,
+)
+from utils.helpers import ALLOWED_EXTENSIONS, VALID_CLASSES, allowed_file
+from utils.async_blob_storage import upload_files
 from utils.blob_storage import blob_storage
+from utils.class_centroids import class_centroids, update_centroids
+from utils.embeddings import document_hash
+from utils.embedding_versions import active_embedding_version, embedding_fields
+from utils.pipeline import Pipeline
+from utils.jobs import job_queue
+from utils.model_scheduler import BACKGROUND, model_caller
+from usecases.image_analysis import analyze_image, parse_analysis
+from usecases.text_prompt import (
+    SEARCH_DIVERSIFY,
+    SEARCH_TIME_BUDGET,
+    explain_report,
+    search_database,
+)
+from utils.cohere_client import co
 
-co = cohere.ClientV2()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,20 +40,74 @@ logger = logging.getLogger(__name__)
 # Create Blueprint
 file_bp = Blueprint("file_bp", __name__)
 
+# Most files a "more like this" search returns
+MAX_SIMILAR_RESULTS = 50
 
-# Define valid file classes
-VALID_CLASSES = {
-    "art and film",
-    "fabric",
-    "fashion illustration",
-    "garment",
-    "historical photograph",
-    "location photograph",
-    "nature",
-    "runway",
-    "street style photograph",
-    "texture",
-}
+# Shared pool for the concurrent steps of the upload pipeline
+upload_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPLOAD_PIPELINE_WORKERS", "16"))
+)
+
+
+def blob_metadata(file_doc):
+    """
+    Metadata mirrored onto the blob so it can be inspected without MongoDB.
+    Azure metadata names must be valid C# identifiers, so "class" is stored as "file_class".
+    """
+    return {
+        "description": file_doc.get("description", ""),
+        "file_class": file_doc.get("class", ""),
+        "colour": file_doc.get("colour", ""),
+    }
+
+
+def ingest_file(user_id, file_id):
+    """
+    Background job: fill in missing metadata from an image analysis, embed the file
+    and mark it ready for search. Safe to retry.
+    """
+    file_doc = list(find_documents(user_id, "files", {"_id": ObjectId(file_id)}))[0]
+    previous_doc = dict(file_doc)
+    previous_metadata = blob_metadata(file_doc)
+
+    if not all(file_doc.get(field) for field in ("description", "class", "colour")):
+        # The image is read back from blob storage, so the job needs only the file id
+        image_bytes = blob_storage.download_blob(
+            file_doc["blob_name"], file_doc.get("container")
+        )
+        analysis = parse_analysis(analyze_image(co, image_bytes))
+        for field, value in analysis.items():
+            if not file_doc.get(field):
+                file_doc[field] = value
+
+    update = {
+        "description": file_doc.get("description", ""),
+        "class": file_doc.get("class", ""),
+        "colour": file_doc.get("colour", ""),
+        **embedding_fields(user_id, [file_doc])[0],
+        "status": "ready",
+    }
+    update_document(user_id, "files", file_id, update)
+    # A retry after a crash between these writes nets to no change; the periodic
+    # rebuild (see utils/class_centroids.py) brings the file back into its class
+    update_centroids(user_id, added=[{**file_doc, **update}], removed=[previous_doc])
+
+    new_metadata = blob_metadata(file_doc)
+    if new_metadata != previous_metadata:
+        blob_storage.set_blob_metadata(
+            file_doc["blob_name"], new_metadata, file_doc.get("container")
+        )
+
+    return {"file_id": file_id}
+
+
+def mark_ingest_failed(user_id, error, file_id):
+    update_document(
+        user_id, "files", file_id, {"status": "failed", "error": str(error)}
+    )
+
+
+job_queue.register("ingest_file", ingest_file, on_failure=mark_ingest_failed)
 
 
 @file_bp.route("/api/files/analyze", methods=["POST"])
@@ -54,40 +131,10 @@ def analyze_file():
             return jsonify({"error": "No file uploaded"}), 400
 
         file = request.files["file"]
-        # Convert image to base64 for Cohere API
-        image_base64 = base64.b64encode(file.read()).decode("utf-8")
-        image_url = f"data:image/png;base64,{image_base64}"
-        # Construct the AI prompt
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Can you return your answer as a list, with square brackets and quotations but without the indenting and formatting:",
-                    },
-                    {
-                        "type": "text",
-                        "text": "1. The general vibe in a brief sentence.",
-                    },
-                    {
-                        "type": "text",
-                        "text": "2. The classification from this list: ('fabric', 'fashion illustration', 'garment', 'historical photograph', 'location photograph', 'nature', 'runway', 'street style photograph', 'texture').",
-                    },
-                    {
-                        "type": "text",
-                        "text": "3. The main colors in the image, separated by commas.",
-                    },
-                    {"type": "image_url", "image_url": {"url": image_url}},
-                ],
-            }
-        ]
+        analysis = analyze_image(co, file.read())
 
-        # Call Cohere AI
-        response = co.chat(model="c4ai-aya-vision-8b", messages=messages, temperature=0)
-        # Extract response
         return (
-            jsonify({"success": True, "analysis": response.message.content[0].text}),
+            jsonify({"success": True, "analysis": analysis}),
             200,
         )
 
@@ -106,6 +153,10 @@ def upload_file():
     - user_id: ID of the user uploading the file
     - class: Classification of the file (from predefined list)
     - colour: Colour description of the file
+
+    Optional:
+    - background: "true" to return 202 as soon as the blob is stored; the file is
+      embedded by a job worker and its progress polled at /api/jobs/<job_id>
     """
     try:
         # Check if all required fields are present
@@ -152,34 +203,103 @@ def upload_file():
         # Secure the filename
         secure_name = secure_filename(file.filename)
 
-        # Upload to Azure Blob Storage
-        upload_result = blob_storage.upload_file(
-            file_data=file.read(), original_filename=secure_name
-        )
+        file_data = file.read()
 
-        embedding = co.embed(
-            texts=[description, file_class, colour],
-            model="embed-english-v3.0",
-            input_type="search_document",
-            embedding_types=["float"],
-        ).embeddings.float
-
-        # Prepare document for MongoDB
-        file_document = {
-            "filename": secure_name,
-            "blob_name": upload_result["blob_name"],
-            "blob_url": upload_result["blob_url"],
-            "description": description,
-            "size_bytes": upload_result["size"],
-            "timestamp": datetime.utcnow(),
-            "container": upload_result["container"],
-            "embedding": embedding[0],
-            "class": file_class,
-            "colour": colour,
-        }
+        def upload_blob():
+            return blob_storage.upload_file(
+                file_data=file_data,
+                original_filename=secure_name,
+                metadata=blob_metadata(
+                    {"description": description, "class": file_class, "colour": colour}
+                ),
+            )
 
-        # Store metadata in MongoDB
-        document_id = insert_document(user_id, "files", file_document)
+        def delete_orphaned_blob(upload_result):
+            blob_storage.delete_blob(
+                upload_result["blob_name"], upload_result["container"]
+            )
+
+        # In background mode the request only stores the blob and a pending document;
+        # analysis of missing fields and embedding run on a job worker
+        if request.form.get("background", "").lower() == "true":
+            upload_result = upload_blob()
+            try:
+                document_id = insert_document(
+                    user_id,
+                    "files",
+                    {
+                        "filename": secure_name,
+                        "blob_name": upload_result["blob_name"],
+                        "blob_url": upload_result["blob_url"],
+                        "description": description,
+                        "size_bytes": upload_result["size"],
+                        "timestamp": datetime.utcnow(),
+                        "container": upload_result["container"],
+                        "class": file_class,
+                        "colour": colour,
+                        "status": "pending",
+                    },
+                )
+            except Exception:
+                delete_orphaned_blob(upload_result)
+                raise
+
+            job_id = job_queue.enqueue(
+                user_id, "ingest_file", details={"file_id": document_id}
+            )
+
+            upload_result["document_id"] = document_id
+            upload_result["job_id"] = job_id
+            upload_result["status"] = "pending"
+            upload_result["original_filename"] = secure_name
+
+            return (
+                jsonify(
+                    {
+                        "success": True,
+                        "message": "File accepted for processing",
+                        "file_data": upload_result,
+                    }
+                ),
+                202,
+            )
+
+        def embed_metadata():
+            return embedding_fields(
+                user_id,
+                [{"description": description, "class": file_class, "colour": colour}],
+            )[0]
+
+        def store_document(blob, embedding):
+            # Prepare document for MongoDB
+            file_document = {
+                "filename": secure_name,
+                "blob_name": blob["blob_name"],
+                "blob_url": blob["blob_url"],
+                "description": description,
+                "size_bytes": blob["size"],
+                "timestamp": datetime.utcnow(),
+                "container": blob["container"],
+                **embedding,
+                "class": file_class,
+                "colour": colour,
+                "status": "ready",
+            }
+            document_id = insert_document(user_id, "files", file_document)
+            update_centroids(user_id, added=[file_document])
+            return document_id
+
+        # The blob upload and the embedding are independent, so they run concurrently
+        # and the MongoDB insert waits for both. A failure deletes the orphaned blob.
+        results = (
+            Pipeline()
+            .add_stage("blob", upload_blob, compensate=delete_orphaned_blob)
+            .add_stage("embedding", embed_metadata)
+            .add_stage("document", store_document, depends_on=("blob", "embedding"))
+            .run(upload_executor)
+        )
+        upload_result = results["blob"]
+        document_id = results["document"]
 
         # Add the MongoDB ID to the response
         upload_result["document_id"] = document_id
@@ -204,6 +324,191 @@ def upload_file():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@file_bp.route("/api/files/upload-batch", methods=["POST"])
+def upload_files_batch():
+    """
+    Endpoint to upload many files in one multipart request
+
+    Request requires:
+    - files: The files to upload (repeated field)
+    - metadata: JSON list with one {"description", "class", "colour"} object per file,
+      in the same order as files
+    - user_id: ID of the user uploading the files
+
+    Blobs are uploaded concurrently, the uploaded files are embedded in one batched
+    call, and the documents are written with a single insert_many.
+
+    Response:
+    - results: One entry per file, in request order, with success and either
+      document_id/blob_url or error
+    """
+    try:
+        files = request.files.getlist("files")
+        if not files:
+            return jsonify({"error": "No files provided"}), 400
+
+        user_id = request.form.get("user_id")
+        if not user_id:
+            return jsonify({"error": "User ID is required"}), 400
+
+        try:
+            metadata = json.loads(request.form.get("metadata", "[]"))
+        except json.JSONDecodeError:
+            return jsonify({"error": "Invalid metadata format"}), 400
+
+        if not isinstance(metadata, list) or len(metadata) not in (0, len(files)):
+            return (
+                jsonify({"error": "metadata must be a list with one entry per file"}),
+                400,
+            )
+
+        # Validate every item up front; invalid items are reported, not uploaded
+        results = []
+        items = []
+        for index, file in enumerate(files):
+            item_metadata = metadata[index] if metadata else {}
+            valid_metadata = isinstance(item_metadata, dict) and all(
+                isinstance(item_metadata.get(field, ""), str)
+                for field in ("description", "class", "colour")
+            )
+            if not valid_metadata:
+                item_metadata = {}
+            item = {
+                "index": index,
+                "filename": secure_filename(file.filename or ""),
+                "description": item_metadata.get("description", ""),
+                "class": item_metadata.get("class", ""),
+                "colour": item_metadata.get("colour", ""),
+            }
+            results.append({"index": index, "original_filename": item["filename"]})
+
+            if not valid_metadata:
+                results[index].update(
+                    success=False,
+                    error="metadata must be an object whose description, class and "
+                    "colour are strings",
+                )
+            elif not file.filename or not allowed_file(file.filename):
+                results[index].update(
+                    success=False,
+                    error=f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}",
+                )
+            elif item["class"] and item["class"] not in VALID_CLASSES:
+                results[index].update(
+                    success=False,
+                    error=f"Invalid class. Allowed classes: {', '.join(VALID_CLASSES)}",
+                )
+            else:
+                item["data"] = file.read()
+                items.append(item)
+
+        if items:
+            # Upload every blob concurrently, then embed the uploaded files in one call
+            uploads = upload_files(
+                blob_storage,
+                [
+                    {
+                        "file_data": item["data"],
+                        "original_filename": item["filename"],
+                        "metadata": blob_metadata(item),
+                    }
+                    for item in items
+                ],
+            )
+            for item, upload in zip(items, uploads):
+                if isinstance(upload, Exception):
+                    logger.warning(f"Could not upload {item['filename']}: {upload}")
+                    results[item["index"]].update(success=False, error=str(upload))
+                else:
+                    item["blob"] = upload
+
+            uploaded = [item for item in items if "blob" in item]
+            try:
+                # Bulk uploads are ingestion; their embeds queue behind interactive calls
+                with model_caller(user_id, BACKGROUND):
+                    fields = embedding_fields(user_id, uploaded) if uploaded else []
+                for item, item_fields in zip(uploaded, fields):
+                    item["embedding_fields"] = item_fields
+                documents = [
+                    {
+                        "filename": item["filename"],
+                        "blob_name": item["blob"]["blob_name"],
+                        "blob_url": item["blob"]["blob_url"],
+                        "description": item["description"],
+                        "size_bytes": item["blob"]["size"],
+                        "timestamp": datetime.utcnow(),
+                        "container": item["blob"]["container"],
+                        **item["embedding_fields"],
+                        "class": item["class"],
+                        "colour": item["colour"],
+                        "status": "ready",
+                    }
+                    for item in uploaded
+                ]
+                document_ids = (
+                    insert_documents(user_id, "files", documents) if documents else []
+                )
+            except BulkWriteError as e:
+                # insert_many is ordered: the documents before the first rejected one
+                # were written and keep their blobs, the rest are reported as failed
+                written = e.details.get("nInserted", 0)
+                errors = {
+                    error["index"]: error.get("errmsg", str(e))
+                    for error in e.details.get("writeErrors", [])
+                }
+                logger.warning(f"Stored {written} of {len(documents)} files: {e}")
+                for index, item in enumerate(uploaded[written:], start=written):
+                    blob_storage.delete_blob(
+                        item["blob"]["blob_name"], item["blob"]["container"]
+                    )
+                    results[item["index"]].update(
+                        success=False,
+                        error=errors.get(index, "File was not stored"),
+                    )
+                uploaded = uploaded[:written]
+                documents = documents[:written]
+                # insert_many sets the _id of each document it sends
+                document_ids = [str(document["_id"]) for document in documents]
+            except Exception:
+                # Do not leave blobs behind that no document points to
+                for item in uploaded:
+                    blob_storage.delete_blob(
+                        item["blob"]["blob_name"], item["blob"]["container"]
+                    )
+                raise
+            update_centroids(user_id, added=documents)
+
+            for item, document_id in zip(uploaded, document_ids):
+                results[item["index"]].update(
+                    {
+                        "success": True,
+                        "document_id": document_id,
+                        "blob_name": item["blob"]["blob_name"],
+                        "blob_url": item["blob"]["blob_url"],
+                        "container": item["blob"]["container"],
+                        "description": item["description"],
+                        "class": item["class"],
+                        "colour": item["colour"],
+                    }
+                )
+
+        uploaded_count = sum(1 for result in results if result["success"])
+        return (
+            jsonify(
+                {
+                    "success": uploaded_count == len(results),
+                    "message": f"Uploaded {uploaded_count} of {len(results)} files",
+                    "results": results,
+                }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        logger.error(f"Error in batch file upload: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 @file_bp.route("/api/files/user/<user_id>", methods=["GET"])
 def get_user_files(user_id):
     """
@@ -259,6 +564,7 @@ def delete_file(user_id, file_id):
 
         # Delete from MongoDB
         delete_document(user_id, "files", file_id)
+        update_centroids(user_id, removed=[file_doc])
 
         return (
             jsonify(
@@ -278,7 +584,8 @@ def delete_file(user_id, file_id):
 @file_bp.route("/api/files/<user_id>/<file_id>", methods=["PATCH"])
 def update_file(user_id, file_id):
     """
-    Endpoint to update file metadata (description, class, colour) in MongoDB and Azure Blob Storage
+    Endpoint to update file metadata (description, class, colour) in MongoDB.
+    The blob's metadata headers are only rewritten when the mirrored fields change.
     """
     try:
         # Find the file document first
@@ -311,30 +618,37 @@ def update_file(user_id, file_id):
                 400,
             )
 
+        previous_doc = dict(file_doc)
+        previous_metadata = blob_metadata(file_doc)
+
         # Update document fields
         file_doc["description"] = description
         file_doc["class"] = file_class
         file_doc["colour"] = colour
 
-        # Update embedding
-        new_embedding = co.embed(
-            texts=[description, file_class, colour],
-            model="embed-english-v3.0",
-            input_type="search_document",
-            embedding_types=["float"],
-        ).embeddings.float
-        file_doc["embedding"] = new_embedding[0]
+        # Re-embed only when the embedded text changed; otherwise keep the stored vector
+        active = active_embedding_version(user_id)
+        new_hash = document_hash(file_doc)
+        if (
+            active["field"] not in file_doc
+            or file_doc.get("embedding_hash") != new_hash
+        ):
+            file_doc.update(embedding_fields(user_id, [file_doc])[0])
 
-        # Update in Azure Blob Storage
-        if blob_name:
-            blob_updated = blob_storage.update_blob(blob_name, file_doc, container)
+        # Mirror changed metadata onto the blob; the image itself is never rewritten
+        new_metadata = blob_metadata(file_doc)
+        if blob_name and new_metadata != previous_metadata:
+            blob_updated = blob_storage.set_blob_metadata(
+                blob_name, new_metadata, container
+            )
             if not blob_updated:
                 logger.warning(
-                    f"Could not update blob {blob_name} in container {container}"
+                    f"Could not update blob metadata for {blob_name} in container {container}"
                 )
 
         # Update in MongoDB
         result = update_document(user_id, "files", file_id, file_doc)
+        update_centroids(user_id, added=[file_doc], removed=[previous_doc])
 
         return (
             jsonify(
@@ -373,6 +687,7 @@ def get_file_metadata(user_id, file_id):
             "description": file_doc.get("description", ""),
             "class": file_doc.get("class", ""),
             "colour": file_doc.get("colour", ""),
+            "status": file_doc.get("status", "ready"),
         }
 
         return jsonify({"success": True, "file_data": result}), 200
@@ -380,3 +695,99 @@ def get_file_metadata(user_id, file_id):
     except Exception as e:
         logger.error(f"Error retrieving file metadata: {e}", exc_info=True)
         return jsonify({"success": False, "error": str(e)}), 500
+
+
+def list_arg(name):
+    """Values of a query parameter given repeatedly and/or comma-separated."""
+    return [
+        value.strip()
+        for arg in request.args.getlist(name)
+        for value in arg.split(",")
+        if value.strip()
+    ]
+
+
+@file_bp.route("/api/files/<user_id>/<file_id>/similar", methods=["GET"])
+def get_similar_files(user_id, file_id):
+    """
+    Endpoint to find the files most similar to file_id ("more like this").
+    The file's stored embedding is the query vector, so no model is called.
+
+    Query parameters:
+    - topK: Number of files to return (default 10, at most MAX_SIMILAR_RESULTS)
+    - class: Classes to restrict the results to (repeated or comma-separated)
+    - exclude: IDs of files to leave out, e.g. those already on the board
+    - debug: "explain" to return the trace of the search
+
+    The files are returned best match first, with their similarity scores. The file
+    itself is never returned.
+    """
+    try:
+        try:
+            top_k = int(request.args.get("topK", 10))
+        except ValueError:
+            return jsonify({"error": "topK must be an integer"}), 400
+        if not 1 <= top_k <= MAX_SIMILAR_RESULTS:
+            return (
+                jsonify({"error": f"topK must be between 1 and {MAX_SIMILAR_RESULTS}"}),
+                400,
+            )
+
+        classes = list_arg("class")
+        if any(file_class not in VALID_CLASSES for file_class in classes):
+            return (
+                jsonify(
+                    {
+                        "error": f"Invalid class. Allowed classes: {', '.join(VALID_CLASSES)}"
+                    }
+                ),
+                400,
+            )
+
+        excluded_ids = list_arg("exclude")
+        if not all(ObjectId.is_valid(i) for i in [file_id, *excluded_ids]):
+            return jsonify({"error": "Invalid file ID"}), 400
+
+        file_docs = list(find_documents(user_id, "files", {"_id": ObjectId(file_id)}))
+        if not file_docs:
+            return jsonify({"error": "File not found"}), 404
+
+        embedding_version = active_embedding_version(user_id)
+        query_emb = file_docs[0].get(embedding_version["field"])
+        if query_emb is None:
+            # Files uploaded in the background are embedded by a job
+            return jsonify({"error": "File has not been embedded yet"}), 409
+
+        report = {}
+        image_ids, blob_urls = search_database(
+            get_user_collection(user_id, "files"),
+            f"similar to {file_id}",
+            postfilter={"score": {"$gt": 0}},
+            excluded_ids=[file_id, *excluded_ids],
+            topK=top_k,
+            embedding_version=embedding_version,
+            time_budget=SEARCH_TIME_BUDGET,
+            diversify_results=SEARCH_DIVERSIFY,
+            report=report,
+            centroids=class_centroids(user_id, embedding_version["field"]),
+            query_emb=query_emb,
+            classes=classes or None,
+            shuffle=False,
+        )
+
+        scores = report.get("scores", {})
+        response = {
+            "success": True,
+            "file_id": file_id,
+            "image_ids": image_ids,
+            "blob_urls": blob_urls,
+            "scores": [scores.get(image_id) for image_id in image_ids],
+            "skipped_groups": report.get("skipped_groups", []),
+        }
+        if request.args.get("debug") == "explain":
+            response["explain"] = explain_report(report)
+        return jsonify(response), 200
+
+    except Exception as e:
+        logger.error(f"Error finding similar files: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
@@ -0,0 +1,44 @@
+import logging
+from flask import Blueprint, jsonify, request
+from bson.objectid import ObjectId
+from init_mongo import find_documents
+from utils.helpers import get_user_id
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Create Blueprint
+job_bp = Blueprint("job_bp", __name__)
+
+
+@job_bp.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    """
+    Endpoint to poll the status of a background job.
+
+    Query parameters:
+    - user_id: Owner of the job, defaults to the session user
+
+    Response:
+    - job: status ("pending", "running", "completed" or "failed"), attempts,
+      result or error, and timestamps
+    """
+    try:
+        user_id = request.args.get("user_id") or get_user_id()
+        jobs = list(find_documents(user_id, "jobs", {"_id": ObjectId(job_id)}))
+
+        if not jobs:
+            return jsonify({"error": "Job not found"}), 404
+
+        job = jobs[0]
+        job["_id"] = str(job["_id"])
+        for field in ("created_at", "started_at", "finished_at"):
+            if field in job:
+                job[field] = job[field].isoformat()
+
+        return jsonify({"success": True, "job": job}), 200
+
+    except Exception as e:
+        logger.error(f"Error retrieving job status: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
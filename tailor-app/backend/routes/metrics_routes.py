@@ -0,0 +1,55 @@
+import logging
+from flask import Blueprint, jsonify
+from utils.cohere_client import cohere_dependency, cohere_metrics, embed_hedger
+from utils.blob_storage import azure_dependency
+from utils.embeddings import embedding_cache, embedding_service
+from utils.semantic_cache import semantic_cache
+from utils.conversation_log import conversation_log
+from utils.model_scheduler import model_scheduler
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Create Blueprint
+metrics_bp = Blueprint("metrics_bp", __name__)
+
+
+@metrics_bp.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Endpoint reporting in-process counters of this worker.
+
+    Response:
+    - cohere_connections: requests, new connections, TLS handshakes and reuse ratio
+      of the shared Cohere connection pool
+    - embedding_cache: hits and misses of the embedding cache
+    - embedding_batcher: texts embedded and embed requests sent
+    - semantic_cache: hits, misses, hit rate and entries per template of the chat
+      response cache
+    - conversation_log: chat turns logged, written and still buffered by the
+      write-behind conversation log, failed flushes and turns MongoDB rejected
+    - model_scheduler: Cohere calls in flight per model, and per priority lane the
+      calls waiting, in flight, admitted and timed out with their queue times
+    - resilience: calls, retries, failures and circuit state of Cohere and Azure, and
+      how often embed calls were hedged and the hedge answered first
+    """
+    try:
+        return jsonify(
+            {
+                "cohere_connections": cohere_metrics.snapshot(),
+                "embedding_cache": dict(embedding_cache.stats),
+                "embedding_batcher": dict(embedding_service.stats),
+                "semantic_cache": semantic_cache.snapshot(),
+                "conversation_log": conversation_log.snapshot(),
+                "model_scheduler": model_scheduler.snapshot(),
+                "resilience": {
+                    "cohere": cohere_dependency.snapshot(),
+                    "azure": azure_dependency.snapshot(),
+                    "embed_hedging": embed_hedger.snapshot(),
+                },
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error collecting metrics: {e}", exc_info=True)
+        return jsonify({"success": False, "error": str(e)}), 500
@@ -4,13 +4,13 @@ import base64
 import json
 from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
-import cohere
 from bson.objectid import ObjectId
 from init_mongo import insert_document, find_documents, delete_document
 from utils.blob_storage import blob_storage
 from utils.helpers import allowed_file, ALLOWED_EXTENSIONS, MAX_IMAGE_SIZE
+from utils.cohere_client import VISION_TIMEOUT, co
+from utils.sse import format_sse, sse_response, stream_chat_text
 
-co = cohere.ClientV2()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,6 +19,28 @@ logger = logging.getLogger(__name__)
 board_bp = Blueprint("board_bp", __name__)
 
 
+def wants_stream():
+    return request.form.get("stream", "").lower() == "true"
+
+
+def stream_analysis(chat_kwargs):
+    """
+    Relay a moodboard analysis as SSE: one "delta" event per markdown chunk, then
+    "end" with the full analysis, or "error" if the stream broke off.
+    """
+    chunks = []
+    try:
+        for text in stream_chat_text(co.chat_stream(**chat_kwargs)):
+            chunks.append(text)
+            yield format_sse({"text": text}, "delta")
+    except Exception as e:
+        logger.error(f"Error streaming moodboard analysis: {e}", exc_info=True)
+        yield format_sse({"error": str(e)}, "error")
+        return
+
+    yield format_sse({"success": True, "analysis": "".join(chunks)}, "end")
+
+
 @board_bp.route("/api/boards/analyze", methods=["POST"])
 def analyze_moodboard_with_desc():
     """
@@ -27,6 +49,7 @@ def analyze_moodboard_with_desc():
     Request:
     - file: The image file to analyze.
     - image_descriptions: A list of descriptions of images in the moodboard.
+    - stream: "true" to receive the analysis as Server-Sent Events (see stream_analysis).
 
     Response:
     - success (bool): Whether the request was processed successfully.
@@ -101,10 +124,17 @@ def analyze_moodboard_with_desc():
             }
         ]
 
+        chat_kwargs = {
+            "model": "c4ai-aya-vision-8b",
+            "messages": messages,
+            "temperature": 0.3,
+            "request_options": {"timeout_in_seconds": VISION_TIMEOUT},
+        }
+        if wants_stream():
+            return sse_response(stream_analysis(chat_kwargs))
+
         # Call Cohere API
-        response = co.chat(
-            model="c4ai-aya-vision-8b", messages=messages, temperature=0.3
-        )
+        response = co.chat(**chat_kwargs)
 
         return jsonify(
             {"success": True, "analysis": response.message.content[0].text}
@@ -122,6 +152,7 @@ def analyze_moodboard_no_desc():
 
     Request:
     - file: The image file to analyze.
+    - stream: "true" to receive the analysis as Server-Sent Events (see stream_analysis).
 
     Response:
     - success (bool): Whether the request was processed successfully.
@@ -172,7 +203,16 @@ def analyze_moodboard_no_desc():
             }
         ]
 
-        response = co.chat(model="c4ai-aya-vision-8b", messages=messages, temperature=0)
+        chat_kwargs = {
+            "model": "c4ai-aya-vision-8b",
+            "messages": messages,
+            "temperature": 0,
+            "request_options": {"timeout_in_seconds": VISION_TIMEOUT},
+        }
+        if wants_stream():
+            return sse_response(stream_analysis(chat_kwargs))
+
+        response = co.chat(**chat_kwargs)
 
         # Extract response
         return jsonify(
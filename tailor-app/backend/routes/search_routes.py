@@ -1,11 +1,20 @@
 import logging
 from flask import Blueprint, jsonify, request
 from utils.helpers import get_user_id
-from usecases.text_prompt import search_database
+from usecases.text_prompt import (
+    SEARCH_DIVERSIFY,
+    SEARCH_TIME_BUDGET,
+    explain_report,
+    search_database,
+    search_database_batch,
+)
+from utils.class_centroids import class_centroids
+from utils.embedding_versions import active_embedding_version
 from init_mongo import (
     find_documents,
     get_user_collection,
     insert_document,
+    insert_documents,
     update_document,
 )
 
@@ -16,6 +25,18 @@ logger = logging.getLogger(__name__)
 search_bp = Blueprint("moodboard", __name__)
 generated_images = set()  # Keep track of already generated images
 
+# Most prompts and results per prompt a batch search accepts
+MAX_BATCH_PROMPTS = 10
+MAX_BATCH_TOP_K = 50
+
+
+def explain_requested():
+    """
+    Whether the search should be explained, via "debug": "explain" in the body or
+    ?debug=explain.
+    """
+    return (request.args.get("debug") or request.json.get("debug")) == "explain"
+
 
 @search_bp.route("/api/search-prompt", methods=["POST"])
 def search_prompt():
@@ -26,8 +47,17 @@ def search_prompt():
     try:
         user_id = get_user_id()
         files_collection = get_user_collection(user_id, "files")
+        embedding_version = active_embedding_version(user_id)
+        report = {}
         image_ids, blob_urls = search_database(
-            files_collection, prompt, postfilter={"score": {"$gt": 0}}
+            files_collection,
+            prompt,
+            postfilter={"score": {"$gt": 0}},
+            embedding_version=embedding_version,
+            time_budget=SEARCH_TIME_BUDGET,
+            diversify_results=SEARCH_DIVERSIFY,
+            report=report,
+            centroids=class_centroids(user_id, embedding_version["field"]),
         )
         temp_board_document = {
             "prompt": prompt,
@@ -40,9 +70,16 @@ def search_prompt():
         # Store temp board metadata in MongoDB to keep track of the current image ids (that are subject to change)
         insert_document(user_id, "temp_boards", temp_board_document)
 
-        return jsonify(
-            {"image_ids": image_ids, "blob_urls": blob_urls, "user_id": user_id}
-        )
+        response = {
+            "image_ids": image_ids,
+            "blob_urls": blob_urls,
+            "user_id": user_id,
+            # Class groups left out because their search ran over the time budget
+            "skipped_groups": report.get("skipped_groups", []),
+        }
+        if explain_requested():
+            response["explain"] = explain_report(report)
+        return jsonify(response)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -65,24 +102,33 @@ def regenerate_search():
         temp_board_id = temp_board["_id"]
         queue_images = temp_board["queue_images"]
         curr_images = temp_board["curr_images"]
+        report = {}
 
         if not queue_images:
             # Have the database NOT search among the already generated image ids
+            embedding_version = active_embedding_version(user_id)
             image_ids, blob_urls = search_database(
                 files_collection,
                 prompt,
                 postfilter={"score": {"$gt": 0}},
                 excluded_ids=[img[0] for img in curr_images],
+                embedding_version=embedding_version,
+                time_budget=SEARCH_TIME_BUDGET,
+                diversify_results=SEARCH_DIVERSIFY,
+                report=report,
+                centroids=class_centroids(user_id, embedding_version["field"]),
             )
 
             if not image_ids:
-                return jsonify(
-                    {
-                        "image_ids": image_ids,
-                        "blob_urls": blob_urls,
-                        "success": "No new relevant images found",
-                    }
-                )
+                response = {
+                    "image_ids": image_ids,
+                    "blob_urls": blob_urls,
+                    "success": "No new relevant images found",
+                    "skipped_groups": report.get("skipped_groups", []),
+                }
+                if explain_requested():
+                    response["explain"] = explain_report(report)
+                return jsonify(response)
 
             # Add new unique images to queue
             for i in range(min(len(image_ids), 10)):
@@ -94,10 +140,100 @@ def regenerate_search():
         temp_board["curr_images"] = curr_images
         update_document(user_id, "temp_boards", temp_board_id, temp_board)
 
+        response = {
+            "next_image": [next_image_id, next_image_url],
+            "remaining_queue_size": len(queue_images),
+            "user_id": user_id,
+            "skipped_groups": report.get("skipped_groups", []),
+        }
+        if explain_requested():
+            # An empty report: the image came from the queue without a search
+            response["explain"] = explain_report(report)
+        return jsonify(response)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@search_bp.route("/api/search-batch", methods=["POST"])
+def search_batch():
+    """
+    Search several prompts in one request, e.g. a theme, a fabric and a location.
+
+    Request requires:
+    - prompts: List of prompts (at most MAX_BATCH_PROMPTS)
+    - topK: Optional number of images per prompt (default 10)
+
+    All prompts are embedded in one call and searched concurrently; an image is only
+    returned for the prompt it matches best. A temp board is stored per prompt, so
+    /api/regenerate-search works for each of them.
+    """
+    prompts = request.json.get("prompts")
+    if (
+        not isinstance(prompts, list)
+        or not prompts
+        or not all(isinstance(prompt, str) and prompt for prompt in prompts)
+    ):
+        return jsonify({"error": "'prompts' must be a non-empty list of prompts"}), 400
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return (
+            jsonify({"error": f"At most {MAX_BATCH_PROMPTS} prompts per request"}),
+            400,
+        )
+    top_k = request.json.get("topK", 10)
+    if not isinstance(top_k, int) or not 1 <= top_k <= MAX_BATCH_TOP_K:
+        return (
+            jsonify({"error": f"topK must be between 1 and {MAX_BATCH_TOP_K}"}),
+            400,
+        )
+
+    try:
+        user_id = get_user_id()
+        files_collection = get_user_collection(user_id, "files")
+        embedding_version = active_embedding_version(user_id)
+        reports = [{} for _ in prompts]
+        results, duplicates = search_database_batch(
+            files_collection,
+            prompts,
+            topK=top_k,
+            embedding_version=embedding_version,
+            reports=reports,
+            postfilter={"score": {"$gt": 0}},
+            time_budget=SEARCH_TIME_BUDGET,
+            diversify_results=SEARCH_DIVERSIFY,
+            centroids=class_centroids(user_id, embedding_version["field"]),
+        )
+
+        insert_documents(
+            user_id,
+            "temp_boards",
+            [
+                {
+                    "prompt": prompt,
+                    "curr_images": [list(image) for image in zip(image_ids, blob_urls)],
+                    "queue_images": [],
+                }
+                for prompt, (image_ids, blob_urls) in zip(prompts, results)
+            ],
+        )
+
+        explain = explain_requested()
+        response_results = []
+        for prompt, (image_ids, blob_urls), report in zip(prompts, results, reports):
+            result = {
+                "prompt": prompt,
+                "image_ids": image_ids,
+                "blob_urls": blob_urls,
+                "skipped_groups": report.get("skipped_groups", []),
+            }
+            if explain:
+                result["explain"] = explain_report(report)
+            response_results.append(result)
+
         return jsonify(
             {
-                "next_image": [next_image_id, next_image_url],
-                "remaining_queue_size": len(queue_images),
+                "results": response_results,
+                "duplicates_removed": duplicates,
                 "user_id": user_id,
             }
         )
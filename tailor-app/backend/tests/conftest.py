@@ -19,6 +19,18 @@ def setup_environment():
 
 
 from app import app
+from utils.embeddings import embedding_cache
+from utils.embedding_versions import clear_state_cache
+from utils.class_centroids import clear_centroid_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_embedding_cache():
+    """Start every test without cached embeddings from earlier tests."""
+    embedding_cache.clear()
+    clear_state_cache()
+    clear_centroid_cache()
+    yield
 
 
 @pytest.fixture
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from utils.async_blob_storage import AsyncAzureBlobStorage, upload_files
+from utils.resilience import DeadlineExceeded, deadline_budget, time_remaining
+
+
+def make_service_client():
+    mock_service_client = MagicMock()
+    mock_service_client.close = AsyncMock()
+    mock_container_client = MagicMock()
+    mock_container_client.url = (
+        "https://test-storage.blob.core.windows.net/user-uploads"
+    )
+    mock_container_client.container_name = "user-uploads"
+    mock_container_client.upload_blob = AsyncMock()
+    mock_container_client.delete_blob = AsyncMock()
+    mock_blob_client = MagicMock()
+    mock_blob_client.set_blob_metadata = AsyncMock()
+    mock_blob_client.set_blob_tags = AsyncMock()
+    mock_blob_client.upload_blob = AsyncMock()
+    mock_container_client.get_blob_client.return_value = mock_blob_client
+    mock_service_client.get_container_client.return_value = mock_container_client
+    return mock_service_client, mock_container_client, mock_blob_client
+
+
+@patch.dict(os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"})
+@patch("utils.async_blob_storage.aiohttp.ClientSession")
+@patch("utils.async_blob_storage.BlobServiceClient")
+class TestAsyncAzureBlobStorage(unittest.TestCase):
+    def make_storage(self, mock_blob_service_client, mock_session):
+        mock_service_client, mock_container_client, mock_blob_client = (
+            make_service_client()
+        )
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+        mock_session.return_value.close = AsyncMock()
+        storage = AsyncAzureBlobStorage()
+        self.addCleanup(storage.close)
+        return storage, mock_service_client, mock_container_client, mock_blob_client
+
+    def test_upload_file_from_sync_code(self, mock_blob_service_client, mock_session):
+        storage, mock_service_client, mock_container_client, _ = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+
+        with patch("utils.async_blob_storage.uuid.uuid4", return_value="test-uuid"):
+            result = storage.run(storage.upload_file(b"content", "test.jpg"))
+
+        _, kwargs = mock_container_client.upload_blob.call_args
+        self.assertEqual(kwargs["name"], "test-uuid.jpg")
+        self.assertEqual(kwargs["data"], b"content")
+        self.assertEqual(result["blob_name"], "test-uuid.jpg")
+        self.assertEqual(result["container"], "user-uploads")
+        self.assertEqual(result["size"], len(b"content"))
+
+        storage.close()
+        mock_service_client.close.assert_awaited_once()
+        mock_session.return_value.close.assert_awaited_once()
+
+    def test_shared_pool_across_callers_loops(
+        self, mock_blob_service_client, mock_session
+    ):
+        storage, _, _, _ = self.make_storage(mock_blob_service_client, mock_session)
+
+        async def run():
+            await asyncio.gather(
+                storage.delete_blob("a.jpg"),
+                storage.delete_blob("b.jpg"),
+                storage.set_blob_metadata("c.jpg", {"colour": "red"}),
+            )
+
+        # Each asyncio.run is a new loop; the storage keeps running on its own
+        asyncio.run(run())
+        asyncio.run(run())
+
+        # One session and one service client are shared by every operation
+        mock_session.assert_called_once()
+        mock_blob_service_client.from_connection_string.assert_called_once()
+        _, kwargs = mock_blob_service_client.from_connection_string.call_args
+        self.assertIn("transport", kwargs)
+
+    def test_calls_run_under_callers_deadline(
+        self, mock_blob_service_client, mock_session
+    ):
+        storage, _, mock_container_client, _ = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+        remaining = []
+        mock_container_client.delete_blob.side_effect = lambda *args, **kwargs: (
+            remaining.append(time_remaining())
+        )
+
+        with deadline_budget(5):
+            self.assertTrue(storage.run(storage.delete_blob("test.jpg")))
+
+        self.assertIsNotNone(remaining[0])
+        self.assertLessEqual(remaining[0], 5)
+
+    def test_run_stops_waiting_at_deadline(
+        self, mock_blob_service_client, mock_session
+    ):
+        storage, _, mock_container_client, _ = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+
+        async def slow_upload(**kwargs):
+            await asyncio.sleep(5)
+
+        mock_container_client.upload_blob.side_effect = slow_upload
+
+        with deadline_budget(0.05):
+            with self.assertRaises(DeadlineExceeded):
+                storage.run(storage.upload_file(b"content", "test.jpg"))
+
+    def test_upload_files_reports_each_failure(
+        self, mock_blob_service_client, mock_session
+    ):
+        storage, _, mock_container_client, _ = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+        mock_container_client.upload_blob.side_effect = [None, Exception("Failed")]
+
+        results = storage.run(
+            storage.upload_files(
+                [
+                    {"file_data": b"a", "original_filename": "a.jpg"},
+                    {"file_data": b"b", "original_filename": "b.jpg"},
+                ]
+            )
+        )
+
+        self.assertEqual(results[0]["size"], 1)
+        self.assertIsInstance(results[1], Exception)
+
+    def test_delete_blob_exception(self, mock_blob_service_client, mock_session):
+        storage, _, mock_container_client, _ = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+        mock_container_client.delete_blob.side_effect = Exception("Delete failed")
+
+        self.assertFalse(storage.run(storage.delete_blob("test.jpg")))
+
+    def test_set_blob_metadata_and_tags(self, mock_blob_service_client, mock_session):
+        storage, _, _, mock_blob_client = self.make_storage(
+            mock_blob_service_client, mock_session
+        )
+
+        async def run():
+            return (
+                await storage.set_blob_metadata("test.jpg", {"colour": "red"}),
+                await storage.set_blob_tags("test.jpg", {"class": "runway"}),
+            )
+
+        self.assertEqual(asyncio.run(run()), (True, True))
+        _, kwargs = mock_blob_client.set_blob_metadata.call_args
+        self.assertEqual(kwargs["metadata"], {"colour": "red"})
+        self.assertEqual(
+            mock_blob_client.set_blob_tags.call_args[0], ({"class": "runway"},)
+        )
+        mock_blob_client.upload_blob.assert_not_called()
+
+    @patch.dict(os.environ, {"AZURE_STORAGE_CONNECTION_STRING": ""})
+    def test_init_missing_connection_string(
+        self, mock_blob_service_client, mock_session
+    ):
+        with self.assertRaises(ValueError):
+            AsyncAzureBlobStorage()
+
+
+class TestUploadFiles(unittest.TestCase):
+    def test_other_backends_upload_one_by_one(self):
+        storage = MagicMock()
+        storage.upload_file.side_effect = [{"blob_name": "a.jpg"}, Exception("Failed")]
+
+        results = upload_files(
+            storage,
+            [
+                {"file_data": b"a", "original_filename": "a.jpg"},
+                {"file_data": b"b", "original_filename": "b.jpg"},
+            ],
+        )
+
+        self.assertEqual(results[0], {"blob_name": "a.jpg"})
+        self.assertIsInstance(results[1], Exception)
+        storage.upload_file.assert_any_call(file_data=b"b", original_filename="b.jpg")
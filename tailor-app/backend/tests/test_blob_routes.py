@@ -0,0 +1,50 @@
+from unittest.mock import patch
+import pytest
+
+from utils.blob_storage import LocalBlobStorage
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    storage = LocalBlobStorage(
+        root_dir=tmp_path, base_url="http://testserver/api/blobs"
+    )
+    with patch("routes.blob_routes.blob_storage", storage):
+        yield storage
+
+
+def test_serve_blob_success(local_storage, client):
+    blob_name = local_storage.upload_file(b"image bytes", "test.png")["blob_name"]
+
+    response = client.get(f"/api/blobs/user-uploads/{blob_name}")
+
+    assert response.status_code == 200
+    assert response.data == b"image bytes"
+    assert response.headers["ETag"]
+
+
+def test_serve_blob_conditional_and_range(local_storage, client):
+    blob_name = local_storage.upload_file(b"image bytes", "test.png")["blob_name"]
+    etag = client.get(f"/api/blobs/user-uploads/{blob_name}").headers["ETag"]
+
+    response = client.get(
+        f"/api/blobs/user-uploads/{blob_name}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    response = client.get(
+        f"/api/blobs/user-uploads/{blob_name}", headers={"Range": "bytes=0-4"}
+    )
+    assert response.status_code == 206
+    assert response.data == b"image"
+
+
+def test_serve_blob_not_found(local_storage, client):
+    response = client.get("/api/blobs/user-uploads/missing.png")
+    assert response.status_code == 404
+    assert "Blob not found" in response.get_json()["error"]
+
+
+def test_serve_blob_azure_backend(client):
+    response = client.get("/api/blobs/user-uploads/test.png")
+    assert response.status_code == 404
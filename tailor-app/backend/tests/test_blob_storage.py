@@ -1,10 +1,25 @@
+import math
 import unittest
 from unittest.mock import patch, MagicMock
 import os
 import io
+import json
+import tempfile
 
 # Import the class to test
-from utils.blob_storage import AzureBlobStorage
+from utils.blob_storage import (
+    AZURE_CONNECTION_TIMEOUT,
+    AZURE_READ_TIMEOUT,
+    AzureBlobStorage,
+    LocalBlobStorage,
+    create_blob_storage,
+)
+
+# Per-operation timeouts passed to the Azure SDK outside a request deadline
+TIMEOUTS = {
+    "timeout": math.ceil(AZURE_READ_TIMEOUT),
+    "read_timeout": AZURE_READ_TIMEOUT,
+}
 
 
 class TestAzureBlobStorage(unittest.TestCase):
@@ -18,7 +33,10 @@ class TestAzureBlobStorage(unittest.TestCase):
 
         # Verify BlobServiceClient was created with correct connection string
         mock_blob_service_client.from_connection_string.assert_called_once_with(
-            "test_connection_string"
+            "test_connection_string",
+            connection_timeout=AZURE_CONNECTION_TIMEOUT,
+            read_timeout=AZURE_READ_TIMEOUT,
+            retry_total=0,
         )
 
         # Verify default container is set correctly
@@ -104,7 +122,7 @@ class TestAzureBlobStorage(unittest.TestCase):
         # Verify correct blob name was generated and upload was called
         expected_blob_name = "test-uuid.jpg"
         mock_container_client.upload_blob.assert_called_once_with(
-            name=expected_blob_name, data=file_content, overwrite=True
+            name=expected_blob_name, data=file_content, overwrite=True, **TIMEOUTS
         )
 
         # Verify returned data is correct
@@ -158,11 +176,37 @@ class TestAzureBlobStorage(unittest.TestCase):
         result = storage.delete_blob("test-blob.jpg")
 
         # Verify delete_blob was called with correct name
-        mock_container_client.delete_blob.assert_called_once_with("test-blob.jpg")
+        mock_container_client.delete_blob.assert_called_once_with(
+            "test-blob.jpg", **TIMEOUTS
+        )
 
         # Verify result is True for successful deletion
         self.assertTrue(result)
 
+    @patch.dict(
+        os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
+    )
+    @patch("utils.blob_storage.BlobServiceClient")
+    def test_download_blob_success(self, mock_blob_service_client):
+        # Setup mocks
+        mock_service_client = MagicMock()
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+
+        mock_container_client = MagicMock()
+        mock_container_client.download_blob.return_value.readall.return_value = (
+            b"content"
+        )
+        mock_service_client.get_container_client.return_value = mock_container_client
+
+        storage = AzureBlobStorage()
+
+        self.assertEqual(storage.download_blob("test-blob.jpg"), b"content")
+        mock_container_client.download_blob.assert_called_once_with(
+            "test-blob.jpg", **TIMEOUTS
+        )
+
     @patch.dict(
         os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
     )
@@ -213,7 +257,9 @@ class TestAzureBlobStorage(unittest.TestCase):
         mock_container_client.get_blob_client.assert_called_once_with(blob_name)
 
         # Verify upload_blob was called with correct data and overwrite flag
-        mock_blob_client.upload_blob.assert_called_once_with(new_data, overwrite=True)
+        mock_blob_client.upload_blob.assert_called_once_with(
+            new_data, overwrite=True, **TIMEOUTS
+        )
 
         # Verify result is True for successful update
         self.assertTrue(result)
@@ -243,6 +289,93 @@ class TestAzureBlobStorage(unittest.TestCase):
         # Verify result is False when update fails
         self.assertFalse(result)
 
+    @patch.dict(
+        os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
+    )
+    @patch("utils.blob_storage.BlobServiceClient")
+    def test_upload_file_with_metadata(self, mock_blob_service_client):
+        mock_service_client = MagicMock()
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+        mock_container_client = MagicMock()
+        mock_service_client.get_container_client.return_value = mock_container_client
+
+        storage = AzureBlobStorage()
+        storage.upload_file(b"content", "test.jpg", metadata={"colour": "red"})
+
+        _, kwargs = mock_container_client.upload_blob.call_args
+        self.assertEqual(kwargs["metadata"], {"colour": "red"})
+
+    @patch.dict(
+        os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
+    )
+    @patch("utils.blob_storage.BlobServiceClient")
+    def test_set_blob_metadata_success(self, mock_blob_service_client):
+        mock_service_client = MagicMock()
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+        mock_blob_client = MagicMock()
+        mock_container_client = MagicMock()
+        mock_container_client.get_blob_client.return_value = mock_blob_client
+        mock_service_client.get_container_client.return_value = mock_container_client
+
+        storage = AzureBlobStorage()
+        result = storage.set_blob_metadata(
+            "test-blob.jpg", {"description": "café\nlook", "file_class": "runway"}
+        )
+
+        mock_container_client.get_blob_client.assert_called_once_with("test-blob.jpg")
+        mock_blob_client.set_blob_metadata.assert_called_once_with(
+            metadata={"description": "caf%C3%A9%0Alook", "file_class": "runway"},
+            **TIMEOUTS,
+        )
+        # The blob content must never be re-uploaded for a metadata change
+        mock_blob_client.upload_blob.assert_not_called()
+        self.assertTrue(result)
+
+    @patch.dict(
+        os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
+    )
+    @patch("utils.blob_storage.BlobServiceClient")
+    def test_set_blob_metadata_exception(self, mock_blob_service_client):
+        mock_service_client = MagicMock()
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+        mock_blob_client = MagicMock()
+        mock_blob_client.set_blob_metadata.side_effect = Exception("Failed")
+        mock_container_client = MagicMock()
+        mock_container_client.get_blob_client.return_value = mock_blob_client
+        mock_service_client.get_container_client.return_value = mock_container_client
+
+        storage = AzureBlobStorage()
+        self.assertFalse(storage.set_blob_metadata("test-blob.jpg", {"a": "b"}))
+
+    @patch.dict(
+        os.environ, {"AZURE_STORAGE_CONNECTION_STRING": "test_connection_string"}
+    )
+    @patch("utils.blob_storage.BlobServiceClient")
+    def test_set_blob_tags_success(self, mock_blob_service_client):
+        mock_service_client = MagicMock()
+        mock_blob_service_client.from_connection_string.return_value = (
+            mock_service_client
+        )
+        mock_blob_client = MagicMock()
+        mock_container_client = MagicMock()
+        mock_container_client.get_blob_client.return_value = mock_blob_client
+        mock_service_client.get_container_client.return_value = mock_container_client
+
+        storage = AzureBlobStorage()
+        result = storage.set_blob_tags("test-blob.jpg", {"class": "runway"})
+
+        mock_blob_client.set_blob_tags.assert_called_once_with(
+            {"class": "runway"}, **TIMEOUTS
+        )
+        mock_blob_client.upload_blob.assert_not_called()
+        self.assertTrue(result)
+
     @patch.dict(
         os.environ,
         {
@@ -257,3 +390,82 @@ class TestAzureBlobStorage(unittest.TestCase):
 
         # Verify custom default container is set correctly
         self.assertEqual(storage.default_container, "custom-default")
+
+
+class TestLocalBlobStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = LocalBlobStorage(
+            root_dir=self.tmp_dir.name, base_url="http://testserver/api/blobs"
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch("utils.blob_storage.uuid.uuid4")
+    def test_upload_file_success(self, mock_uuid):
+        mock_uuid.return_value = "test-uuid"
+
+        result = self.storage.upload_file(
+            b"test file content", "test_image.jpg", metadata={"colour": "red"}
+        )
+
+        self.assertEqual(result["blob_name"], "test-uuid.jpg")
+        self.assertEqual(
+            result["blob_url"], "http://testserver/api/blobs/user-uploads/test-uuid.jpg"
+        )
+        self.assertEqual(result["container"], "user-uploads")
+        self.assertEqual(result["size"], len(b"test file content"))
+
+        path = self.storage.get_blob_path("test-uuid.jpg")
+        self.assertEqual(path.read_bytes(), b"test file content")
+        sidecar = self.storage._metadata_path("test-uuid.jpg")
+        self.assertEqual(json.loads(sidecar.read_text())["metadata"], {"colour": "red"})
+
+    def test_update_and_delete_blob(self):
+        result = self.storage.upload_file(b"old", "test.png", "custom")
+        blob_name = result["blob_name"]
+
+        self.assertTrue(self.storage.update_blob(blob_name, b"new", "custom"))
+        path = self.storage.get_blob_path(blob_name, "custom")
+        self.assertEqual(path.read_bytes(), b"new")
+
+        self.assertTrue(self.storage.delete_blob(blob_name, "custom"))
+        self.assertFalse(path.exists())
+
+    def test_set_blob_metadata_and_tags(self):
+        blob_name = self.storage.upload_file(b"content", "test.png")["blob_name"]
+
+        self.assertTrue(self.storage.set_blob_metadata(blob_name, {"colour": "blue"}))
+        self.assertTrue(self.storage.set_blob_tags(blob_name, {"class": "runway"}))
+
+        sidecar = json.loads(self.storage._metadata_path(blob_name).read_text())
+        self.assertEqual(
+            sidecar, {"metadata": {"colour": "blue"}, "tags": {"class": "runway"}}
+        )
+
+    def test_download_blob(self):
+        blob_name = self.storage.upload_file(b"content", "test.png", "custom")[
+            "blob_name"
+        ]
+
+        self.assertEqual(self.storage.download_blob(blob_name, "custom"), b"content")
+        with self.assertRaises(FileNotFoundError):
+            self.storage.download_blob("missing.png")
+
+    def test_delete_missing_blob(self):
+        self.assertFalse(self.storage.delete_blob("missing.png"))
+
+    def test_get_blob_path_rejects_traversal(self):
+        self.assertIsNone(self.storage.get_blob_path("../secret.txt"))
+        self.assertIsNone(self.storage.get_blob_path("a.json", ".metadata"))
+
+    @patch.dict(os.environ, {"BLOB_STORAGE_BACKEND": "local"})
+    def test_create_blob_storage_local(self):
+        with patch.dict(os.environ, {"LOCAL_BLOB_ROOT": self.tmp_dir.name}):
+            self.assertIsInstance(create_blob_storage(), LocalBlobStorage)
+
+    @patch.dict(os.environ, {"BLOB_STORAGE_BACKEND": "ftp"})
+    def test_create_blob_storage_unknown(self):
+        with self.assertRaises(ValueError):
+            create_blob_storage()
@@ -0,0 +1,156 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from bson.objectid import ObjectId
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from utils.chat_context import SessionContext, TokenCounter, load_turns
+
+
+@pytest.fixture
+def tokenizer_path(tmp_path):
+    """A word-level tokenizer, so every word (and punctuation mark) is one token."""
+    tokenizer = Tokenizer(WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    path = tmp_path / "tokenizer.json"
+    tokenizer.save(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def context(tokenizer_path):
+    context = SessionContext("command-r-08-2024", budget=40, summary_tokens=10)
+    context.tokens = TokenCounter("command-r-08-2024", path=tokenizer_path)
+    return context
+
+
+def make_turn(index, words=4):
+    # turn_text adds 4 tokens ("User", ":", "Assistant", ":") to the prompt and response
+    return {
+        "_id": ObjectId(),
+        "session_id": "session_1",
+        "prompt": " ".join(["ask"] * words),
+        "response": f"answer {index}",
+        "timestamp": float(index),
+    }
+
+
+def test_token_counter_uses_tokenizer(tokenizer_path):
+    counter = TokenCounter("command-r-08-2024", path=tokenizer_path)
+
+    assert counter.count("wide leg linen trousers") == 4
+    assert counter.count("") == 0
+
+
+@patch("utils.chat_context.co.fetch_tokenizer")
+def test_token_counter_falls_back_to_estimate(mock_fetch):
+    mock_fetch.side_effect = Exception("offline")
+    counter = TokenCounter("command-r-08-2024")
+
+    assert counter.count("a" * 40) == 11
+    assert counter.count("a" * 40) == 11
+    mock_fetch.assert_called_once()
+
+
+@patch("utils.chat_context.conversation_log.buffered")
+@patch("utils.chat_context.get_user_collection")
+def test_load_turns_includes_buffered_turns(mock_get_collection, mock_buffered):
+    stored, pending = make_turn(1), make_turn(2)
+    other_session = {**make_turn(3), "session_id": "session_2"}
+    mock_get_collection.return_value.find.return_value.sort.return_value = [stored]
+    mock_buffered.return_value = [pending, other_session, stored]
+
+    turns = load_turns("user_1", "session_1", after=0.5)
+
+    assert turns == [stored, pending]
+    mock_get_collection.return_value.find.assert_called_once_with(
+        {"session_id": "session_1", "timestamp": {"$gt": 0.5}}
+    )
+
+
+@patch("utils.chat_context.load_turns")
+def test_build_messages_replays_turns_within_budget(mock_load_turns, context):
+    turns = [make_turn(1), make_turn(2)]
+    mock_load_turns.return_value = turns
+
+    messages = context.build_messages(
+        "user_1", "session_1", "Be helpful.", "And shoes?"
+    )
+
+    assert messages == [
+        {"role": "system", "content": "Be helpful."},
+        {"role": "user", "content": turns[0]["prompt"]},
+        {"role": "assistant", "content": "answer 1"},
+        {"role": "user", "content": turns[1]["prompt"]},
+        {"role": "assistant", "content": "answer 2"},
+        {"role": "user", "content": "And shoes?"},
+    ]
+
+
+@patch("utils.chat_context.co.chat")
+@patch("utils.chat_context.load_turns")
+def test_build_messages_rolls_old_turns_into_summary(
+    mock_load_turns, mock_chat, context
+):
+    # Five turns of 10 tokens overflow the budget of 40; the newest one fits the
+    # (40 - 10) / 2 tokens replayed after a summary
+    turns = [make_turn(i) for i in range(1, 6)]
+    mock_load_turns.return_value = turns
+    mock_chat.return_value.message.content = [MagicMock(text="Likes linen.")]
+
+    messages = context.build_messages("user_1", "session_1", "Be helpful.", "Next?")
+
+    assert messages[0]["content"] == (
+        "Be helpful.\n\nSummary of the earlier conversation:\nLikes linen."
+    )
+    assert [m["content"] for m in messages[1:]] == [
+        turns[-1]["prompt"],
+        "answer 5",
+        "Next?",
+    ]
+    summary_request = mock_chat.call_args[1]["messages"][1]["content"]
+    assert "answer 1" in summary_request and "answer 5" not in summary_request
+
+    # The summary is cached; later turns are loaded after the summarized ones
+    mock_load_turns.return_value = [turns[-1]]
+    context.build_messages("user_1", "session_1", "Be helpful.", "Next?")
+    mock_load_turns.assert_called_with("user_1", "session_1", 4.0)
+    assert mock_chat.call_count == 1
+    assert context.snapshot() == {
+        "summaries": 1,
+        "summary_failures": 0,
+        "cached_sessions": 1,
+    }
+
+
+@patch("utils.chat_context.co.chat")
+@patch("utils.chat_context.load_turns")
+def test_build_messages_folds_long_history_in_chunks(
+    mock_load_turns, mock_chat, context
+):
+    mock_load_turns.return_value = [make_turn(i) for i in range(1, 11)]
+    mock_chat.return_value.message.content = [MagicMock(text="Likes linen.")]
+
+    context.build_messages("user_1", "session_1", "Be helpful.", "Next?")
+
+    # Nine folded turns of 10 tokens in chunks of at most 40 tokens
+    assert mock_chat.call_count == 3
+    second_request = mock_chat.call_args_list[1][1]["messages"][1]["content"]
+    assert second_request.startswith("Summary so far:\nLikes linen.")
+
+
+@patch("utils.chat_context.co.chat")
+@patch("utils.chat_context.load_turns")
+def test_build_messages_summary_failure(mock_load_turns, mock_chat, context):
+    turns = [make_turn(i) for i in range(1, 6)]
+    mock_load_turns.return_value = turns
+    mock_chat.side_effect = Exception("Cohere unavailable")
+
+    messages = context.build_messages("user_1", "session_1", "Be helpful.", "Next?")
+
+    # The newest turns that fit the whole budget are still replayed
+    assert messages[0]["content"] == "Be helpful."
+    assert len(messages) == 2 + 2 * 4
+    assert context.snapshot()["summary_failures"] == 1
@@ -1,7 +1,10 @@
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 
+import pytest
 from flask import json
 
+from utils.semantic_cache import SemanticCache
+
 
 @patch("routes.chat_routes.co.chat")
 def test_generate_response_basic_chat(mock_chat, client):
@@ -92,6 +95,238 @@ def test_generate_response_error(mock_chat, client):
     assert "Test error" in data["error"]
 
 
+def stream_event(event_type, text=None):
+    event = MagicMock()
+    event.type = event_type
+    event.delta.message.content.text = text
+    return event
+
+
+def parse_sse(body):
+    """Split an SSE body into (event, payload) pairs."""
+    events = []
+    for message in body.decode("utf-8").strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((lines.get("event"), json.loads(lines["data"])))
+    return events
+
+
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat_stream")
+def test_generate_response_stream(mock_stream, mock_log, client):
+    """Test the streaming mode relays deltas and finalizes the conversation."""
+    mock_stream.return_value = iter(
+        [
+            stream_event("message-start"),
+            stream_event("content-delta", "Try "),
+            stream_event("content-delta", "linen."),
+            stream_event("message-end"),
+        ]
+    )
+
+    test_data = {"prompt": "Summer fabric?", "template": "basic_chat", "stream": True}
+    response = client.post(
+        "/api/generate", data=json.dumps(test_data), content_type="application/json"
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    events = parse_sse(response.data)
+    assert [event for event, _ in events] == ["start", "delta", "delta", "end"]
+    conversation_id = events[0][1]["conversation_id"]
+    assert events[0][1]["session_id"]
+    assert events[1][1] == {"text": "Try "}
+    assert events[-1][1]["response"] == "Try linen."
+
+    _, kwargs = mock_stream.call_args
+    assert kwargs["model"] == "command-r-08-2024"
+    assert kwargs["max_tokens"] == 300
+    # The turn is logged once, with its response, under the announced id
+    mock_log.assert_called_once_with(ANY, ANY)
+    logged = mock_log.call_args[0][1]
+    assert str(logged["_id"]) == conversation_id
+    assert logged["prompt"] == "Summer fabric?"
+    assert logged["response"] == "Try linen."
+    assert "incomplete" not in logged
+
+
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat_stream")
+def test_generate_response_stream_error(mock_stream, mock_log, client):
+    """Test a stream that breaks off keeps the partial response."""
+
+    def broken_stream(**kwargs):
+        yield stream_event("content-delta", "Try ")
+        raise Exception("Connection reset")
+
+    mock_stream.side_effect = broken_stream
+
+    test_data = {"prompt": "Summer fabric?", "stream": True}
+    response = client.post(
+        "/api/generate", data=json.dumps(test_data), content_type="application/json"
+    )
+
+    events = parse_sse(response.data)
+    assert [event for event, _ in events] == ["start", "delta", "error"]
+    assert events[-1][1] == {"error": "Connection reset"}
+    mock_log.assert_called_once()
+    logged = mock_log.call_args[0][1]
+    assert logged["response"] == "Try "
+    assert logged["incomplete"] is True
+
+
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+def test_generate_response_starts_session(mock_chat, mock_log, client):
+    """Test a prompt without session_id starts a session recorded on the turn."""
+    mock_chat.return_value.message.content = [MagicMock(text="Try linen.")]
+
+    data = client.post("/api/generate", json={"prompt": "Summer fabric?"}).get_json()
+
+    assert data["session_id"]
+    assert mock_log.call_args[0][1]["session_id"] == data["session_id"]
+    assert len(mock_chat.call_args[1]["messages"]) == 2
+
+
+@patch("routes.chat_routes.session_context.build_messages")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+def test_generate_response_continues_session(
+    mock_chat, mock_log, mock_build_messages, client
+):
+    """Test a follow-up prompt is sent with the session's context."""
+    mock_chat.return_value.message.content = [MagicMock(text="White sneakers.")]
+    context = [
+        {"role": "system", "content": "You are a helpful fashion assistant."},
+        {"role": "user", "content": "Summer fabric?"},
+        {"role": "assistant", "content": "Try linen."},
+        {"role": "user", "content": "And shoes?"},
+    ]
+    mock_build_messages.return_value = context
+
+    data = client.post(
+        "/api/generate", json={"prompt": "And shoes?", "session_id": "session_1"}
+    ).get_json()
+
+    assert data["session_id"] == "session_1"
+    mock_build_messages.assert_called_once_with(
+        ANY, "session_1", "You are a helpful fashion assistant.", "And shoes?"
+    )
+    assert mock_chat.call_args[1]["messages"] == context
+    assert mock_log.call_args[0][1]["session_id"] == "session_1"
+
+
+@pytest.fixture
+def enabled_semantic_cache():
+    cache = SemanticCache(enabled=True)
+    with patch("routes.chat_routes.semantic_cache", cache):
+        yield cache
+
+
+@patch("utils.embeddings.co.embed")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+def test_generate_response_semantic_cache_hit(
+    mock_chat, mock_log, mock_embed, client, enabled_semantic_cache
+):
+    """Test a near-identical prompt of the same template is answered from the cache."""
+    mock_chat.return_value.message.content = [MagicMock(text="Try linen.")]
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]]
+
+    first = client.post(
+        "/api/generate", json={"prompt": "What fabric for summer?"}
+    ).get_json()
+    mock_embed.return_value.embeddings.float = [[0.99, 0.05]]
+    second = client.post(
+        "/api/generate", json={"prompt": "Which fabric for summer?"}
+    ).get_json()
+
+    assert first["cached"] is False
+    assert second["cached"] is True
+    assert second["response"] == "Try linen."
+    mock_chat.assert_called_once()
+    # The conversation is still recorded for the cached answer
+    assert mock_log.call_count == 2
+    assert enabled_semantic_cache.snapshot()["hits"] == 1
+
+
+@patch("utils.embeddings.co.embed")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+@patch("routes.chat_routes.get_user_id")
+def test_generate_response_semantic_cache_per_user(
+    mock_get_user_id, mock_chat, mock_log, mock_embed, client, enabled_semantic_cache
+):
+    """Test a response cached for one user is never served to another."""
+    mock_chat.return_value.message.content = [MagicMock(text="Try linen.")]
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]]
+
+    mock_get_user_id.return_value = "alice"
+    client.post("/api/generate", json={"prompt": "What fabric for summer?"})
+    mock_get_user_id.return_value = "bob"
+    response = client.post("/api/generate", json={"prompt": "What fabric for summer?"})
+
+    assert response.get_json()["cached"] is False
+    assert mock_chat.call_count == 2
+
+
+@patch("utils.embeddings.co.embed")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+def test_generate_response_semantic_cache_per_template(
+    mock_chat, mock_log, mock_embed, client, enabled_semantic_cache
+):
+    """Test templates without semantic_cache never use the cache."""
+    mock_chat.return_value.message.content = [MagicMock(text="Use pytest.")]
+
+    for _ in range(2):
+        response = client.post(
+            "/api/generate",
+            json={"prompt": "How do I test?", "template": "expert_mode"},
+        )
+        assert response.get_json()["cached"] is False
+
+    assert mock_chat.call_count == 2
+    mock_embed.assert_not_called()
+
+
+@patch("utils.embeddings.co.embed")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat")
+def test_generate_response_semantic_cache_embed_failure(
+    mock_chat, mock_log, mock_embed, client, enabled_semantic_cache
+):
+    """Test the request still succeeds when the prompt cannot be embedded."""
+    mock_chat.return_value.message.content = [MagicMock(text="Try linen.")]
+    mock_embed.side_effect = Exception("Embed unavailable")
+
+    response = client.post("/api/generate", json={"prompt": "Summer fabric?"})
+
+    assert response.status_code == 200
+    assert response.get_json()["response"] == "Try linen."
+
+
+@patch("utils.embeddings.co.embed")
+@patch("routes.chat_routes.conversation_log.log")
+@patch("routes.chat_routes.co.chat_stream")
+def test_generate_response_stream_semantic_cache_hit(
+    mock_stream, mock_log, mock_embed, client, enabled_semantic_cache
+):
+    """Test a cached response is streamed as one delta."""
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]]
+    enabled_semantic_cache.store("123:basic_chat", [1.0, 0.0], "Try linen.")
+
+    response = client.post(
+        "/api/generate", json={"prompt": "Summer fabric?", "stream": True}
+    )
+
+    events = parse_sse(response.data)
+    assert [event for event, _ in events] == ["start", "delta", "end"]
+    assert events[-1][1]["response"] == "Try linen."
+    mock_stream.assert_not_called()
+
+
 @patch("routes.chat_routes.find_documents")
 @patch("routes.chat_routes.get_user_id")
 def test_get_history_success(mock_get_user_id, mock_find_documents, client):
@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pytest
+
+from utils.class_centroids import (
+    CENTROID_REBUILD_INTERVAL,
+    META_ID,
+    _rebuild_job,
+    class_centroids,
+    class_similarities,
+    clear_centroid_cache,
+    rebuild_centroids,
+    update_centroids,
+)
+
+
+@pytest.fixture
+def collections():
+    """Separate mocks for the files and centroids collections, and the job queue."""
+    mocks = {"files": MagicMock(), "centroids": MagicMock()}
+    with (
+        patch(
+            "utils.class_centroids.get_user_collection",
+            side_effect=lambda user_id, collection_type: mocks[collection_type],
+        ),
+        patch("utils.class_centroids.job_queue") as mock_job_queue,
+        patch("utils.class_centroids._rebuilding", set()),
+    ):
+        yield {**mocks, "jobs": mock_job_queue}
+
+
+def stored_centroid(field, file_class, total, count):
+    return {
+        "_id": f"{field}:{file_class}",
+        "field": field,
+        "class": file_class,
+        "count": count,
+        "sum": {str(i): value for i, value in enumerate(total)},
+    }
+
+
+def test_update_centroids_increments_sums(collections):
+    update_centroids(
+        "user_1",
+        added=[
+            {"class": "fabric", "embedding": [1.0, 0.0]},
+            {"class": "fabric", "embedding": [0.5, 0.5], "embedding_v4": [1.0]},
+            {"class": "", "embedding": [9.0, 9.0]},
+        ],
+    )
+
+    calls = {
+        c.args[0]["_id"]: c.args[1]
+        for c in collections["centroids"].update_one.call_args_list
+    }
+    assert calls["embedding:fabric"]["$inc"] == {
+        "count": 2,
+        "sum.0": 1.5,
+        "sum.1": 0.5,
+    }
+    assert calls["embedding_v4:fabric"]["$inc"] == {"count": 1, "sum.0": 1.0}
+    assert len(calls) == 2
+
+
+def test_update_centroids_moves_reclassified_file(collections):
+    old = {"class": "fabric", "embedding": [1.0, 0.0]}
+    new = {"class": "texture", "embedding": [1.0, 0.0]}
+
+    update_centroids("user_1", added=[new], removed=[old])
+
+    calls = {
+        c.args[0]["_id"]: c.args[1]["$inc"]
+        for c in collections["centroids"].update_one.call_args_list
+    }
+    assert calls == {
+        "embedding:texture": {"count": 1, "sum.0": 1.0, "sum.1": 0.0},
+        "embedding:fabric": {"count": -1, "sum.0": -1.0, "sum.1": -0.0},
+    }
+
+
+def test_update_centroids_skips_unchanged_file(collections):
+    document = {"class": "fabric", "embedding": [1.0, 0.0]}
+
+    update_centroids("user_1", added=[document], removed=[dict(document)])
+
+    collections["centroids"].update_one.assert_not_called()
+
+
+def test_update_centroids_failure_is_logged(collections):
+    collections["centroids"].update_one.side_effect = Exception("Mongo down")
+
+    # Must not raise: a stale centroid only makes pruning less precise
+    update_centroids("user_1", added=[{"class": "fabric", "embedding": [1.0]}])
+
+
+def test_rebuild_centroids_sums_library(collections):
+    collections["files"].find.return_value = [
+        {"class": "garment", "embedding": [1.0, 1.0]},
+        {"class": "garment", "embedding": [3.0, 1.0]},
+    ]
+
+    sums = rebuild_centroids("user_1")
+
+    total, count = sums[("embedding", "garment")]
+    assert count == 2 and list(total) == [4.0, 2.0]
+    replacement = stored_centroid("embedding", "garment", [4.0, 2.0], 2)
+    del replacement["_id"]
+    collections["centroids"].replace_one.assert_called_once_with(
+        {"_id": "embedding:garment"}, replacement, upsert=True
+    )
+    collections["centroids"].delete_many.assert_called_once_with(
+        {"_id": {"$nin": [META_ID, "embedding:garment"]}}
+    )
+
+
+def test_class_centroids_reads_stored_sums(collections):
+    collections["centroids"].find.return_value = [
+        {"_id": META_ID, "built_at": datetime.utcnow()},
+        stored_centroid("embedding", "garment", [3.0, 4.0], 2),
+        stored_centroid("embedding", "fabric", [1.0, 0.0], 0),
+        stored_centroid("embedding_v4", "garment", [1.0], 1),
+    ]
+
+    centroids = class_centroids("user_1", "embedding")
+
+    # Classes whose files were all deleted count as empty
+    assert list(centroids) == ["garment"]
+    assert centroids["garment"]["count"] == 2
+    assert np.allclose(centroids["garment"]["vector"], [0.6, 0.8])
+
+    # Cached until the TTL passes or the user's centroids change
+    class_centroids("user_1", "embedding")
+    collections["centroids"].find.assert_called_once()
+    update_centroids("user_1", added=[{"class": "garment", "embedding": [1.0, 0]}])
+    class_centroids("user_1", "embedding")
+    assert collections["centroids"].find.call_count == 2
+    collections["jobs"].enqueue.assert_not_called()
+
+
+def test_class_centroids_rebuilds_without_marker_in_background(collections):
+    collections["centroids"].find.return_value = []
+    collections["files"].find.return_value = [{"class": "runway", "embedding": [2.0]}]
+
+    # The library is searched without pruning until the rebuild job has run
+    assert class_centroids("user_1", "embedding") is None
+    collections["files"].find.assert_not_called()
+    # Only one rebuild is queued while it is pending
+    clear_centroid_cache()
+    class_centroids("user_1", "embedding")
+    collections["jobs"].enqueue.assert_called_once()
+
+    assert collections["jobs"].enqueue.call_args.args == ("user_1", "rebuild_centroids")
+    assert _rebuild_job("user_1") == {"centroids": 1}
+    assert collections["centroids"].update_one.call_args.args[0] == {"_id": META_ID}
+    # A finished rebuild lets the next one be queued
+    class_centroids("user_1", "embedding")
+    assert collections["jobs"].enqueue.call_count == 2
+
+
+def test_class_centroids_rebuilds_stale_centroids(collections):
+    built_at = datetime.utcnow() - timedelta(seconds=CENTROID_REBUILD_INTERVAL + 1)
+    collections["centroids"].find.return_value = [
+        {"_id": META_ID, "built_at": built_at},
+        stored_centroid("embedding", "garment", [1.0, 0.0], 1),
+    ]
+
+    centroids = class_centroids("user_1", "embedding")
+
+    # Stale centroids are still used while they are rebuilt
+    assert list(centroids) == ["garment"]
+    collections["jobs"].enqueue.assert_called_once()
+
+
+def test_class_centroids_unavailable(collections):
+    collections["centroids"].find.side_effect = Exception("Mongo down")
+
+    assert class_centroids("user_1", "embedding") is None
+
+
+def test_class_similarities():
+    centroids = {
+        "fabric": {"vector": np.array([1.0, 0.0]), "count": 3},
+        "runway": {"vector": np.array([0.0, 1.0]), "count": 1},
+    }
+
+    similarities = class_similarities(centroids, [2.0, 0.0])
+
+    assert similarities == pytest.approx({"fabric": 1.0, "runway": 0.0})
+    assert class_similarities({}, [1.0]) == {}
@@ -0,0 +1,115 @@
+from unittest.mock import MagicMock, patch
+import httpx
+import pytest
+from cohere.errors import BadRequestError, ServiceUnavailableError, TooManyRequestsError
+
+from utils.cohere_client import (
+    ConnectionMetrics,
+    ResilientClient,
+    co,
+    cohere_dependency,
+    cohere_metrics,
+    is_retryable_cohere_error,
+)
+from utils.model_scheduler import ModelQueueTimeout
+from utils.resilience import Dependency
+
+
+def test_metrics_count_reused_connections():
+    metrics = ConnectionMetrics()
+    for _ in range(3):
+        metrics.on_request(httpx.Request("POST", "https://api.cohere.com/v2/chat"))
+    # Only the first request opened a connection and negotiated TLS
+    metrics.trace("connection.connect_tcp.complete", {})
+    metrics.trace("connection.start_tls.complete", {})
+    metrics.trace("http11.send_request_headers.complete", {})
+
+    assert metrics.snapshot() == {
+        "requests": 3,
+        "new_connections": 1,
+        "tls_handshakes": 1,
+        "reused_connections": 2,
+        "reuse_ratio": 0.667,
+    }
+
+
+def test_metrics_attach_trace_to_requests():
+    metrics = ConnectionMetrics()
+    request = httpx.Request("POST", "https://api.cohere.com/v2/embed")
+
+    metrics.on_request(request)
+
+    assert request.extensions["trace"] == metrics.trace
+
+
+def test_shared_client_records_requests():
+    cohere_metrics.reset()
+    httpx_client = co._client_wrapper.httpx_client.httpx_client
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json={}))
+
+    with patch.object(httpx_client, "_transport", transport):
+        httpx_client.get("https://api.cohere.com/v1/check-api-key")
+        httpx_client.get("https://api.cohere.com/v1/check-api-key")
+
+    assert cohere_metrics.snapshot()["requests"] == 2
+
+
+def test_retryable_cohere_errors():
+    assert is_retryable_cohere_error(TooManyRequestsError(body=None))
+    assert is_retryable_cohere_error(httpx.ReadTimeout("timed out"))
+    assert not is_retryable_cohere_error(BadRequestError(body=None))
+
+
+def test_queue_timeout_does_not_count_as_cohere_success():
+    assert ModelQueueTimeout in cohere_dependency.local_errors
+
+
+def make_resilient_client(client):
+    dependency = Dependency("cohere", is_retryable_cohere_error, base_delay=0.001)
+    return ResilientClient(client, dependency), dependency
+
+
+def test_resilient_client_retries_chat():
+    client = MagicMock()
+    client.chat.side_effect = [ServiceUnavailableError(body=None), "response"]
+    resilient, dependency = make_resilient_client(client)
+
+    assert resilient.chat(model="command-r-08-2024") == "response"
+    assert client.chat.call_count == 2
+    assert dependency.snapshot()["retries"] == 1
+
+
+def test_resilient_client_retries_opening_stream():
+    client = MagicMock()
+
+    def stream(**kwargs):
+        if client.chat_stream.call_count == 1:
+            raise ServiceUnavailableError(body=None)
+        yield "first"
+        yield "second"
+
+    client.chat_stream.side_effect = stream
+    resilient, _ = make_resilient_client(client)
+
+    assert list(resilient.chat_stream(model="command-r-08-2024")) == [
+        "first",
+        "second",
+    ]
+    assert client.chat_stream.call_count == 2
+
+
+def test_resilient_client_does_not_retry_broken_stream():
+    client = MagicMock()
+
+    def stream(**kwargs):
+        yield "first"
+        raise ServiceUnavailableError(body=None)
+
+    client.chat_stream.side_effect = stream
+    resilient, _ = make_resilient_client(client)
+
+    events = resilient.chat_stream(model="command-r-08-2024")
+    assert next(events) == "first"
+    with pytest.raises(ServiceUnavailableError):
+        next(events)
+    client.chat_stream.assert_called_once()
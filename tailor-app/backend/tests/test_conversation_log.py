@@ -0,0 +1,130 @@
+import time
+from unittest.mock import MagicMock, patch
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from utils.conversation_log import ConversationLogWriter
+
+
+def make_writer(**kwargs):
+    # A long interval keeps the background thread from flushing during a test
+    return ConversationLogWriter(flush_interval=60, **kwargs)
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_flush_groups_turns_per_user(mock_get_collection):
+    collections = {"alice": MagicMock(), "bob": MagicMock()}
+    mock_get_collection.side_effect = lambda user_id, name: collections[user_id]
+    writer = make_writer()
+
+    first = writer.log("alice", {"prompt": "a", "response": "1"})
+    writer.log("bob", {"prompt": "b", "response": "2"})
+    writer.log("alice", {"prompt": "c", "response": "3"})
+    mock_get_collection.assert_not_called()
+
+    writer.flush()
+
+    documents = collections["alice"].insert_many.call_args[0][0]
+    assert [d["prompt"] for d in documents] == ["a", "c"]
+    assert str(documents[0]["_id"]) == first
+    collections["bob"].insert_many.assert_called_once()
+    assert writer.snapshot() == {
+        "logged": 3,
+        "written": 3,
+        "failed_flushes": 0,
+        "dropped": 0,
+        "buffered": 0,
+    }
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_log_keeps_assigned_id(mock_get_collection):
+    writer = make_writer()
+    doc_id = ObjectId()
+
+    assert writer.log("alice", {"_id": doc_id, "prompt": "a"}) == str(doc_id)
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_full_batch_wakes_the_writer(mock_get_collection):
+    writer = ConversationLogWriter(flush_interval=60, max_batch_size=2)
+    collection = mock_get_collection.return_value
+
+    writer.log("alice", {"prompt": "a"})
+    writer.log("alice", {"prompt": "b"})
+    deadline = time.monotonic() + 2
+    while writer.snapshot()["written"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert collection.insert_many.call_count == 1
+    assert writer.snapshot()["written"] == 2
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_failed_flush_requeues_turns(mock_get_collection):
+    collection = mock_get_collection.return_value
+    collection.insert_many.side_effect = [Exception("Mongo down"), None]
+    writer = make_writer()
+    writer.log("alice", {"prompt": "a"})
+
+    writer.flush()
+    assert writer.snapshot()["buffered"] == 1
+    assert writer.snapshot()["failed_flushes"] == 1
+
+    writer.flush()
+    assert writer.snapshot()["buffered"] == 0
+    assert writer.snapshot()["written"] == 1
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_duplicate_keys_count_as_written(mock_get_collection):
+    collection = mock_get_collection.return_value
+    collection.insert_many.side_effect = BulkWriteError(
+        {"writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]}
+    )
+    writer = make_writer()
+    writer.log("alice", {"prompt": "a"})
+    writer.log("alice", {"prompt": "b"})
+
+    writer.flush()
+
+    assert writer.snapshot()["written"] == 2
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_bulk_write_errors_drop_rejected_turns(mock_get_collection):
+    collection = mock_get_collection.return_value
+    collection.insert_many.side_effect = BulkWriteError(
+        {
+            "writeErrors": [
+                {"index": 0, "code": 11000, "errmsg": "duplicate key"},
+                {"index": 2, "code": 121, "errmsg": "validation failed"},
+            ]
+        }
+    )
+    writer = make_writer()
+    for prompt in ("a", "b", "c"):
+        writer.log("alice", {"prompt": prompt})
+
+    writer.flush()
+
+    snapshot = writer.snapshot()
+    assert snapshot["written"] == 2
+    assert snapshot["failed_flushes"] == 1
+    assert snapshot["dropped"] == 1
+    # A rejected turn would be rejected again, so it is not requeued
+    assert writer.buffered("alice") == []
+
+
+@patch("utils.conversation_log.get_user_collection")
+def test_full_buffer_writes_synchronously(mock_get_collection):
+    collection = mock_get_collection.return_value
+    writer = make_writer(max_buffered=1)
+
+    writer.log("alice", {"prompt": "a"})
+    writer.log("alice", {"prompt": "b"})
+
+    documents = collection.insert_many.call_args[0][0]
+    assert [d["prompt"] for d in documents] == ["b"]
+    assert writer.snapshot()["buffered"] == 1
@@ -0,0 +1,84 @@
+from unittest.mock import MagicMock, patch
+import pytest
+
+from utils.embedding_models import EMBEDDING_VERSIONS
+from utils.embeddings import document_hash
+from utils.embedding_versions import (
+    active_embedding_version,
+    embedding_fields,
+    get_embedding_state,
+    set_embedding_state,
+)
+
+
+@patch("utils.embedding_versions.find_documents")
+def test_state_defaults_to_default_version(mock_find):
+    mock_find.return_value = []
+
+    assert get_embedding_state("user_1") == {"active": "v3", "target": None}
+    assert active_embedding_version("user_1") == EMBEDDING_VERSIONS["v3"]
+
+
+@patch("utils.embedding_versions.find_documents")
+def test_state_is_cached(mock_find):
+    mock_find.return_value = [{"name": "embedding", "active": "v4", "target": None}]
+
+    get_embedding_state("user_1")
+    assert active_embedding_version("user_1")["field"] == "embedding_v4"
+
+    mock_find.assert_called_once()
+
+
+@patch("utils.embedding_versions.get_user_collection")
+@patch("utils.embedding_versions.find_documents")
+def test_set_state_invalidates_cache(mock_find, mock_collection):
+    mock_find.return_value = []
+    get_embedding_state("user_1")
+
+    set_embedding_state("user_1", "v3", "v4")
+    mock_find.return_value = [{"name": "embedding", "active": "v3", "target": "v4"}]
+
+    assert get_embedding_state("user_1")["target"] == "v4"
+    update = mock_collection.return_value.update_one.call_args
+    assert update[0][1]["$set"]["target"] == "v4"
+    assert update[1]["upsert"] is True
+
+
+def test_set_state_rejects_unknown_version():
+    with pytest.raises(ValueError, match="v9"):
+        set_embedding_state("user_1", "v9")
+
+
+@patch("utils.embeddings.co.embed")
+@patch("utils.embedding_versions.find_documents")
+def test_embedding_fields_active_version_only(mock_find, mock_embed):
+    mock_find.return_value = []
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2]]
+    file_doc = {"description": "Blue silk", "class": "fabric", "colour": "blue"}
+
+    fields = embedding_fields("user_1", [file_doc])
+
+    assert fields == [
+        {"embedding": [0.1, 0.2], "embedding_hash": document_hash(file_doc)}
+    ]
+    assert mock_embed.call_args[1]["model"] == "embed-english-v3.0"
+
+
+@patch("utils.embeddings.co.embed")
+@patch("utils.embedding_versions.find_documents")
+def test_embedding_fields_dual_write_during_migration(mock_find, mock_embed):
+    mock_find.return_value = [{"name": "embedding", "active": "v3", "target": "v4"}]
+
+    def fake_embed(texts, model, **kwargs):
+        response = MagicMock()
+        response.embeddings.float = [[len(model)] for _ in texts]
+        return response
+
+    mock_embed.side_effect = fake_embed
+    file_doc = {"description": "Blue silk", "class": "fabric", "colour": "blue"}
+
+    fields = embedding_fields("user_1", [file_doc])[0]
+
+    assert fields["embedding"] == [len("embed-english-v3.0")]
+    assert fields["embedding_v4"] == [len("embed-v4.0")]
+    assert fields["embedding_hash"] == document_hash(file_doc)
@@ -0,0 +1,234 @@
+import concurrent.futures
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import pytest
+
+from utils.embeddings import (
+    EMBED_MODEL,
+    EmbeddingBatcher,
+    EmbeddingCache,
+    compose_document_text,
+    document_hash,
+    embed_file_documents,
+    embed_texts,
+    text_hash,
+)
+from utils.resilience import DeadlineExceeded, deadline_budget, time_remaining
+
+
+def make_client():
+    client = MagicMock()
+    client.embed.side_effect = lambda texts, **kwargs: MagicMock(
+        embeddings=MagicMock(float=[[float(len(t))] for t in texts])
+    )
+    return client
+
+
+def test_compose_document_text_all_fields():
+    text = compose_document_text("Flowing silk dress", "garment", "red, gold")
+    assert text == "Flowing silk dress Category: garment. Colours: red, gold."
+
+
+def test_compose_document_text_skips_empty_fields():
+    assert compose_document_text("Linen swatch", "", "") == "Linen swatch"
+    assert compose_document_text("", "texture", "") == "Category: texture."
+
+
+def test_batcher_coalesces_concurrent_callers():
+    client = make_client()
+    batcher = EmbeddingBatcher(client, max_wait_ms=200)
+
+    # Submit from several threads before the flush window closes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(
+            pool.map(lambda i: batcher.embed(["x" * i], "search_query"), range(1, 9))
+        )
+
+    assert results == [[[float(i)]] for i in range(1, 9)]
+    client.embed.assert_called_once()
+    _, kwargs = client.embed.call_args
+    assert sorted(kwargs["texts"], key=len) == ["x" * i for i in range(1, 9)]
+    assert kwargs["model"] == EMBED_MODEL
+    assert kwargs["input_type"] == "search_query"
+    assert batcher.stats == {"texts": 8, "requests": 1}
+
+
+def test_batcher_flushes_full_batch_immediately():
+    client = make_client()
+    batcher = EmbeddingBatcher(client, max_batch_size=2, max_wait_ms=60_000)
+
+    futures = batcher.submit(["a", "bb", "ccc", "dddd"])
+
+    # Both full batches are sent without waiting for the (very long) flush window
+    vectors = [future.result(timeout=5) for future in futures]
+    assert vectors == [[1.0], [2.0], [3.0], [4.0]]
+    assert client.embed.call_count == 2
+
+
+def test_batcher_groups_by_input_type():
+    client = make_client()
+    batcher = EmbeddingBatcher(client, max_wait_ms=50)
+
+    documents = batcher.submit(["doc"], "search_document")
+    queries = batcher.submit(["query"], "search_query")
+    documents[0].result(timeout=5)
+    queries[0].result(timeout=5)
+
+    input_types = {call[1]["input_type"] for call in client.embed.call_args_list}
+    assert input_types == {"search_document", "search_query"}
+    assert client.embed.call_count == 2
+
+
+def test_batcher_propagates_errors_to_every_caller():
+    client = MagicMock()
+    client.embed.side_effect = Exception("Cohere API error")
+    batcher = EmbeddingBatcher(client, max_wait_ms=50)
+
+    futures = batcher.submit(["a", "b"])
+
+    for future in futures:
+        with pytest.raises(Exception, match="Cohere API error"):
+            future.result(timeout=5)
+
+
+def test_batcher_short_response_fails_missing_callers():
+    client = MagicMock()
+    client.embed.return_value.embeddings.float = [[0.1]]
+    batcher = EmbeddingBatcher(client, max_wait_ms=1)
+
+    first, second = batcher.submit(["a", "b"])
+
+    assert first.result(timeout=5) == [0.1]
+    with pytest.raises(ValueError):
+        second.result(timeout=5)
+
+
+def test_batcher_sends_batch_under_callers_deadline():
+    client = make_client()
+    remaining = []
+    client.embed.side_effect = lambda texts, **kwargs: (
+        remaining.append(time_remaining())
+        or MagicMock(embeddings=MagicMock(float=[[1.0] for _ in texts]))
+    )
+    batcher = EmbeddingBatcher(client, max_wait_ms=1)
+
+    with deadline_budget(2):
+        assert batcher.embed(["a"]) == [[1.0]]
+
+    # The flush thread has no deadline of its own
+    assert remaining[0] is not None and remaining[0] <= 2
+
+
+def test_batcher_caller_stops_waiting_at_deadline():
+    release = threading.Event()
+    client = make_client()
+    client.embed.side_effect = lambda **kwargs: release.wait(5)
+    batcher = EmbeddingBatcher(client, max_wait_ms=1)
+
+    try:
+        with deadline_budget(0.05):
+            with pytest.raises(DeadlineExceeded):
+                batcher.embed(["a"])
+    finally:
+        release.set()
+
+
+def test_batcher_drops_texts_past_their_deadline():
+    client = make_client()
+    batcher = EmbeddingBatcher(client, max_wait_ms=50)
+
+    with deadline_budget(0):
+        expired = batcher.submit(["a"])
+    live = batcher.submit(["bb"])
+
+    assert live[0].result(timeout=5) == [2.0]
+    with pytest.raises(DeadlineExceeded):
+        expired[0].result(timeout=5)
+    assert client.embed.call_args[1]["texts"] == ["bb"]
+
+
+def test_batcher_runs_shared_batch_under_longest_deadline():
+    client = make_client()
+    remaining = []
+
+    def embed(texts, **kwargs):
+        remaining.append(time_remaining())
+        time.sleep(0.3)
+        return MagicMock(embeddings=MagicMock(float=[[1.0] for _ in texts]))
+
+    client.embed.side_effect = embed
+    batcher = EmbeddingBatcher(client, max_wait_ms=50)
+
+    with deadline_budget(0.2):
+        short = batcher.submit(["a"])
+    with deadline_budget(10):
+        assert batcher.embed(["b"]) == [[1.0]]
+
+    # A caller with a short budget does not cut the batch short for the others
+    assert client.embed.call_count == 1
+    assert remaining[0] > 5
+    assert short[0].result(timeout=5) == [1.0]
+
+
+@patch("utils.embeddings.co.embed")
+def test_embed_file_documents_one_vector_per_file(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1], [0.2]]
+    files = [
+        {"description": "Wool coat", "class": "garment", "colour": "grey"},
+        {"description": "Beach at dusk"},
+    ]
+
+    vectors = embed_file_documents(files)
+
+    assert vectors == [[0.1], [0.2]]
+    mock_embed.assert_called_once()
+    assert mock_embed.call_args[1]["texts"] == [
+        "Wool coat Category: garment. Colours: grey.",
+        "Beach at dusk",
+    ]
+
+
+@patch("utils.embeddings.co.embed")
+def test_embed_texts_uses_input_type(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.5, 0.5]]
+
+    assert embed_texts(["red dress"], input_type="search_query") == [[0.5, 0.5]]
+    assert mock_embed.call_args[1]["input_type"] == "search_query"
+
+
+def test_text_hash_depends_on_input_type():
+    assert text_hash("red dress") == text_hash("red dress")
+    assert text_hash("red dress") != text_hash("red dress", "search_query")
+
+
+def test_document_hash_changes_with_embedded_fields():
+    doc = {"description": "Wool coat", "class": "garment", "colour": "grey"}
+    assert document_hash(doc) == document_hash({**doc, "filename": "other.jpg"})
+    assert document_hash(doc) != document_hash({**doc, "colour": "black"})
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(max_size=2)
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    cache.get("a")
+    cache.put("c", [3.0])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == [1.0]
+    assert cache.get("c") == [3.0]
+    assert cache.stats == {"hits": 3, "misses": 1}
+
+
+@patch("utils.embeddings.co.embed")
+def test_embed_texts_only_embeds_uncached_texts(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1]]
+    embed_texts(["red dress"])
+
+    mock_embed.return_value.embeddings.float = [[0.2]]
+    vectors = embed_texts(["red dress", "blue coat"])
+
+    assert vectors == [[0.1], [0.2]]
+    assert mock_embed.call_count == 2
+    assert mock_embed.call_args[1]["texts"] == ["blue coat"]
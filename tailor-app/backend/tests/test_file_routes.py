@@ -1,7 +1,13 @@
+import json
 from io import BytesIO
 from unittest.mock import patch, MagicMock
 from datetime import datetime
 from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from utils.cohere_client import EMBED_TIMEOUT
+from utils.embedding_models import EMBEDDING_VERSIONS
+from utils.embeddings import document_hash
+from routes.file_routes import ingest_file
 
 
 def create_test_file(filename="test.jpg", content=b"Test content"):
@@ -65,7 +71,7 @@ def test_analyze_file_exception(mock_chat, client):
 
 
 @patch("routes.file_routes.blob_storage.upload_file")
-@patch("routes.file_routes.cohere.ClientV2.embed")
+@patch("utils.embeddings.co.embed")
 @patch("routes.file_routes.insert_document")
 def test_upload_file_success(
     mock_insert_document, mock_embed, mock_upload_file, client
@@ -101,6 +107,13 @@ def test_upload_file_success(
     assert response_json["file_data"]["class"] == "art and film"
     assert response_json["file_data"]["colour"] == "blue"
 
+    _, kwargs = mock_embed.call_args
+    assert kwargs["texts"] == [
+        "Test file description Category: art and film. Colours: blue."
+    ]
+    stored_document = mock_insert_document.call_args[0][2]
+    assert stored_document["embedding"] == [0.1, 0.2, 0.3]
+
 
 def test_upload_file_no_file(client):
     response = client.post("/api/files/upload", data={})
@@ -167,9 +180,11 @@ def test_upload_file_invalid_class(mock_insert_document, mock_upload_file, clien
 
 
 @patch("routes.file_routes.blob_storage.upload_file")
+@patch("utils.embeddings.co.embed")
 @patch("routes.file_routes.logger")
-def test_upload_file_exception(mock_logger, mock_upload_file, client):
+def test_upload_file_exception(mock_logger, mock_embed, mock_upload_file, client):
     mock_upload_file.side_effect = Exception("Storage service unavailable")
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
 
     file, filename = create_test_file()
     data = {
@@ -194,6 +209,358 @@ def test_upload_file_exception(mock_logger, mock_upload_file, client):
     assert mock_logger.error.call_args[1]["exc_info"] is True
 
 
+@patch("routes.file_routes.blob_storage.upload_file")
+@patch("routes.file_routes.blob_storage.delete_blob")
+@patch("utils.embeddings.co.embed")
+@patch("routes.file_routes.insert_document")
+def test_upload_file_embed_failure_deletes_blob(
+    mock_insert_document, mock_embed, mock_delete_blob, mock_upload_file, client
+):
+    mock_upload_file.return_value = {
+        "blob_name": "test_blob",
+        "blob_url": "http://example.com/test_blob",
+        "size": 1234,
+        "container": "test_container",
+    }
+    mock_embed.side_effect = Exception("Cohere API error")
+
+    file, filename = create_test_file()
+    data = {
+        "file": (file, filename),
+        "description": "Test file description",
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 500
+    assert "Cohere API error" in response.get_json()["error"]
+    mock_insert_document.assert_not_called()
+    mock_delete_blob.assert_called_once_with("test_blob", "test_container")
+
+
+@patch("routes.file_routes.blob_storage.upload_file")
+@patch("routes.file_routes.insert_document")
+@patch("routes.file_routes.job_queue.enqueue")
+@patch("utils.embeddings.co.embed")
+def test_upload_file_background(
+    mock_embed, mock_enqueue, mock_insert_document, mock_upload_file, client
+):
+    mock_upload_file.return_value = {
+        "blob_name": "test_blob",
+        "blob_url": "http://example.com/test_blob",
+        "size": 1234,
+        "container": "test_container",
+    }
+    mock_insert_document.return_value = "document_id_123"
+    mock_enqueue.return_value = "job_id_456"
+
+    file, filename = create_test_file()
+    data = {"file": (file, filename), "user_id": "user_123", "background": "true"}
+
+    response = client.post(
+        "/api/files/upload", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 202
+    file_data = response.get_json()["file_data"]
+    assert file_data["document_id"] == "document_id_123"
+    assert file_data["job_id"] == "job_id_456"
+    assert file_data["status"] == "pending"
+
+    # Nothing is embedded on the request path
+    mock_embed.assert_not_called()
+    stored_document = mock_insert_document.call_args[0][2]
+    assert stored_document["status"] == "pending"
+    assert "embedding" not in stored_document
+    args, kwargs = mock_enqueue.call_args
+    assert args[:2] == ("user_123", "ingest_file")
+    assert kwargs["details"] == {"file_id": "document_id_123"}
+
+
+@patch("routes.file_routes.find_documents")
+@patch("routes.file_routes.update_document")
+@patch("routes.file_routes.blob_storage.download_blob")
+@patch("routes.file_routes.blob_storage.set_blob_metadata")
+@patch("routes.file_routes.co.chat")
+@patch("utils.embeddings.co.embed")
+def test_ingest_file_fills_missing_metadata(
+    mock_embed,
+    mock_chat,
+    mock_set_metadata,
+    mock_download_blob,
+    mock_update_document,
+    mock_find,
+    client,
+):
+    file_id = "507f1f77bcf86cd799439011"
+    mock_find.return_value = [
+        {
+            "_id": ObjectId(file_id),
+            "blob_name": "blob123",
+            "container": "container1",
+            "description": "My own words",
+            "class": "",
+            "colour": "",
+            "status": "pending",
+        }
+    ]
+    mock_chat.return_value.message.content = [
+        MagicMock(text='["Moody street look", "street style photograph", "black"]')
+    ]
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    mock_download_blob.return_value = b"image bytes"
+
+    result = ingest_file("user_123", file_id)
+
+    assert result == {"file_id": file_id}
+    # The image is read back from the file's blob
+    mock_download_blob.assert_called_once_with("blob123", "container1")
+    update = mock_update_document.call_args[0][3]
+    # User-provided fields are kept; only missing ones come from the analysis
+    assert update["description"] == "My own words"
+    assert update["class"] == "street style photograph"
+    assert update["colour"] == "black"
+    assert update["embedding"] == [0.1, 0.2, 0.3]
+    assert update["status"] == "ready"
+    mock_set_metadata.assert_called_once()
+
+
+def fake_upload(file_data, original_filename, metadata=None):
+    return {
+        "blob_name": f"blob_{original_filename}",
+        "blob_url": f"http://example.com/blob_{original_filename}",
+        "size": len(file_data),
+        "container": "test_container",
+    }
+
+
+def fake_upload_files(storage, files):
+    return [fake_upload(**file) for file in files]
+
+
+@patch("routes.file_routes.upload_files")
+@patch("routes.file_routes.insert_documents")
+@patch("utils.embeddings.co.embed")
+def test_upload_files_batch_success(
+    mock_embed, mock_insert_documents, mock_upload_files, client
+):
+    mock_upload_files.side_effect = fake_upload_files
+    mock_embed.return_value.embeddings.float = [[0.1], [0.2]]
+    mock_insert_documents.return_value = ["doc_a", "doc_b"]
+
+    data = {
+        "files": [
+            create_test_file("a.jpg"),
+            create_test_file("notes.txt"),
+            create_test_file("b.png"),
+        ],
+        "metadata": json.dumps(
+            [
+                {"description": "Red coat", "class": "garment", "colour": "red"},
+                {"description": "Not an image"},
+                {"description": "Silk swatch", "class": "fabric"},
+            ]
+        ),
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 200
+    response_json = response.get_json()
+    assert response_json["success"] is False
+    results = response_json["results"]
+    assert [r["success"] for r in results] == [True, False, True]
+    assert results[0]["document_id"] == "doc_a"
+    assert results[0]["class"] == "garment"
+    assert results[2]["document_id"] == "doc_b"
+    assert "File type not allowed" in results[1]["error"]
+
+    # One embed request and one insert_many for the whole batch
+    mock_embed.assert_called_once()
+    assert mock_embed.call_args[1]["texts"] == [
+        "Red coat Category: garment. Colours: red.",
+        "Silk swatch Category: fabric.",
+    ]
+    mock_insert_documents.assert_called_once()
+    user_id, collection, documents = mock_insert_documents.call_args[0]
+    assert (user_id, collection) == ("user_123", "files")
+    assert [d["embedding"] for d in documents] == [[0.1], [0.2]]
+    assert [d["blob_name"] for d in documents] == ["blob_a.jpg", "blob_b.png"]
+
+
+@patch("routes.file_routes.upload_files")
+@patch("routes.file_routes.insert_documents")
+@patch("utils.embeddings.co.embed")
+def test_upload_files_batch_partial_blob_failure(
+    mock_embed, mock_insert_documents, mock_upload_files, client
+):
+    def upload(file_data, original_filename, metadata=None):
+        if original_filename == "b.jpg":
+            return Exception("Storage service unavailable")
+        return fake_upload(file_data, original_filename)
+
+    mock_upload_files.side_effect = lambda storage, files: [
+        upload(**file) for file in files
+    ]
+    mock_embed.return_value.embeddings.float = [[0.1], [0.2]]
+    mock_insert_documents.return_value = ["doc_a"]
+
+    data = {
+        "files": [create_test_file("a.jpg"), create_test_file("b.jpg")],
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    results = response.get_json()["results"]
+    assert results[0]["success"] is True
+    assert results[1]["success"] is False
+    assert "Storage service unavailable" in results[1]["error"]
+    documents = mock_insert_documents.call_args[0][2]
+    assert len(documents) == 1
+    assert documents[0]["embedding"] == [0.1]
+    # The file whose blob failed is not embedded
+    assert len(mock_embed.call_args[1]["texts"]) == 1
+
+
+@patch("routes.file_routes.upload_files")
+@patch("routes.file_routes.blob_storage.delete_blob")
+@patch("routes.file_routes.insert_documents")
+@patch("utils.embeddings.co.embed")
+def test_upload_files_batch_insert_failure_deletes_blobs(
+    mock_embed, mock_insert_documents, mock_delete_blob, mock_upload_files, client
+):
+    mock_upload_files.side_effect = fake_upload_files
+    mock_embed.return_value.embeddings.float = [[0.1], [0.2]]
+    mock_insert_documents.side_effect = Exception("Database connection error")
+
+    data = {
+        "files": [create_test_file("a.jpg"), create_test_file("b.jpg")],
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 500
+    assert "Database connection error" in response.get_json()["error"]
+    assert mock_delete_blob.call_count == 2
+
+
+@patch("routes.file_routes.upload_files")
+@patch("routes.file_routes.blob_storage.delete_blob")
+@patch("routes.file_routes.insert_documents")
+@patch("utils.embeddings.co.embed")
+def test_upload_files_batch_partial_insert_keeps_written_files(
+    mock_embed, mock_insert_documents, mock_delete_blob, mock_upload_files, client
+):
+    mock_upload_files.side_effect = fake_upload_files
+    mock_embed.return_value.embeddings.float = [[0.1], [0.2], [0.3]]
+
+    def insert_documents(user_id, collection_type, documents):
+        # Like insert_many, ids are set on every document sent
+        for document in documents:
+            document["_id"] = ObjectId()
+        raise BulkWriteError(
+            {
+                "nInserted": 1,
+                "writeErrors": [
+                    {"index": 1, "code": 121, "errmsg": "Document failed validation"}
+                ],
+            }
+        )
+
+    mock_insert_documents.side_effect = insert_documents
+
+    data = {
+        "files": [
+            create_test_file("a.jpg"),
+            create_test_file("b.jpg"),
+            create_test_file("c.jpg"),
+        ],
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r["success"] for r in results] == [True, False, False]
+    documents = mock_insert_documents.call_args[0][2]
+    assert results[0]["document_id"] == str(documents[0]["_id"])
+    assert results[1]["error"] == "Document failed validation"
+    # Only the blobs of files that were not written are deleted
+    deleted = [call.args[0] for call in mock_delete_blob.call_args_list]
+    assert deleted == ["blob_b.jpg", "blob_c.jpg"]
+
+
+@patch("routes.file_routes.upload_files")
+@patch("routes.file_routes.insert_documents")
+@patch("utils.embeddings.co.embed")
+def test_upload_files_batch_invalid_metadata_items(
+    mock_embed, mock_insert_documents, mock_upload_files, client
+):
+    mock_upload_files.side_effect = fake_upload_files
+    mock_embed.return_value.embeddings.float = [[0.1]]
+    mock_insert_documents.return_value = ["doc_a"]
+
+    data = {
+        "files": [
+            create_test_file("a.jpg"),
+            create_test_file("b.jpg"),
+            create_test_file("c.jpg"),
+            create_test_file("d.jpg"),
+        ],
+        "metadata": json.dumps(
+            [{"description": "Red coat"}, "Blue coat", None, {"colour": ["red"]}]
+        ),
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r["success"] for r in results] == [True, False, False, False]
+    assert all("metadata must be an object" in r["error"] for r in results[1:])
+    # Invalid items are not uploaded
+    assert len(mock_upload_files.call_args[0][1]) == 1
+
+
+def test_upload_files_batch_metadata_mismatch(client):
+    data = {
+        "files": [create_test_file("a.jpg"), create_test_file("b.jpg")],
+        "metadata": json.dumps([{"description": "Only one"}]),
+        "user_id": "user_123",
+    }
+
+    response = client.post(
+        "/api/files/upload-batch", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.status_code == 400
+    assert "one entry per file" in response.get_json()["error"]
+
+
+def test_upload_files_batch_no_files(client):
+    response = client.post("/api/files/upload-batch", data={"user_id": "user_123"})
+    assert response.status_code == 400
+    assert "No files provided" in response.get_json()["error"]
+
+
 @patch("routes.file_routes.find_documents")
 def test_get_user_files_success(mock_find_documents, client):
     mock_find_documents.return_value = [
@@ -263,11 +630,16 @@ def test_get_user_files_timestamp_formatting(mock_find_documents, client):
     assert isinstance(response_json["files"][0]["timestamp"], str)
 
 
+@patch("routes.file_routes.update_centroids")
 @patch("routes.file_routes.find_documents")
 @patch("routes.file_routes.blob_storage.delete_blob")
 @patch("routes.file_routes.delete_document")
 def test_delete_file_success(
-    mock_delete_document, mock_delete_blob, mock_find_documents, client
+    mock_delete_document,
+    mock_delete_blob,
+    mock_find_documents,
+    mock_update_centroids,
+    client,
 ):
     file_id = "507f1f77bcf86cd799439011"
     mock_find_documents.return_value = [
@@ -295,6 +667,10 @@ def test_delete_file_success(
     )
     mock_delete_blob.assert_called_once_with("blob123", "container1")
     mock_delete_document.assert_called_once_with("1", "files", file_id)
+    # The file's vector is taken out of its class centroid
+    mock_update_centroids.assert_called_once_with(
+        "1", removed=[mock_find_documents.return_value[0]]
+    )
 
 
 @patch("routes.file_routes.find_documents")
@@ -344,9 +720,9 @@ def test_delete_file_blob_storage_failure(
 
 
 @patch("routes.file_routes.find_documents")
-@patch("routes.file_routes.blob_storage.update_blob")
+@patch("routes.file_routes.blob_storage.set_blob_metadata")
 @patch("routes.file_routes.update_document")
-@patch("routes.file_routes.co.embed")
+@patch("utils.embeddings.co.embed")
 def test_update_file_success(
     mock_embed, mock_update_document, mock_update_blob, mock_find_documents, client
 ):
@@ -401,21 +777,130 @@ def test_update_file_success(
         "class": "street style photograph",
         "colour": "white",
         "embedding": [0.1, 0.2, 0.3],
+        "embedding_hash": document_hash(
+            {
+                "description": "New description",
+                "class": "street style photograph",
+                "colour": "white",
+            }
+        ),
     }
 
     mock_update_blob.assert_called_once_with(
-        "blob123", expected_updated_doc, "container1"
+        "blob123",
+        {
+            "description": "New description",
+            "file_class": "street style photograph",
+            "colour": "white",
+        },
+        "container1",
     )
     mock_update_document.assert_called_once_with(
         "1", "files", file_id, expected_updated_doc
     )
+    # One composed text is embedded, not one vector per field
     mock_embed.assert_called_once_with(
-        texts=["New description", "street style photograph", "white"],
+        texts=["New description Category: street style photograph. Colours: white."],
         model="embed-english-v3.0",
         input_type="search_document",
         embedding_types=["float"],
+        request_options={"timeout_in_seconds": EMBED_TIMEOUT},
+    )
+
+
+@patch("routes.file_routes.find_documents")
+@patch("routes.file_routes.blob_storage.set_blob_metadata")
+@patch("routes.file_routes.update_document")
+@patch("utils.embeddings.co.embed")
+def test_update_file_unchanged_metadata_skips_blob(
+    mock_embed, mock_update_document, mock_set_metadata, mock_find_documents, client
+):
+    file_id = "507f1f77bcf86cd799439011"
+    mock_find_documents.return_value = [
+        {
+            "_id": file_id,
+            "filename": "test.jpg",
+            "blob_name": "blob123",
+            "container": "container1",
+            "description": "Same description",
+            "class": "runway",
+            "colour": "black",
+        }
+    ]
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    mock_update_document.return_value = {"_id": file_id}
+
+    response = client.patch(
+        f"/api/files/1/{file_id}",
+        data={"description": "Same description", "class": "runway"},
     )
 
+    assert response.status_code == 200
+    mock_set_metadata.assert_not_called()
+    mock_update_document.assert_called_once()
+
+
+@patch("routes.file_routes.find_documents")
+@patch("routes.file_routes.blob_storage.set_blob_metadata")
+@patch("routes.file_routes.update_document")
+@patch("utils.embeddings.co.embed")
+def test_update_file_unchanged_text_skips_embedding(
+    mock_embed, mock_update_document, mock_set_metadata, mock_find_documents, client
+):
+    file_id = "507f1f77bcf86cd799439011"
+    stored = {
+        "description": "Same description",
+        "class": "runway",
+        "colour": "black",
+    }
+    mock_find_documents.return_value = [
+        {
+            "_id": file_id,
+            "blob_name": "blob123",
+            "container": "container1",
+            "embedding": [0.4, 0.5, 0.6],
+            "embedding_hash": document_hash(stored),
+            **stored,
+        }
+    ]
+    mock_update_document.return_value = {"_id": file_id}
+
+    response = client.patch(f"/api/files/1/{file_id}", data=stored)
+
+    assert response.status_code == 200
+    mock_embed.assert_not_called()
+    mock_set_metadata.assert_not_called()
+    updated_doc = mock_update_document.call_args[0][3]
+    assert updated_doc["embedding"] == [0.4, 0.5, 0.6]
+
+
+@patch("routes.file_routes.active_embedding_version")
+@patch("routes.file_routes.find_documents")
+@patch("routes.file_routes.update_document")
+@patch("utils.embeddings.co.embed")
+def test_update_file_after_cutover_keeps_vector_of_unchanged_text(
+    mock_embed, mock_update_document, mock_find_documents, mock_active, client
+):
+    file_id = "507f1f77bcf86cd799439011"
+    stored = {"description": "Same description", "class": "runway", "colour": ""}
+    # Hashed before cutover, backfilled with the new model by the migration
+    mock_find_documents.return_value = [
+        {
+            "_id": file_id,
+            "embedding": [0.4],
+            "embedding_v4": [0.7],
+            "embedding_hash": document_hash(stored),
+            **stored,
+        }
+    ]
+    mock_active.return_value = EMBEDDING_VERSIONS["v4"]
+    mock_update_document.return_value = {"_id": file_id}
+
+    response = client.patch(f"/api/files/1/{file_id}", data=stored)
+
+    assert response.status_code == 200
+    mock_embed.assert_not_called()
+
 
 @patch("routes.file_routes.find_documents")
 def test_update_file_invalid_class(mock_find_documents, client):
@@ -449,9 +934,9 @@ def test_update_file_not_found(mock_find_documents, client):
 
 
 @patch("routes.file_routes.find_documents")
-@patch("routes.file_routes.blob_storage.update_blob")
+@patch("routes.file_routes.blob_storage.set_blob_metadata")
 @patch("routes.file_routes.update_document")
-@patch("routes.file_routes.co.embed")
+@patch("utils.embeddings.co.embed")
 @patch("routes.file_routes.logger")
 def test_update_file_blob_storage_failure(
     mock_logger,
@@ -610,3 +1095,66 @@ def test_get_file_metadata_missing_fields(mock_find_documents, client):
     assert not file_data["description"]  # Default empty string
     assert not file_data["class"]  # Default empty string
     assert not file_data["colour"]  # Default empty string
+
+
+@patch("routes.file_routes.class_centroids")
+@patch("routes.file_routes.search_database")
+@patch("routes.file_routes.find_documents")
+def test_get_similar_files(
+    mock_find_documents, mock_search, mock_class_centroids, client
+):
+    file_id = "507f1f77bcf86cd799439011"
+    on_board = "507f1f77bcf86cd799439012"
+    mock_find_documents.return_value = [
+        {"_id": ObjectId(file_id), "class": "runway", "embedding": [0.1, 0.2]}
+    ]
+
+    def search(*args, report, **kwargs):
+        report["scores"] = {"file_2": 0.9, "file_3": 0.7}
+        return ["file_2", "file_3"], ["url_2", "url_3"]
+
+    mock_search.side_effect = search
+
+    response = client.get(
+        f"/api/files/1/{file_id}/similar?topK=5&class=runway,garment&exclude={on_board}"
+    )
+
+    assert response.status_code == 200
+    assert response.get_json()["image_ids"] == ["file_2", "file_3"]
+    assert response.get_json()["scores"] == [0.9, 0.7]
+    kwargs = mock_search.call_args.kwargs
+    assert kwargs["shuffle"] is False
+    assert kwargs["query_emb"] == [0.1, 0.2]
+    assert kwargs["excluded_ids"] == [file_id, on_board]
+    assert kwargs["classes"] == ["runway", "garment"]
+    assert kwargs["topK"] == 5
+    mock_class_centroids.assert_called_once_with("1", "embedding")
+
+
+@patch("routes.file_routes.find_documents")
+def test_get_similar_files_without_embedding(mock_find_documents, client):
+    file_id = "507f1f77bcf86cd799439011"
+    mock_find_documents.return_value = [{"_id": ObjectId(file_id), "status": "pending"}]
+
+    response = client.get(f"/api/files/1/{file_id}/similar")
+
+    assert response.status_code == 409
+
+
+@patch("routes.file_routes.find_documents")
+def test_get_similar_files_not_found(mock_find_documents, client):
+    mock_find_documents.return_value = []
+
+    response = client.get("/api/files/1/507f1f77bcf86cd799439011/similar")
+
+    assert response.status_code == 404
+
+
+def test_get_similar_files_invalid_arguments(client):
+    file_id = "507f1f77bcf86cd799439011"
+
+    assert client.get(f"/api/files/1/{file_id}/similar?topK=0").status_code == 400
+    assert client.get(f"/api/files/1/{file_id}/similar?topK=x").status_code == 400
+    assert client.get(f"/api/files/1/{file_id}/similar?class=hat").status_code == 400
+    assert client.get(f"/api/files/1/{file_id}/similar?exclude=1").status_code == 400
+    assert client.get("/api/files/1/not-an-id/similar").status_code == 400
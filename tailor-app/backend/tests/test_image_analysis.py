@@ -0,0 +1,37 @@
+from unittest.mock import MagicMock
+
+from usecases.image_analysis import VISION_MODEL, analyze_image, parse_analysis
+
+
+def test_analyze_image_calls_vision_model():
+    client = MagicMock()
+    client.chat.return_value.message.content = [MagicMock(text="['a', 'b', 'c']")]
+
+    assert analyze_image(client, b"image bytes") == "['a', 'b', 'c']"
+
+    _, kwargs = client.chat.call_args
+    assert kwargs["model"] == VISION_MODEL
+    assert kwargs["temperature"] == 0
+    image_part = kwargs["messages"][0]["content"][-1]
+    assert image_part["image_url"]["url"].startswith("data:image/png;base64,")
+
+
+def test_parse_analysis_valid_list():
+    analysis = '["Vibrant street fashion", "Street Style Photograph", "red, black"]'
+
+    assert parse_analysis(analysis) == {
+        "description": "Vibrant street fashion",
+        "class": "street style photograph",
+        "colour": "red, black",
+    }
+
+
+def test_parse_analysis_unknown_class():
+    result = parse_analysis("['Dreamy', 'poster', 'pink']")
+    assert result["class"] == ""
+    assert result["colour"] == "pink"
+
+
+def test_parse_analysis_unparseable_text():
+    result = parse_analysis("A moody runway look")
+    assert result == {"description": "A moody runway look", "class": "", "colour": ""}
@@ -0,0 +1,201 @@
+from unittest.mock import MagicMock, patch
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import ingest_pinterest
+from ingest_pinterest import StageTimer, filter_new_blobs, ingest
+
+
+class FakePages:
+    """
+    Mimics the azure ItemPaged.by_page() iterator, exposing continuation_token.
+    """
+
+    def __init__(self, pages, start=None):
+        self.pages = pages
+        self.index = int(start) if start else 0
+        self.continuation_token = start
+
+    def __iter__(self):
+        while self.index < len(self.pages):
+            page = self.pages[self.index]
+            self.index += 1
+            self.continuation_token = (
+                str(self.index) if self.index < len(self.pages) else None
+            )
+            yield iter(page)
+
+
+def make_blob(name, size=1024):
+    blob = MagicMock()
+    blob.name = name
+    blob.size = size
+    return blob
+
+
+@pytest.fixture
+def container_client():
+    pages = [
+        [make_blob("a.jpg"), make_blob("b.png"), make_blob("notes.txt")],
+        [make_blob("c.jpg")],
+    ]
+    client = MagicMock()
+    client.url = "https://account.blob.core.windows.net/pinterest-images"
+    client.container_name = "pinterest-images"
+    client.list_blobs.return_value.by_page.side_effect = (
+        lambda continuation_token=None: FakePages(pages, continuation_token)
+    )
+    client.download_blob.return_value.readall.return_value = b"image"
+    return client
+
+
+@pytest.fixture
+def mocks(container_client):
+    with (
+        patch("ingest_pinterest.blob_storage") as mock_storage,
+        patch("ingest_pinterest.analyze_image") as mock_analyze,
+        patch("ingest_pinterest.embedding_fields") as mock_embed,
+        patch("ingest_pinterest.insert_documents") as mock_insert,
+        patch("ingest_pinterest.find_documents") as mock_find,
+        patch("ingest_pinterest.get_user_collection") as mock_collection,
+    ):
+        mock_storage.get_container_client.return_value = container_client
+        mock_analyze.return_value = "['Soft linen', 'fabric', 'beige']"
+        mock_embed.side_effect = lambda user_id, docs: [
+            {"embedding": [0.1, 0.2], "embedding_hash": "hash"} for _ in docs
+        ]
+        mock_find.return_value = []
+        yield {
+            "analyze": mock_analyze,
+            "embed": mock_embed,
+            "insert": mock_insert,
+            "find": mock_find,
+            "checkpoints": mock_collection.return_value,
+        }
+
+
+def test_ingest_processes_every_page(mocks):
+    stats = ingest(user_id="pinterest", batch_size=2, concurrency=2)
+
+    assert stats["processed"] == 3
+    assert stats["failed"] == 0
+    assert stats["skipped"] == 1
+    assert set(stats["stages"]) >= {"download", "analysis", "embed", "insert"}
+
+    inserted = [doc for call in mocks["insert"].call_args_list for doc in call[0][2]]
+    assert sorted(doc["blob_name"] for doc in inserted) == ["a.jpg", "b.png", "c.jpg"]
+    document = inserted[0]
+    assert document["class"] == "fabric"
+    assert document["embedding"] == [0.1, 0.2]
+    assert document["embedding_hash"]
+    assert document["blob_url"].startswith("https://account.blob.core.windows.net/")
+
+    # One checkpoint per page, the last one marking the run complete
+    updates = [
+        call[0][1]["$set"] for call in mocks["checkpoints"].update_one.call_args_list
+    ]
+    assert [u["continuation_token"] for u in updates] == ["1", None]
+    assert updates[-1]["completed"] is True
+
+
+def test_ingest_resumes_from_checkpoint(mocks):
+    mocks["find"].side_effect = lambda user_id, collection, query=None: (
+        [{"container": "pinterest-images", "continuation_token": "1"}]
+        if collection == "ingest_checkpoints"
+        else []
+    )
+
+    stats = ingest(user_id="pinterest")
+
+    assert stats["processed"] == 1
+    inserted = mocks["insert"].call_args[0][2]
+    assert [doc["blob_name"] for doc in inserted] == ["c.jpg"]
+
+
+def test_ingest_skips_completed_container(mocks):
+    mocks["find"].side_effect = lambda user_id, collection, query=None: (
+        [{"container": "pinterest-images", "completed": True}]
+        if collection == "ingest_checkpoints"
+        else []
+    )
+
+    stats = ingest(user_id="pinterest")
+
+    assert stats["processed"] == 0
+    mocks["insert"].assert_not_called()
+
+
+def test_ingest_counts_failed_analyses(mocks):
+    mocks["analyze"].side_effect = [Exception("rate limited")] + [
+        "['Runway look', 'runway', 'black']"
+    ] * 3
+
+    stats = ingest(user_id="pinterest", batch_size=10, concurrency=1)
+
+    assert stats["failed"] == 1
+    assert stats["processed"] == 2
+    # The failed blob is kept with the checkpoints for the next run to retry
+    updates = [
+        call[0][1]["$set"] for call in mocks["checkpoints"].update_one.call_args_list
+    ]
+    assert [u["failed_blobs"] for u in updates] == [["a.jpg"], ["a.jpg"]]
+
+
+def test_ingest_retries_failed_blobs_of_completed_container(mocks, container_client):
+    mocks["find"].side_effect = lambda user_id, collection, query=None: (
+        [
+            {
+                "container": "pinterest-images",
+                "completed": True,
+                "failed_blobs": ["b.png", "gone.jpg"],
+            }
+        ]
+        if collection == "ingest_checkpoints"
+        else []
+    )
+
+    def get_blob_client(name):
+        blob_client = MagicMock()
+        if name == "gone.jpg":
+            blob_client.get_blob_properties.side_effect = ResourceNotFoundError()
+        else:
+            blob_client.get_blob_properties.return_value = make_blob(name)
+        return blob_client
+
+    container_client.get_blob_client.side_effect = get_blob_client
+
+    stats = ingest(user_id="pinterest")
+
+    assert stats["processed"] == 1
+    assert [doc["blob_name"] for doc in mocks["insert"].call_args[0][2]] == ["b.png"]
+    container_client.list_blobs.assert_not_called()
+    update = mocks["checkpoints"].update_one.call_args[0][1]["$set"]
+    assert update["failed_blobs"] == []
+    assert update["completed"] is True
+
+
+def test_filter_new_blobs_skips_existing_and_oversized():
+    blobs = [
+        make_blob("a.jpg"),
+        make_blob("b.jpg"),
+        make_blob("huge.jpg", size=ingest_pinterest.MAX_IMAGE_SIZE + 1),
+    ]
+    stats = {"skipped": 0}
+    with patch(
+        "ingest_pinterest.find_documents", return_value=[{"blob_name": "a.jpg"}]
+    ):
+        new_blobs = filter_new_blobs(blobs, "pinterest", stats)
+
+    assert [blob.name for blob in new_blobs] == ["b.jpg"]
+    assert stats["skipped"] == 2
+
+
+def test_stage_timer_summary():
+    timer = StageTimer()
+    for _ in range(3):
+        with timer.time("embed"):
+            pass
+
+    summary = timer.summary()
+    assert summary["embed"]["count"] == 3
+    assert summary["embed"]["p95_ms"] >= summary["embed"]["mean_ms"] >= 0
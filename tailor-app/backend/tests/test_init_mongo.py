@@ -257,6 +257,35 @@ class TestInitMongo(unittest.TestCase):
             mock_collection.create_search_index.assert_called_once()
             self.assertEqual(result, mock_collection)
 
+    def test_list_user_ids(self):
+        self.mock_db.list_collection_names.return_value = [
+            "user_alice_jobs",
+            "user_alice_files",
+            "user_bob_smith_jobs",
+            "jobs",
+        ]
+
+        with patch("sys.exit"):
+            import init_mongo
+
+            init_mongo.testing_mode = False
+            init_mongo.db = self.mock_db
+
+            self.assertEqual(
+                init_mongo.list_user_ids("jobs"), ["alice", "bob_smith"]
+            )
+
+    def test_search_index_definition(self):
+        import init_mongo
+
+        # Both versions are indexed while a model migration is backfilling
+        fields = init_mongo.search_index_definition(["v3", "v4"])["mappings"]["fields"]
+
+        self.assertEqual(fields["embedding"]["dimensions"], 1024)
+        self.assertEqual(fields["embedding_v4"]["dimensions"], 1536)
+        self.assertEqual(fields["embedding_v4"]["type"], "knnVector")
+        self.assertEqual(fields["class"], {"type": "token"})
+
     def test_mock_collection_operations(self):
         # Test that MockCollection methods work as expected
         with patch("sys.exit"):
@@ -0,0 +1,50 @@
+from datetime import datetime
+from unittest.mock import patch
+from bson import ObjectId
+
+JOB_ID = "507f1f77bcf86cd799439011"
+
+
+@patch("routes.job_routes.find_documents")
+def test_get_job_status_success(mock_find_documents, client):
+    mock_find_documents.return_value = [
+        {
+            "_id": ObjectId(JOB_ID),
+            "type": "ingest_file",
+            "status": "completed",
+            "attempts": 1,
+            "file_id": "file_1",
+            "created_at": datetime(2025, 3, 15, 10, 30, 45),
+        }
+    ]
+
+    response = client.get(f"/api/jobs/{JOB_ID}?user_id=user_123")
+
+    assert response.status_code == 200
+    job = response.get_json()["job"]
+    assert job["_id"] == JOB_ID
+    assert job["status"] == "completed"
+    assert job["created_at"] == "2025-03-15T10:30:45"
+    mock_find_documents.assert_called_once_with(
+        "user_123", "jobs", {"_id": ObjectId(JOB_ID)}
+    )
+
+
+@patch("routes.job_routes.find_documents")
+def test_get_job_status_not_found(mock_find_documents, client):
+    mock_find_documents.return_value = []
+
+    response = client.get(f"/api/jobs/{JOB_ID}")
+
+    assert response.status_code == 404
+    assert "Job not found" in response.get_json()["error"]
+
+
+@patch("routes.job_routes.find_documents")
+def test_get_job_status_exception(mock_find_documents, client):
+    mock_find_documents.side_effect = Exception("Database connection error")
+
+    response = client.get(f"/api/jobs/{JOB_ID}")
+
+    assert response.status_code == 500
+    assert "Database connection error" in response.get_json()["error"]
@@ -0,0 +1,158 @@
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+import pytest
+
+from utils.jobs import COMPLETED, FAILED, PENDING, RUNNING, JobQueue
+
+
+@pytest.fixture
+def mock_store():
+    with (
+        patch("utils.jobs.insert_document") as mock_insert,
+        patch("utils.jobs.update_document") as mock_update,
+    ):
+        mock_insert.return_value = "job_1"
+        yield mock_insert, mock_update
+
+
+def run_to_completion(queue):
+    queue._get_executor().shutdown(wait=True)
+
+
+def test_enqueue_persists_pending_job(mock_store):
+    mock_insert, mock_update = mock_store
+    handler = MagicMock(return_value=42)
+    queue = JobQueue(max_workers=1, retry_delay=0)
+    queue.register("ingest_file", handler)
+
+    job_id = queue.enqueue("user_1", "ingest_file", {"file_id": "f1"})
+    run_to_completion(queue)
+
+    assert job_id == "job_1"
+    user_id, collection, document = mock_insert.call_args[0]
+    assert (user_id, collection) == ("user_1", "jobs")
+    assert document["status"] == "pending"
+    # The job document holds what the handler needs, not the work itself
+    assert document["details"] == {"file_id": "f1"}
+    handler.assert_called_once_with("user_1", file_id="f1")
+
+    statuses = [call[0][3]["status"] for call in mock_update.call_args_list]
+    assert statuses == [RUNNING, COMPLETED]
+    assert mock_update.call_args[0][3]["result"] == 42
+
+
+def test_enqueue_rejects_unknown_job_type(mock_store):
+    queue = JobQueue(max_workers=1, retry_delay=0)
+
+    with pytest.raises(ValueError):
+        queue.enqueue("user_1", "ingest_file")
+
+
+def test_job_retries_until_success(mock_store):
+    _, mock_update = mock_store
+    handler = MagicMock(side_effect=[Exception("Cohere timeout"), "done"])
+    queue = JobQueue(max_workers=1, max_attempts=3, retry_delay=0)
+    queue.register("ingest_file", handler)
+
+    queue.enqueue("user_1", "ingest_file")
+    run_to_completion(queue)
+
+    assert handler.call_count == 2
+    assert mock_update.call_args[0][3]["status"] == COMPLETED
+    attempts = [
+        call[0][3]["attempts"]
+        for call in mock_update.call_args_list
+        if call[0][3]["status"] == RUNNING
+    ]
+    assert attempts == [1, 2]
+
+
+def test_job_fails_after_max_attempts(mock_store):
+    _, mock_update = mock_store
+    handler = MagicMock(side_effect=Exception("Cohere down"))
+    on_failure = MagicMock()
+    queue = JobQueue(max_workers=1, max_attempts=2, retry_delay=0)
+    queue.register("ingest_file", handler, on_failure=on_failure)
+
+    queue.enqueue("user_1", "ingest_file", {"file_id": "f1"})
+    run_to_completion(queue)
+
+    assert handler.call_count == 2
+    final_update = mock_update.call_args[0][3]
+    assert final_update["status"] == FAILED
+    assert final_update["error"] == "Cohere down"
+    on_failure.assert_called_once()
+    user_id, error = on_failure.call_args[0]
+    assert user_id == "user_1"
+    assert str(error) == "Cohere down"
+    assert on_failure.call_args[1] == {"file_id": "f1"}
+
+
+@pytest.fixture
+def stale_jobs():
+    """A jobs collection of user_1 holding one running job abandoned by a worker."""
+    collection = MagicMock()
+    collection.find.return_value = [
+        {
+            "_id": "507f1f77bcf86cd799439011",
+            "type": "ingest_file",
+            "status": RUNNING,
+            "attempts": 1,
+            "details": {"file_id": "f1"},
+            "updated_at": datetime(2024, 1, 1),
+        }
+    ]
+    with (
+        patch("utils.jobs.list_user_ids", return_value=["user_1"]),
+        patch("utils.jobs.get_user_collection", return_value=collection),
+    ):
+        yield collection
+
+
+def test_requeue_stale_jobs_runs_them_again(mock_store, stale_jobs):
+    _, mock_update = mock_store
+    handler = MagicMock(return_value="done")
+    queue = JobQueue(max_workers=1, max_attempts=3, retry_delay=0)
+    queue.register("ingest_file", handler)
+
+    assert queue.requeue_stale_jobs() == 1
+    run_to_completion(queue)
+
+    query = stale_jobs.find.call_args[0][0]
+    assert query["status"] == {"$in": [PENDING, RUNNING]}
+    assert query["type"] == {"$in": ["ingest_file"]}
+    # The job is claimed only if no other process touched it since it was read
+    claim_filter, claim = stale_jobs.update_one.call_args[0]
+    assert claim_filter["updated_at"] == datetime(2024, 1, 1)
+    assert claim["$set"]["status"] == PENDING
+    handler.assert_called_once_with("user_1", file_id="f1")
+    # The abandoned attempt counts against the job's attempts
+    assert mock_update.call_args_list[0][0][3]["attempts"] == 2
+    assert mock_update.call_args[0][3]["status"] == COMPLETED
+
+
+def test_requeue_stale_jobs_skips_jobs_claimed_elsewhere(mock_store, stale_jobs):
+    stale_jobs.update_one.return_value.modified_count = 0
+    handler = MagicMock()
+    queue = JobQueue(max_workers=1, retry_delay=0)
+    queue.register("ingest_file", handler)
+
+    assert queue.requeue_stale_jobs() == 0
+    run_to_completion(queue)
+
+    handler.assert_not_called()
+
+
+def test_stale_job_abandoned_on_last_attempt_fails(mock_store, stale_jobs):
+    _, mock_update = mock_store
+    handler = MagicMock()
+    on_failure = MagicMock()
+    queue = JobQueue(max_workers=1, max_attempts=1, retry_delay=0)
+    queue.register("ingest_file", handler, on_failure=on_failure)
+
+    queue.requeue_stale_jobs()
+    run_to_completion(queue)
+
+    handler.assert_not_called()
+    assert mock_update.call_args[0][3]["status"] == FAILED
+    on_failure.assert_called_once()
@@ -0,0 +1,28 @@
+from unittest.mock import patch
+
+
+def test_metrics_route(client):
+    response = client.get("/api/metrics")
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert set(data) == {
+        "cohere_connections",
+        "embedding_cache",
+        "embedding_batcher",
+        "semantic_cache",
+        "conversation_log",
+        "model_scheduler",
+        "resilience",
+    }
+    assert "reuse_ratio" in data["cohere_connections"]
+
+
+@patch("routes.metrics_routes.cohere_metrics.snapshot")
+def test_metrics_route_error(mock_snapshot, client):
+    mock_snapshot.side_effect = Exception("boom")
+
+    response = client.get("/api/metrics")
+
+    assert response.status_code == 500
+    assert response.get_json()["success"] is False
@@ -0,0 +1,226 @@
+from unittest.mock import MagicMock, patch
+import pytest
+from bson.objectid import ObjectId
+from cohere.errors import TooManyRequestsError
+
+import migrate_embeddings
+from migrate_embeddings import (
+    AdaptiveLimiter,
+    backfill,
+    cutover,
+    embed_with_backoff,
+    reembed,
+    start,
+)
+from utils.cohere_client import ResilientClient
+from utils.embeddings import document_hash
+
+
+def embed_response(texts):
+    response = MagicMock()
+    response.embeddings.float = [[0.5, 0.5] for _ in texts]
+    return response
+
+
+class FakeFilesCollection:
+    """
+    Enough of a pymongo collection for the backfill: find/sort/limit, count and
+    bulk_write over an in-memory list of documents.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def _matches(self, document, query):
+        for key, condition in query.items():
+            if key == "_id":
+                if isinstance(condition, dict):
+                    if not document["_id"] > condition["$gt"]:
+                        return False
+                elif document["_id"] != condition:
+                    return False
+            elif condition == {"$exists": False}:
+                if key in document:
+                    return False
+            elif document.get(key) != condition:
+                return False
+        return True
+
+    def count_documents(self, query):
+        return sum(1 for d in self.documents if self._matches(d, query))
+
+    def find(self, query, projection=None):
+        cursor = MagicMock()
+        matches = sorted(
+            (d for d in self.documents if self._matches(d, query)),
+            key=lambda d: d["_id"],
+        )
+        cursor.sort.return_value.limit.side_effect = lambda n: matches[:n]
+        return cursor
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            for document in self.documents:
+                if self._matches(document, operation._filter):
+                    document.update(operation._doc["$set"])
+
+
+@pytest.fixture
+def files():
+    return [
+        {"_id": ObjectId(), "description": f"Look {i}", "class": "runway"}
+        for i in range(5)
+    ]
+
+
+@patch("migrate_embeddings.update_search_index")
+@patch("migrate_embeddings.set_embedding_state")
+@patch("migrate_embeddings.get_embedding_state")
+def test_start_records_target_and_indexes_both_fields(
+    mock_state, mock_set_state, mock_update_index
+):
+    mock_state.return_value = {"active": "v3", "target": None}
+
+    start("user_1", "v4", grace=0)
+
+    mock_set_state.assert_called_once_with("user_1", "v3", "v4")
+    mock_update_index.assert_called_once_with("user_1", ["v3", "v4"])
+
+
+@patch("migrate_embeddings.get_embedding_state")
+def test_start_rejects_active_version(mock_state):
+    mock_state.return_value = {"active": "v4", "target": None}
+
+    with pytest.raises(ValueError):
+        start("user_1", "v4", grace=0)
+
+
+@patch("migrate_embeddings.co.embed")
+@patch("migrate_embeddings.get_user_collection")
+@patch("migrate_embeddings.get_embedding_state")
+def test_backfill_fills_shadow_field_in_batches(
+    mock_state, mock_collection, mock_embed, files
+):
+    mock_state.return_value = {"active": "v3", "target": "v4"}
+    files[0]["embedding_v4"] = [0.9, 0.9]
+    mock_collection.return_value = FakeFilesCollection(files)
+    mock_embed.side_effect = lambda texts, **kwargs: embed_response(texts)
+
+    backfilled = backfill("user_1", batch_size=2, concurrency=2)
+
+    assert backfilled == 4
+    assert mock_embed.call_count == 2
+    assert mock_embed.call_args[1]["model"] == "embed-v4.0"
+    # Already migrated files are left untouched
+    assert files[0]["embedding_v4"] == [0.9, 0.9]
+    assert all(f["embedding_v4"] == [0.5, 0.5] for f in files[1:])
+
+
+@patch("migrate_embeddings.get_embedding_state")
+def test_backfill_requires_started_migration(mock_state):
+    mock_state.return_value = {"active": "v3", "target": None}
+
+    with pytest.raises(ValueError):
+        backfill("user_1")
+
+
+@patch("migrate_embeddings.time.sleep")
+@patch("migrate_embeddings.co.embed")
+def test_embed_with_backoff_retries_rate_limits(mock_embed, mock_sleep):
+    mock_embed.side_effect = [
+        TooManyRequestsError(body="slow down"),
+        embed_response(["a"]),
+    ]
+    limiter = AdaptiveLimiter(4)
+
+    vectors = embed_with_backoff(["a"], "embed-v4.0", limiter)
+
+    assert vectors == [[0.5, 0.5]]
+    mock_sleep.assert_called_once()
+    # Halved on the rate limit, then grown back by one
+    assert limiter.limit == 3
+
+
+@patch("migrate_embeddings.time.sleep")
+@patch("migrate_embeddings.co.embed")
+def test_embed_with_backoff_gives_up(mock_embed, mock_sleep):
+    mock_embed.side_effect = TooManyRequestsError(body="slow down")
+
+    with pytest.raises(TooManyRequestsError):
+        embed_with_backoff(["a"], "embed-v4.0", AdaptiveLimiter(4))
+
+    assert mock_embed.call_count == migrate_embeddings.MAX_EMBED_ATTEMPTS
+
+
+@patch("migrate_embeddings.rebuild_centroids")
+@patch("migrate_embeddings.co.embed")
+@patch("migrate_embeddings.get_user_collection")
+@patch("migrate_embeddings.get_embedding_state")
+def test_reembed_refreshes_files_embedded_from_other_text(
+    mock_state, mock_collection, mock_embed, mock_rebuild, files
+):
+    mock_state.return_value = {"active": "v3", "target": None}
+    # Stored before class and colour were part of the embedded text
+    for f in files:
+        f["embedding"] = [0.1, 0.1]
+    files[0]["embedding_hash"] = document_hash(files[0])
+    files[1]["embedding_hash"] = "description-only"
+    mock_collection.return_value = FakeFilesCollection(files)
+    mock_embed.side_effect = lambda texts, **kwargs: embed_response(texts)
+
+    reembedded = reembed("user_1", batch_size=2, concurrency=2)
+
+    assert reembedded == 4
+    embedded_texts = [t for c in mock_embed.call_args_list for t in c[1]["texts"]]
+    assert "Look 1 Category: runway." in embedded_texts
+    # A file already embedded from its current text is left untouched
+    assert files[0]["embedding"] == [0.1, 0.1]
+    assert all(f["embedding"] == [0.5, 0.5] for f in files[1:])
+    assert all(f["embedding_hash"] == document_hash(f) for f in files)
+    mock_rebuild.assert_called_once_with("user_1")
+
+    # Once every file is current, a re-run embeds nothing
+    mock_embed.reset_mock()
+    assert reembed("user_1", batch_size=2) == 0
+    mock_embed.assert_not_called()
+
+
+def test_backfill_bypasses_shared_retries_and_circuit_breaker():
+    # Throttling is left to embed_with_backoff, so a long run is slowed, not aborted
+    assert not isinstance(migrate_embeddings.co, ResilientClient)
+
+
+@patch("migrate_embeddings.rebuild_centroids")
+@patch("migrate_embeddings.update_search_index")
+@patch("migrate_embeddings.set_embedding_state")
+@patch("migrate_embeddings.get_user_collection")
+@patch("migrate_embeddings.get_embedding_state")
+def test_cutover_switches_searches_then_index(
+    mock_state, mock_collection, mock_set_state, mock_update_index, mock_rebuild
+):
+    mock_state.return_value = {"active": "v3", "target": "v4"}
+    mock_collection.return_value.count_documents.return_value = 0
+
+    cutover("user_1", grace=0, drop_old=True)
+
+    mock_rebuild.assert_called_once_with("user_1")
+    mock_set_state.assert_called_once_with("user_1", "v4")
+    mock_update_index.assert_called_once_with("user_1", ["v4"])
+    mock_collection.return_value.update_many.assert_called_once_with(
+        {}, {"$unset": {"embedding": ""}}
+    )
+
+
+@patch("migrate_embeddings.set_embedding_state")
+@patch("migrate_embeddings.get_user_collection")
+@patch("migrate_embeddings.get_embedding_state")
+def test_cutover_refuses_incomplete_backfill(
+    mock_state, mock_collection, mock_set_state
+):
+    mock_state.return_value = {"active": "v3", "target": "v4"}
+    mock_collection.return_value.count_documents.return_value = 3
+
+    with pytest.raises(RuntimeError):
+        cutover("user_1", grace=0)
+
+    mock_set_state.assert_not_called()
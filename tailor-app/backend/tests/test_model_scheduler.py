@@ -0,0 +1,250 @@
+import concurrent.futures
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from app import app
+from utils.model_scheduler import (
+    BACKGROUND,
+    INTERACTIVE,
+    ModelQueueTimeout,
+    ModelScheduler,
+    ScheduledClient,
+    current_caller,
+    model_caller,
+    parse_model_limits,
+)
+from utils.pipeline import Pipeline
+from utils.resilience import Hedger
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def waiting(scheduler):
+    return sum(lane["waiting"] for lane in scheduler.snapshot()["lanes"].values())
+
+
+def queue_call(scheduler, order, name, model="chat", user_id=None, lane=INTERACTIVE):
+    """Start a thread that takes a slot, records its name and releases it."""
+
+    def call():
+        with model_caller(user_id, lane):
+            with scheduler.slot(model):
+                order.append(name)
+
+    thread = threading.Thread(target=call)
+    expected = waiting(scheduler) + 1
+    thread.start()
+    wait_until(lambda: waiting(scheduler) == expected)
+    return thread
+
+
+def run_queued(scheduler, calls):
+    """Queue calls behind a held slot, then release it and return the admission order."""
+    order = []
+    blocker = scheduler.slot("chat")
+    blocker.__enter__()
+    threads = [queue_call(scheduler, order, **call) for call in calls]
+    blocker.__exit__(None, None, None)
+    for thread in threads:
+        thread.join(timeout=2)
+    return order
+
+
+def test_parse_model_limits():
+    assert parse_model_limits("c4ai-aya-vision-8b=4, embed-v4.0=8,") == {
+        "c4ai-aya-vision-8b": 4,
+        "embed-v4.0": 8,
+    }
+
+
+def test_current_caller_defaults():
+    assert current_caller() == (None, BACKGROUND, 1.0)
+    with app.test_request_context():
+        app.preprocess_request()
+        assert current_caller() == ("123", INTERACTIVE, 1.0)
+        with model_caller("user_1", BACKGROUND, 2.0):
+            assert current_caller() == ("user_1", BACKGROUND, 2.0)
+    assert current_caller() == (None, BACKGROUND, 1.0)
+
+
+def test_request_caller_reaches_worker_threads():
+    with app.test_request_context():
+        app.preprocess_request()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            results = Pipeline().add_stage("caller", current_caller).run(pool)
+
+    assert results["caller"] == ("123", INTERACTIVE, 1.0)
+
+
+def test_global_concurrency_limit():
+    scheduler = ModelScheduler(max_concurrency=2, model_limits={})
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def call():
+        with scheduler.slot("chat"):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=2)
+
+    assert peak[0] == 2
+    assert scheduler.snapshot()["lanes"][BACKGROUND]["admitted"] == 6
+
+
+def test_model_limit_does_not_block_other_models():
+    scheduler = ModelScheduler(max_concurrency=4, model_limits={"vision": 1})
+    order = []
+    with scheduler.slot("vision"):
+        vision = queue_call(scheduler, order, "vision", model="vision")
+        with scheduler.slot("chat"):
+            pass
+        assert order == []
+    vision.join(timeout=2)
+    assert order == ["vision"]
+
+
+def test_interactive_lane_first():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+
+    order = run_queued(
+        scheduler,
+        [
+            {"name": "ingest", "user_id": "a", "lane": BACKGROUND},
+            {"name": "search", "user_id": "b", "lane": INTERACTIVE},
+        ],
+    )
+
+    assert order == ["search", "ingest"]
+
+
+def test_fair_queuing_across_users():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+
+    order = run_queued(
+        scheduler,
+        [
+            {"name": "a1", "user_id": "a"},
+            {"name": "a2", "user_id": "a"},
+            {"name": "a3", "user_id": "a"},
+            {"name": "b1", "user_id": "b"},
+        ],
+    )
+
+    # b's first call is tagged alongside a's first, not behind all of a's calls
+    assert order.index("b1") < order.index("a2")
+
+
+def test_background_share_keeps_interactive_headroom():
+    scheduler = ModelScheduler(
+        max_concurrency=2, model_limits={}, background_share=0.5, queue_timeout=0.05
+    )
+
+    with model_caller("a", BACKGROUND):
+        with scheduler.slot("embed"):
+            with pytest.raises(ModelQueueTimeout):
+                with scheduler.slot("embed"):
+                    pass
+            with model_caller("b", INTERACTIVE):
+                with scheduler.slot("chat"):
+                    pass
+
+    lanes = scheduler.snapshot()["lanes"]
+    assert lanes[BACKGROUND]["timeouts"] == 1
+    assert lanes[INTERACTIVE]["admitted"] == 1
+
+
+def test_snapshot_reports_queue_times():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+    run_queued(scheduler, [{"name": "a", "user_id": "a"}])
+
+    snapshot = scheduler.snapshot()
+    assert snapshot["in_flight"] == 0
+    assert snapshot["models"] == {"chat": 0}
+    assert snapshot["lanes"][INTERACTIVE]["admitted"] == 1
+    assert snapshot["lanes"][INTERACTIVE]["queue_ms_p95"] > 0
+
+
+def test_scheduled_client_holds_slot_while_streaming():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+    client = MagicMock()
+    client.chat_stream.return_value = iter(["a", "b"])
+    client.api_key = "key"
+    scheduled = ScheduledClient(client, scheduler)
+
+    stream = scheduled.chat_stream(model="chat")
+    assert next(stream) == "a"
+    assert scheduler.snapshot()["in_flight"] == 1
+    assert list(stream) == ["b"]
+    assert scheduler.snapshot()["in_flight"] == 0
+
+    scheduled.embed(model="embed", texts=["x"])
+    client.embed.assert_called_once_with(model="embed", texts=["x"])
+    assert scheduled.api_key == "key"
+
+
+def test_try_acquire_takes_only_a_free_slot():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+
+    release = scheduler.try_acquire("embed")
+    assert release is not None
+    assert scheduler.snapshot()["in_flight"] == 1
+    assert scheduler.try_acquire("embed") is None
+
+    release()
+    assert scheduler.snapshot()["in_flight"] == 0
+
+
+def test_scheduled_embed_is_not_hedged_while_queued():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+    hedger = Hedger(hedge_after=0.01)
+    client = MagicMock()
+    client.embed.return_value = "embedded"
+    scheduled = ScheduledClient(client, scheduler, hedger)
+
+    with scheduler.slot("chat"):
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(scheduled.embed(model="embed"))
+        )
+        thread.start()
+        time.sleep(0.05)
+    thread.join(2)
+
+    assert result == ["embedded"]
+    client.embed.assert_called_once_with(model="embed")
+    assert hedger.snapshot() == {"hedged": 0, "hedge_wins": 0, "skipped": 0}
+
+
+def test_scheduled_embed_skips_hedge_without_free_slot():
+    scheduler = ModelScheduler(max_concurrency=1, model_limits={})
+    hedger = Hedger(hedge_after=0.01)
+    client = MagicMock()
+
+    def embed(**kwargs):
+        time.sleep(0.05)
+        return "embedded"
+
+    client.embed.side_effect = embed
+    scheduled = ScheduledClient(client, scheduler, hedger)
+
+    assert scheduled.embed(model="embed") == "embedded"
+    assert client.embed.call_count == 1
+    assert hedger.snapshot()["skipped"] == 1
+    assert scheduler.snapshot()["in_flight"] == 0
@@ -1,3 +1,4 @@
+import json
 from io import BytesIO
 from unittest.mock import patch, MagicMock
 from datetime import datetime
@@ -589,3 +590,84 @@ def test_analyze_moodboardV2_exception(mock_cohere_chat, mock_allowed_file, clie
     response_json = response.get_json()
     assert "Internal Server Error" in response_json["error"]
     assert "AI service unavailable" in response_json["details"]
+
+
+def stream_event(event_type, text=None):
+    event = MagicMock()
+    event.type = event_type
+    event.delta.message.content.text = text
+    return event
+
+
+def parse_sse(body):
+    """Split an SSE body into (event, payload) pairs."""
+    events = []
+    for message in body.decode("utf-8").strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((lines.get("event"), json.loads(lines["data"])))
+    return events
+
+
+@patch("routes.moodboard_routes.co.chat_stream")
+def test_analyze_moodboard_stream(mock_chat_stream, client):
+    mock_chat_stream.return_value = iter(
+        [
+            stream_event("message-start"),
+            stream_event("content-delta", "# Coastal"),
+            stream_event("content-delta", " Calm"),
+            stream_event("message-end"),
+        ]
+    )
+    image, filename = create_test_image()
+
+    response = client.post(
+        "/api/boards/nodescriptionsanalyze",
+        data={"file": (image, filename), "stream": "true"},
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    events = parse_sse(response.data)
+    assert events == [
+        ("delta", {"text": "# Coastal"}),
+        ("delta", {"text": " Calm"}),
+        ("end", {"success": True, "analysis": "# Coastal Calm"}),
+    ]
+    assert mock_chat_stream.call_args[1]["model"] == "c4ai-aya-vision-8b"
+
+
+@patch("routes.moodboard_routes.co.chat_stream")
+def test_analyze_moodboardV2_stream(mock_chat_stream, client):
+    mock_chat_stream.return_value = iter([stream_event("content-delta", "# Noir")])
+    image, filename = create_test_image()
+
+    response = client.post(
+        "/api/boards/analyze",
+        data={
+            "file": (image, filename),
+            "image_descriptions": '["Black wool coat"]',
+            "stream": "true",
+        },
+        content_type="multipart/form-data",
+    )
+
+    events = parse_sse(response.data)
+    assert events[-1] == ("end", {"success": True, "analysis": "# Noir"})
+    call_args = mock_chat_stream.call_args[1]
+    assert call_args["temperature"] == 0.3
+    assert "Black wool coat" in call_args["messages"][0]["content"][0]["text"]
+
+
+@patch("routes.moodboard_routes.co.chat_stream")
+def test_analyze_moodboard_stream_error(mock_chat_stream, client):
+    mock_chat_stream.side_effect = Exception("Stream failed")
+    image, filename = create_test_image()
+
+    response = client.post(
+        "/api/boards/nodescriptionsanalyze",
+        data={"file": (image, filename), "stream": "true"},
+        content_type="multipart/form-data",
+    )
+
+    assert parse_sse(response.data) == [("error", {"error": "Stream failed"})]
@@ -0,0 +1,84 @@
+import concurrent.futures
+import threading
+from unittest.mock import MagicMock
+import pytest
+
+from utils.pipeline import Pipeline
+from utils.resilience import deadline_budget, time_remaining
+
+
+@pytest.fixture
+def executor():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        yield pool
+
+
+def test_pipeline_passes_dependency_results(executor):
+    results = (
+        Pipeline()
+        .add_stage("a", lambda: 1)
+        .add_stage("b", lambda: 2)
+        .add_stage("total", lambda a, b: a + b, depends_on=("a", "b"))
+        .run(executor)
+    )
+
+    assert results == {"a": 1, "b": 2, "total": 3}
+
+
+def test_pipeline_runs_independent_stages_concurrently(executor):
+    # Each stage waits for the other, so this only finishes if they overlap
+    barrier = threading.Barrier(2, timeout=5)
+
+    results = (
+        Pipeline()
+        .add_stage("a", lambda: barrier.wait() is not None)
+        .add_stage("b", lambda: barrier.wait() is not None)
+        .run(executor)
+    )
+
+    assert results == {"a": True, "b": True}
+
+
+def test_pipeline_stages_keep_callers_deadline(executor):
+    with deadline_budget(5):
+        results = Pipeline().add_stage("remaining", time_remaining).run(executor)
+
+    assert results["remaining"] is not None and results["remaining"] <= 5
+
+
+def test_pipeline_compensates_completed_stages(executor):
+    compensate = MagicMock()
+    dependent = MagicMock()
+
+    def fail():
+        raise RuntimeError("embed failed")
+
+    pipeline = (
+        Pipeline()
+        .add_stage("blob", lambda: "blob-1", compensate=compensate)
+        .add_stage("embedding", fail)
+        .add_stage("document", dependent, depends_on=("blob", "embedding"))
+    )
+
+    with pytest.raises(RuntimeError, match="embed failed"):
+        pipeline.run(executor)
+
+    compensate.assert_called_once_with("blob-1")
+    dependent.assert_not_called()
+
+
+def test_pipeline_does_not_compensate_failed_stage(executor):
+    compensate = MagicMock()
+
+    def fail():
+        raise RuntimeError("upload failed")
+
+    with pytest.raises(RuntimeError):
+        Pipeline().add_stage("blob", fail, compensate=compensate).run(executor)
+
+    compensate.assert_not_called()
+
+
+def test_pipeline_unknown_dependency():
+    with pytest.raises(ValueError):
+        Pipeline().add_stage("document", lambda blob: blob, depends_on=("blob",))
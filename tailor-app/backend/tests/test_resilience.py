@@ -0,0 +1,262 @@
+import asyncio
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from utils.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    Dependency,
+    Hedger,
+    call_timeout,
+    deadline_budget,
+    time_remaining,
+)
+
+
+class Retryable(Exception):
+    pass
+
+
+def make_dependency(**kwargs):
+    return Dependency(
+        "test", lambda e: isinstance(e, Retryable), base_delay=0.001, **kwargs
+    )
+
+
+def test_deadline_budget_nests_tighter():
+    assert time_remaining() is None
+    assert call_timeout(15) == 15
+
+    with deadline_budget(10):
+        assert 9 < time_remaining() <= 10
+        with deadline_budget(60):
+            # An inner budget cannot extend the outer one
+            assert time_remaining() <= 10
+        with deadline_budget(1):
+            assert call_timeout(15) <= 1
+    assert time_remaining() is None
+
+
+def test_call_timeout_without_budget_left():
+    with deadline_budget(0):
+        with pytest.raises(DeadlineExceeded):
+            call_timeout(15)
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    # Only the trial call is let through while half open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.snapshot() == {
+        "state": CLOSED,
+        "failures": 0,
+        "rejected": 2,
+        "opened": 1,
+    }
+
+
+def test_circuit_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    breaker.before_call()
+
+    breaker.record_failure()
+
+    assert breaker.state == OPEN
+
+
+def test_dependency_retries_retryable_errors():
+    dependency = make_dependency()
+    func = MagicMock(side_effect=[Retryable("busy"), Retryable("busy"), "ok"])
+
+    assert dependency.call(func) == "ok"
+    assert func.call_count == 3
+    assert dependency.snapshot()["retries"] == 2
+    assert dependency.breaker.state == CLOSED
+
+
+def test_dependency_retries_coroutines_without_blocking():
+    dependency = make_dependency()
+    func = AsyncMock(side_effect=[Retryable("busy"), "ok"])
+
+    assert asyncio.run(dependency.call_async(func)) == "ok"
+    assert func.await_count == 2
+    assert dependency.snapshot()["retries"] == 1
+
+
+def test_dependency_gives_up_after_max_attempts():
+    dependency = make_dependency(max_attempts=2)
+    func = MagicMock(side_effect=Retryable("busy"))
+
+    with pytest.raises(Retryable):
+        dependency.call(func)
+
+    assert func.call_count == 2
+    assert dependency.snapshot()["failures"] == 1
+
+
+def test_dependency_raises_other_errors_at_once():
+    dependency = make_dependency()
+    func = MagicMock(side_effect=ValueError("bad request"))
+
+    with pytest.raises(ValueError):
+        dependency.call(func)
+
+    func.assert_called_once()
+    assert dependency.breaker.failures == 0
+
+
+def test_dependency_local_errors_leave_health_unchanged():
+    dependency = make_dependency(local_errors=(KeyError,))
+    dependency.breaker.failure_threshold = 2
+    dependency.breaker.record_failure()
+    func = MagicMock(side_effect=KeyError("no slot"))
+
+    with pytest.raises(KeyError):
+        dependency.call(func)
+
+    func.assert_called_once()
+    # Neither a success resetting the failures nor another failure
+    assert dependency.breaker.failures == 1
+    assert dependency.breaker.state == CLOSED
+
+
+def test_dependency_does_not_retry_past_deadline():
+    dependency = Dependency("test", lambda e: True, base_delay=1)
+    func = MagicMock(side_effect=Retryable("busy"))
+
+    with deadline_budget(0.5):
+        with pytest.raises(Retryable):
+            dependency.call(func)
+
+    # The backoff (at least 0.5s) would not fit the budget left
+    func.assert_called_once()
+
+
+def test_dependency_refuses_calls_without_budget():
+    dependency = make_dependency()
+    func = MagicMock()
+
+    with deadline_budget(0):
+        with pytest.raises(DeadlineExceeded):
+            dependency.call(func)
+
+    func.assert_not_called()
+
+
+def test_dependency_fails_fast_when_circuit_open():
+    dependency = make_dependency(max_attempts=1)
+    dependency.breaker.failure_threshold = 1
+    with pytest.raises(Retryable):
+        dependency.call(MagicMock(side_effect=Retryable("down")))
+
+    func = MagicMock()
+    with pytest.raises(CircuitOpenError):
+        dependency.call(func)
+    func.assert_not_called()
+
+
+def test_hedger_returns_fast_answer_without_hedging():
+    hedger = Hedger(hedge_after=1)
+
+    assert hedger.call(lambda: "fast") == "fast"
+    assert hedger.snapshot() == {"hedged": 0, "hedge_wins": 0, "skipped": 0}
+
+
+def test_hedger_hedges_slow_call():
+    hedger = Hedger(hedge_after=0.01)
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            # The first attempt stalls until the test ends
+            release.wait(2)
+            return "slow"
+        return "hedge"
+
+    try:
+        assert hedger.call(call) == "hedge"
+    finally:
+        release.set()
+    assert hedger.snapshot() == {"hedged": 1, "hedge_wins": 1, "skipped": 0}
+
+
+def test_hedger_skips_hedge_without_capacity():
+    hedger = Hedger(hedge_after=0.01)
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        time.sleep(0.05)
+        return "slow"
+
+    assert hedger.call(call, acquire=lambda: None) == "slow"
+    assert len(calls) == 1
+    assert hedger.snapshot()["skipped"] == 1
+
+
+def test_hedger_releases_hedge_capacity():
+    hedger = Hedger(hedge_after=0.01)
+    released = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            release.wait(2)
+        return "answer"
+
+    try:
+        assert hedger.call(call, acquire=lambda: released.set) == "answer"
+    finally:
+        release.set()
+    assert released.wait(2)
+
+
+def test_hedger_runs_attempts_in_callers_context():
+    hedger = Hedger(hedge_after=1)
+
+    with deadline_budget(5):
+        remaining = hedger.call(time_remaining)
+
+    assert remaining is not None and remaining <= 5
+
+
+def test_hedger_raises_when_both_attempts_fail():
+    hedger = Hedger(hedge_after=0.01)
+    calls = []
+
+    def call():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            time.sleep(0.05)
+        raise Retryable(f"attempt {len(calls)}")
+
+    with pytest.raises(Retryable):
+        hedger.call(call)
+    assert len(calls) == 2
@@ -24,6 +24,7 @@ def test_search_prompt_valid_request(
     assert data["blob_urls"] == ["url_1", "url_2", "url_3"]
     assert data["image_ids"] == ["image_1", "image_2", "image_3"]
     assert data["user_id"] == "user123"
+    assert data["skipped_groups"] == []
 
 
 def test_search_prompt_missing_prompt(client):
@@ -234,3 +235,101 @@ def test_regenerate_search_with_existing_queue(
     mock_update_document.assert_called_once_with(
         "user123", "temp_boards", "1", expected_board_doc
     )
+
+
+@patch("routes.search_routes.get_user_id")
+@patch("routes.search_routes.get_user_collection")
+@patch("routes.search_routes.search_database")
+def test_search_prompt_reports_skipped_groups(
+    mock_search, mock_get_collection, mock_get_user_id, client
+):
+    mock_get_user_id.return_value = "user123"
+
+    def search(*args, report=None, **kwargs):
+        report["skipped_groups"] = ["garment"]
+        return ["image_1"], ["url_1"]
+
+    mock_search.side_effect = search
+
+    response = client.post("/api/search-prompt", json={"prompt": "fashion"})
+
+    assert response.status_code == 200
+    assert response.get_json()["skipped_groups"] == ["garment"]
+    assert mock_search.call_args.kwargs["time_budget"] > 0
+
+
+@patch("routes.search_routes.get_user_id")
+@patch("routes.search_routes.get_user_collection")
+@patch("routes.search_routes.search_database")
+def test_search_prompt_explain(
+    mock_search, mock_get_collection, mock_get_user_id, client
+):
+    mock_get_user_id.return_value = "user123"
+
+    def search(*args, report=None, **kwargs):
+        report.update({"embed_ms": 12.5, "groups": {"garment": {"status": "ok"}}})
+        return ["image_1"], ["url_1"]
+
+    mock_search.side_effect = search
+
+    response = client.post(
+        "/api/search-prompt", json={"prompt": "fashion", "debug": "explain"}
+    )
+    assert response.get_json()["explain"] == {
+        "embed_ms": 12.5,
+        "groups": {"garment": {"status": "ok"}},
+    }
+
+    response = client.post("/api/search-prompt?debug=explain", json={"prompt": "x"})
+    assert "explain" in response.get_json()
+
+    response = client.post("/api/search-prompt", json={"prompt": "fashion"})
+    assert "explain" not in response.get_json()
+
+
+@patch("routes.search_routes.insert_documents")
+@patch("routes.search_routes.class_centroids")
+@patch("routes.search_routes.get_user_id")
+@patch("routes.search_routes.get_user_collection")
+@patch("routes.search_routes.search_database_batch")
+def test_search_batch(
+    mock_search_batch,
+    mock_get_collection,
+    mock_get_user_id,
+    mock_class_centroids,
+    mock_insert_documents,
+    client,
+):
+    mock_get_user_id.return_value = "user123"
+    mock_search_batch.return_value = (
+        [(["image_1"], ["url_1"]), (["image_2", "image_3"], ["url_2", "url_3"])],
+        1,
+    )
+
+    response = client.post(
+        "/api/search-batch", json={"prompts": ["theme", "fabric"], "topK": 5}
+    )
+
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["duplicates_removed"] == 1
+    assert [r["prompt"] for r in data["results"]] == ["theme", "fabric"]
+    assert data["results"][1]["image_ids"] == ["image_2", "image_3"]
+    assert mock_search_batch.call_args.kwargs["topK"] == 5
+    # Every prompt gets a temp board for /api/regenerate-search
+    boards = mock_insert_documents.call_args.args[2]
+    assert boards[1] == {
+        "prompt": "fabric",
+        "curr_images": [["image_2", "url_2"], ["image_3", "url_3"]],
+        "queue_images": [],
+    }
+
+
+def test_search_batch_invalid_request(client):
+    assert client.post("/api/search-batch", json={}).status_code == 400
+    assert client.post("/api/search-batch", json={"prompts": []}).status_code == 400
+    assert client.post("/api/search-batch", json={"prompts": [""]}).status_code == 400
+    response = client.post("/api/search-batch", json={"prompts": ["a"] * 11})
+    assert response.status_code == 400
+    response = client.post("/api/search-batch", json={"prompts": ["a"], "topK": 0})
+    assert response.status_code == 400
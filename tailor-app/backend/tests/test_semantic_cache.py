@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+from utils.semantic_cache import SemanticCache
+
+
+def test_lookup_returns_similar_prompt_response():
+    cache = SemanticCache(threshold=0.9)
+    cache.store("basic_chat", [1.0, 0.0, 0.0], "Wear linen.")
+
+    assert cache.lookup("basic_chat", [0.98, 0.1, 0.0]) == "Wear linen."
+    assert cache.lookup("basic_chat", [0.0, 1.0, 0.0]) is None
+    assert cache.stats == {"hits": 1, "misses": 1}
+
+
+def test_lookup_is_scoped_to_namespace():
+    cache = SemanticCache()
+    cache.store("basic_chat", [1.0, 0.0], "Wear linen.")
+
+    assert cache.lookup("expert_mode", [1.0, 0.0]) is None
+
+
+def test_lookup_threshold_override():
+    cache = SemanticCache(threshold=0.99)
+    cache.store("basic_chat", [1.0, 0.0], "Wear linen.")
+
+    assert cache.lookup("basic_chat", [0.9, 0.3]) is None
+    assert cache.lookup("basic_chat", [0.9, 0.3], threshold=0.9) == "Wear linen."
+
+
+def test_entries_expire_after_ttl():
+    cache = SemanticCache(ttl=10)
+    with patch("utils.semantic_cache.time.monotonic", return_value=100):
+        cache.store("basic_chat", [1.0, 0.0], "Wear linen.")
+    with patch("utils.semantic_cache.time.monotonic", return_value=111):
+        assert cache.lookup("basic_chat", [1.0, 0.0]) is None
+
+    assert cache.snapshot()["entries"] == {"basic_chat": 0}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    cache.store("basic_chat", [1.0, 0.0, 0.0], "first")
+    cache.store("basic_chat", [0.0, 1.0, 0.0], "second")
+    # Using the first entry makes the second one the least recently used
+    cache.lookup("basic_chat", [1.0, 0.0, 0.0])
+    cache.store("basic_chat", [0.0, 0.0, 1.0], "third")
+
+    assert cache.lookup("basic_chat", [1.0, 0.0, 0.0]) == "first"
+    assert cache.lookup("basic_chat", [0.0, 1.0, 0.0]) is None
+    assert cache.lookup("basic_chat", [0.0, 0.0, 1.0]) == "third"
+
+
+def test_snapshot_reports_hit_rate():
+    cache = SemanticCache()
+    cache.store("basic_chat", [1.0, 0.0], "Wear linen.")
+    cache.lookup("basic_chat", [1.0, 0.0])
+    cache.lookup("basic_chat", [1.0, 0.0])
+    cache.lookup("basic_chat", [0.0, 1.0])
+
+    snapshot = cache.snapshot()
+    assert snapshot["hit_rate"] == 0.667
+    assert snapshot["entries"] == {"basic_chat": 1}
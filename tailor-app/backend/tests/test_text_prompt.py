@@ -1,8 +1,20 @@
+import json
+import threading
+import time
 from unittest.mock import MagicMock, patch
+import numpy as np
 import pytest
 from bson.objectid import ObjectId
 
-from usecases.text_prompt import search_database, search_class_group
+from usecases.text_prompt import (
+    diversify,
+    explain_report,
+    relevant_groups,
+    search_class_group,
+    search_database,
+    search_database_batch,
+)
+from utils.resilience import deadline_budget
 
 
 @pytest.fixture
@@ -10,7 +22,7 @@ def mock_files_collection():
     return MagicMock()
 
 
-@patch("usecases.text_prompt.co.embed")
+@patch("utils.embeddings.co.embed")
 def test_search_database_success(mock_embed, mock_files_collection):
     mock_embed.return_value.embeddings.float = [0.1, 0.2, 0.3]
 
@@ -39,7 +51,31 @@ def test_search_database_success(mock_embed, mock_files_collection):
     assert set(urls) == {"url1", "url2", "url3", "url4", "url5"}
 
 
-@patch("usecases.text_prompt.co.embed")
+@patch("utils.embeddings.co.embed")
+def test_search_database_without_shuffle_ranks_by_score(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    scores = iter([0.5, 0.9, 0.6, 0.8, 0.7, 0.4])
+
+    def aggregate(pipeline, **options):
+        score = next(scores)
+        return [{"_id": f"file_{score}", "blob_url": "url", "score": score}]
+
+    collection = MagicMock()
+    collection.aggregate.side_effect = aggregate
+
+    ids, _ = search_database(collection, "test prompt", shuffle=False)
+
+    assert ids == [
+        "file_0.9",
+        "file_0.8",
+        "file_0.7",
+        "file_0.6",
+        "file_0.5",
+        "file_0.4",
+    ]
+
+
+@patch("utils.embeddings.co.embed")
 def test_search_database_with_postfilter(mock_embed, mock_files_collection):
     mock_embed.return_value.embeddings.float = [0.1, 0.2, 0.3]
 
@@ -126,7 +162,7 @@ def test_search_class_group_exception_handling(mock_logger, mock_files_collectio
     assert "Error searching test_group" in mock_logger.warning.call_args[0][0]
 
 
-@patch("usecases.text_prompt.co.embed")
+@patch("utils.embeddings.co.embed")
 @patch("usecases.text_prompt.logger")
 def test_search_database_embed_exception(
     mock_logger, mock_embed, mock_files_collection
@@ -143,7 +179,7 @@ def test_search_database_embed_exception(
     mock_files_collection.aggregate.assert_not_called()
 
 
-@patch("usecases.text_prompt.co.embed")
+@patch("utils.embeddings.co.embed")
 @patch("usecases.text_prompt.concurrent.futures.ThreadPoolExecutor")
 @patch("usecases.text_prompt.logger")
 def test_search_database_threadpool_exception(
@@ -156,15 +192,11 @@ def test_search_database_threadpool_exception(
     mock_future = MagicMock()
     mock_future.result.side_effect = Exception("Thread execution error")
 
-    mock_cm = MagicMock()
-    mock_cm.__enter__.return_value = mock_executor
-    mock_executor.return_value = mock_cm
-
-    mock_executor.submit.return_value = mock_future
+    mock_executor.return_value.submit.return_value = mock_future
 
     with patch(
-        "usecases.text_prompt.concurrent.futures.as_completed",
-        return_value=[mock_future],
+        "usecases.text_prompt.concurrent.futures.wait",
+        return_value=({mock_future}, set()),
     ):
         result = search_database(mock_files_collection, prompt)
 
@@ -172,7 +204,7 @@ def test_search_database_threadpool_exception(
         mock_logger.warning.assert_called()
 
 
-@patch("usecases.text_prompt.co.embed")
+@patch("utils.embeddings.co.embed")
 def test_search_database_remaining_results_block(mock_embed, mock_files_collection):
     """Test the remaining_results block in search_database"""
     mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
@@ -250,3 +282,425 @@ def test_search_database_remaining_results_block(mock_embed, mock_files_collecti
     }
 
     assert set(ids).issubset(all_ids)
+
+
+def slow_group_collection(slow_class, release):
+    """A collection whose search of slow_class stalls until release is set."""
+    collection = MagicMock()
+
+    def aggregate(pipeline, **options):
+        classes = pipeline[0]["$vectorSearch"]["filter"]["class"]
+        if classes == slow_class:
+            release.wait(2)
+            return [{"_id": "slow", "blob_url": "url_slow", "score": 0.99}]
+        name = classes if isinstance(classes, str) else classes["$in"][0]
+        return [
+            {"_id": f"{name}_{i}", "blob_url": f"url_{name}_{i}", "score": 0.5}
+            for i in range(3)
+        ]
+
+    collection.aggregate.side_effect = aggregate
+    return collection
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_skips_groups_over_time_budget(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    release = threading.Event()
+    collection = slow_group_collection("garment", release)
+    report = {}
+
+    try:
+        ids, urls = search_database(
+            collection, "test prompt", time_budget=0.1, report=report
+        )
+    finally:
+        release.set()
+
+    # The slow group is dropped and its slots filled from the other groups
+    assert report["pruned_groups"] == []
+    assert report["skipped_groups"] == ["garment"]
+    assert report["groups"]["garment"]["status"] == "skipped"
+    assert len(ids) == 10
+    assert "slow" not in ids
+    # The server is told to stop aggregations the search will not wait for
+    assert collection.aggregate.call_args.kwargs == {"maxTimeMS": 100}
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_without_budget_waits_for_all_groups(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    collection = MagicMock()
+    collection.aggregate.return_value = [{"_id": "a", "blob_url": "url_a"}]
+    report = {}
+
+    search_database(collection, "test prompt", time_budget=0, report=report)
+
+    assert report["skipped_groups"] == []
+    assert report["time_budget"] is None
+    assert collection.aggregate.call_args.kwargs == {}
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_budget_cut_to_request_deadline(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    collection = MagicMock()
+    collection.aggregate.return_value = []
+
+    with deadline_budget(0.5):
+        search_database(collection, "test prompt", time_budget=5)
+
+    assert collection.aggregate.call_args.kwargs["maxTimeMS"] <= 500
+
+
+def test_search_database_skips_every_group_without_deadline_budget():
+    collection = MagicMock()
+    report = {}
+
+    with deadline_budget(0):
+        ids, urls = search_database(
+            collection,
+            "test prompt",
+            time_budget=5,
+            report=report,
+            query_emb=[0.1, 0.2, 0.3],
+        )
+
+    # A used-up deadline must not turn into a search without any limit
+    collection.aggregate.assert_not_called()
+    assert (ids, urls) == ([], [])
+    assert report["skipped_groups"] == list(report["groups"])
+    assert all(g["status"] == "skipped" for g in report["groups"].values())
+
+
+def centroid(vector, count=1):
+    return {"vector": np.asarray(vector, dtype=float), "count": count}
+
+
+def test_relevant_groups_prunes_empty_and_unrelated_groups():
+    centroids = {
+        "fabric": centroid([1.0, 0.0]),
+        "garment": centroid([0.8, 0.6]),
+        "art and film": centroid([0.0, 1.0]),
+    }
+    class_groups = {
+        "garment": {"classes": ["garment"]},
+        "textures_materials": {"classes": ["fabric", "texture"]},
+        "creative_inspiration": {"classes": ["art and film"]},
+        "real_world_fashion": {"classes": ["street style photograph"]},
+    }
+
+    groups = relevant_groups(class_groups, centroids, [1.0, 0.0], min_similarity=0.1)
+
+    # creative_inspiration is unrelated and real_world_fashion has no files
+    assert groups == ["garment", "textures_materials"]
+
+
+def test_relevant_groups_falls_back_to_groups_with_files():
+    class_groups = {
+        "garment": {"classes": ["garment"]},
+        "creative_inspiration": {"classes": ["art and film"]},
+    }
+    centroids = {"art and film": centroid([0.0, 1.0])}
+
+    assert relevant_groups(class_groups, centroids, [1.0, 0.0]) == [
+        "creative_inspiration"
+    ]
+    assert relevant_groups(class_groups, None, [1.0, 0.0]) == list(class_groups)
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_redistributes_pruned_allocations(mock_embed):
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]]
+    collection = MagicMock()
+    collection.aggregate.return_value = [
+        {"_id": f"file{i}", "blob_url": f"url{i}", "score": 0.5} for i in range(20)
+    ]
+    centroids = {"fabric": centroid([1.0, 0.0]), "garment": centroid([0.9, 0.1])}
+    report = {}
+
+    ids, _ = search_database(
+        collection, "linen texture swatches", report=report, centroids=centroids
+    )
+
+    assert collection.aggregate.call_count == 2
+    assert report["pruned_groups"] == [
+        "fashion_representation",
+        "real_world_fashion",
+        "contextual_environmental",
+        "creative_inspiration",
+    ]
+    # garment (0.2) and textures_materials (0.1) now share all 10 slots
+    limits = sorted(
+        c.args[0][0]["$vectorSearch"]["limit"]
+        for c in collection.aggregate.call_args_list
+    )
+    assert limits == [5, 8]
+    assert len(ids) == 10
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_reports_trace(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    collection = MagicMock()
+    collection.aggregate.return_value = [
+        {"_id": "a", "blob_url": "url_a", "score": 0.9},
+        {"_id": "b", "blob_url": "url_b", "score": 0.5},
+        {"_id": "c", "blob_url": "url_c", "score": 0.7},
+    ]
+    report = {}
+
+    search_database(
+        collection,
+        "test prompt",
+        postfilter={"score": {"$gt": 0}},
+        excluded_ids=["6152f9ae1b55674f32db4a1a"],
+        report=report,
+    )
+    search_database(collection, "test prompt", report=report)
+
+    assert report["embed_cache_hit"] is True
+    assert report["results"] == 10
+    garment = report["groups"]["garment"]
+    assert garment["status"] == "ok"
+    assert garment["results"] == 3
+    assert garment["scores"] == {"min": 0.5, "median": 0.7, "max": 0.9}
+    assert garment["pipeline"][0]["$vectorSearch"]["filter"] == {"class": "garment"}
+
+    explained = explain_report(report, full_vectors=False)
+    stage = explained["groups"]["garment"]["pipeline"][0]["$vectorSearch"]
+    assert stage["queryVector"] == "<3 floats>"
+
+
+@patch("utils.embeddings.co.embed")
+def test_explain_report_serializes_excluded_ids(mock_embed):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    collection = MagicMock()
+    collection.aggregate.return_value = []
+    report = {}
+
+    search_database(
+        collection,
+        "test prompt",
+        excluded_ids=["6152f9ae1b55674f32db4a1a"],
+        report=report,
+    )
+
+    explained = explain_report(report)
+    stage = explained["groups"]["garment"]["pipeline"][0]["$vectorSearch"]
+    assert stage["filter"]["_id"] == {"$nin": [{"$oid": "6152f9ae1b55674f32db4a1a"}]}
+    assert stage["queryVector"] == [0.1, 0.2, 0.3]
+
+
+def test_search_class_group_traces_errors(mock_files_collection):
+    mock_files_collection.aggregate.side_effect = Exception("Database error")
+    trace = {}
+
+    search_class_group(
+        mock_files_collection, [0.1], "garment", ["garment"], 5, trace=trace
+    )
+
+    assert trace["status"] == "error"
+    assert trace["error"] == "Database error"
+    assert trace["ms"] >= 0
+
+
+@patch("usecases.text_prompt.slow_search_logger")
+@patch("utils.embeddings.co.embed")
+def test_search_database_logs_slow_searches(mock_embed, mock_slow_logger):
+    mock_embed.return_value.embeddings.float = [[0.1, 0.2, 0.3]]
+    collection = MagicMock()
+    collection.aggregate.return_value = []
+
+    search_database(collection, "fast prompt")
+    mock_slow_logger.warning.assert_not_called()
+
+    collection.aggregate.side_effect = Exception("Database error")
+    search_database(collection, "failing prompt")
+
+    entry = json.loads(mock_slow_logger.warning.call_args[0][0])
+    assert entry["event"] == "slow_search"
+    assert entry["prompt"] == "failing prompt"
+    assert len(entry["slow_groups"]) == 6
+    assert entry["groups"]["garment"]["error"] == "Database error"
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_with_query_vector_and_classes(mock_embed):
+    collection = MagicMock()
+    collection.aggregate.return_value = [{"_id": "a", "blob_url": "url_a"}]
+    report = {}
+
+    search_database(
+        collection,
+        "similar to file_1",
+        query_emb=[0.1, 0.2],
+        classes=["runway", "fabric"],
+        report=report,
+    )
+
+    # The stored vector is used as is, without an embed call
+    mock_embed.assert_not_called()
+    filters = sorted(
+        str(c.args[0][0]["$vectorSearch"]["filter"]["class"])
+        for c in collection.aggregate.call_args_list
+    )
+    assert filters == ["fabric", "runway"]
+    assert report["groups"]["fashion_representation"]["classes"] == ["runway"]
+    stage = collection.aggregate.call_args.args[0][0]["$vectorSearch"]
+    assert stage["queryVector"] == [0.1, 0.2]
+
+
+def test_search_database_classes_outside_groups(mock_files_collection):
+    assert search_database(
+        mock_files_collection, "prompt", query_emb=[0.1], classes=["unknown"]
+    ) == ([], [])
+    mock_files_collection.aggregate.assert_not_called()
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_batch_embeds_once_and_deduplicates(mock_embed):
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0], [0.0, 1.0]]
+
+    def aggregate(pipeline, **options):
+        stage = pipeline[0]["$vectorSearch"]
+        if stage["filter"]["class"] != "garment":
+            return []
+        # "shared" matches the second prompt better than the first
+        if stage["queryVector"] == [1.0, 0.0]:
+            return [
+                {"_id": "shared", "blob_url": "url_shared", "score": 0.6},
+                {"_id": "a", "blob_url": "url_a", "score": 0.9},
+            ]
+        return [
+            {"_id": "shared", "blob_url": "url_shared", "score": 0.8},
+            {"_id": "b", "blob_url": "url_b", "score": 0.7},
+        ]
+
+    collection = MagicMock()
+    collection.aggregate.side_effect = aggregate
+    reports = [{}, {}]
+
+    results, duplicates = search_database_batch(
+        collection, ["theme", "fabric"], topK=2, max_concurrency=2, reports=reports
+    )
+
+    mock_embed.assert_called_once()
+    assert mock_embed.call_args.kwargs["texts"] == ["theme", "fabric"]
+    assert sorted(results[0][0]) == ["a"]
+    assert sorted(results[1][0]) == ["b", "shared"]
+    assert duplicates == 1
+    assert collection.aggregate.call_count == 12
+    assert reports[1]["scores"]["shared"] == 0.8
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_batch_budget_starts_when_group_runs(mock_embed):
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]] * 4
+
+    def aggregate(pipeline, **options):
+        time.sleep(0.05)
+        return [{"_id": ObjectId(), "blob_url": "url", "score": 0.5}]
+
+    collection = MagicMock()
+    collection.aggregate.side_effect = aggregate
+    reports = [{} for _ in range(4)]
+
+    # 24 group searches on 2 threads take 0.6s, each well within the budget
+    results, _ = search_database_batch(
+        collection,
+        ["a", "b", "c", "d"],
+        topK=2,
+        max_concurrency=2,
+        reports=reports,
+        time_budget=0.2,
+    )
+
+    assert [report["skipped_groups"] for report in reports] == [[]] * 4
+    assert all(len(ids) == 2 for ids, _ in results)
+
+
+def candidate(file_id, score, vector):
+    return {
+        "_id": file_id,
+        "blob_url": f"url_{file_id}",
+        "score": score,
+        "embedding": vector,
+    }
+
+
+def test_diversify_drops_near_duplicates():
+    all_results = {
+        "garment": [
+            candidate("a", 0.9, [1.0, 0.0]),
+            candidate("a_copy", 0.89, [0.999, 0.01]),
+        ],
+        "runway": [candidate("b", 0.5, [0.0, 1.0])],
+    }
+
+    diversified, ranks, dropped = diversify(all_results, "embedding")
+
+    assert dropped == 1
+    assert [r["_id"] for r in diversified["garment"]] == ["a"]
+    assert ranks == {"a": 0, "b": 1}
+
+
+def test_diversify_prefers_novel_candidates():
+    all_results = {
+        "garment": [
+            candidate("a", 0.9, [1.0, 0.0]),
+            candidate("a_like", 0.85, [0.8, 0.6]),
+            candidate("other", 0.8, [0.0, 1.0]),
+            {"_id": "no_vector", "blob_url": "url", "score": 0.99},
+        ]
+    }
+
+    diversified, ranks, dropped = diversify(all_results, "embedding", mmr_lambda=0.5)
+
+    # "other" is less relevant than "a_like" but not redundant with "a"
+    assert dropped == 0
+    assert [r["_id"] for r in diversified["garment"]] == [
+        "a",
+        "other",
+        "a_like",
+        "no_vector",
+    ]
+    assert ranks["no_vector"] == 3
+
+
+@patch("utils.embeddings.co.embed")
+def test_search_database_diversifies_deeper_candidates(mock_embed):
+    mock_embed.return_value.embeddings.float = [[1.0, 0.0]]
+
+    def aggregate(pipeline, **options):
+        group = str(pipeline[0]["$vectorSearch"]["filter"]["class"])
+        # Every group returns three shots of the same image and one distinct one
+        return [
+            candidate(f"{group}_{i}", 0.9 - i / 100, [1.0, 0.0]) for i in range(3)
+        ] + [candidate(f"{group}_distinct", 0.5, [0.0, 1.0])]
+
+    collection = MagicMock()
+    collection.aggregate.side_effect = aggregate
+    report = {}
+
+    def garment_stage():
+        return next(
+            c.args[0]
+            for c in collection.aggregate.call_args_list
+            if c.args[0][0]["$vectorSearch"]["filter"]["class"] == "garment"
+        )
+
+    search_database(collection, "test prompt")
+    limit = garment_stage()[0]["$vectorSearch"]["limit"]
+    collection.aggregate.reset_mock()
+
+    ids, _ = search_database(
+        collection, "test prompt", diversify_results=True, report=report
+    )
+
+    stage = garment_stage()
+    assert stage[0]["$vectorSearch"]["limit"] == 2 * limit
+    assert stage[1]["$project"]["embedding"] == 1
+    # The identical shots of all groups collapse into one, as do the distinct ones
+    assert report["diversity"] == {"candidates": 24, "duplicates": 22}
+    assert len(ids) == 2
@@ -0,0 +1,92 @@
+"""
+Describe, classify and extract the colours of an image with the Aya vision model.
+"""
+
+import ast
+import base64
+import logging
+from utils.helpers import VALID_CLASSES
+from utils.cohere_client import VISION_TIMEOUT
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VISION_MODEL = "c4ai-aya-vision-8b"
+
+
+def build_analysis_messages(image_bytes):
+    """
+    Build the chat messages asking for the vibe, class and colours of an image.
+    """
+    # Convert image to base64 for Cohere API
+    image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+    image_url = f"data:image/png;base64,{image_base64}"
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Can you return your answer as a list, with square brackets and quotations but without the indenting and formatting:",
+                },
+                {
+                    "type": "text",
+                    "text": "1. The general vibe in a brief sentence.",
+                },
+                {
+                    "type": "text",
+                    "text": "2. The classification from this list: ('fabric', 'fashion illustration', 'garment', 'historical photograph', 'location photograph', 'nature', 'runway', 'street style photograph', 'texture').",
+                },
+                {
+                    "type": "text",
+                    "text": "3. The main colors in the image, separated by commas.",
+                },
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ],
+        }
+    ]
+
+
+def analyze_image(client, image_bytes):
+    """
+    Analyze an image with Cohere.
+
+    Args:
+        client: Cohere client
+        image_bytes: Raw image data
+
+    Returns:
+        The model's answer, a list literal of [vibe, class, colours]
+    """
+    response = client.chat(
+        model=VISION_MODEL,
+        messages=build_analysis_messages(image_bytes),
+        temperature=0,
+        request_options={"timeout_in_seconds": VISION_TIMEOUT},
+    )
+    return response.message.content[0].text
+
+
+def parse_analysis(analysis):
+    """
+    Parse the model's answer into file metadata.
+
+    Returns:
+        Dict with description, class and colour. The class is left empty when the
+        model answers with something outside VALID_CLASSES.
+    """
+    try:
+        values = ast.literal_eval(analysis.strip())
+        if not isinstance(values, (list, tuple)):
+            raise ValueError("analysis is not a list")
+    except (ValueError, SyntaxError):
+        logger.warning(f"Could not parse image analysis: {analysis}")
+        return {"description": analysis.strip(), "class": "", "colour": ""}
+
+    values = [str(value).strip() for value in values] + ["", "", ""]
+    file_class = values[1].lower()
+    return {
+        "description": values[0],
+        "class": file_class if file_class in VALID_CLASSES else "",
+        "colour": values[2],
+    }
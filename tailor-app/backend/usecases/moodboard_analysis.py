@@ -7,9 +7,7 @@ import random
 import math
 import concurrent.futures
 from bson.objectid import ObjectId
-import cohere
-
-co = cohere.ClientV2()
+from utils.cohere_client import co
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
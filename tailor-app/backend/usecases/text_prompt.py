@@ -2,18 +2,195 @@
 Search in the database for images most relevant to the text prompt based on the image descriptions and/or alt_text.
 """
 
+import os
 import concurrent.futures
+import contextvars
+import json
 import logging
 import random
 import math
-import cohere
+import time
+import numpy as np
+from bson import json_util
 from bson.objectid import ObjectId
-
-co = cohere.ClientV2()
+from utils.class_centroids import class_similarities
+from utils.embedding_models import DEFAULT_EMBEDDING_VERSION, EMBEDDING_VERSIONS
+from utils.embeddings import embed_texts
+from utils.resilience import time_remaining
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Seconds the class group searches of a request may take; groups still running
+# after it are skipped and their slots filled from the others (0 waits for all)
+SEARCH_TIME_BUDGET = float(os.getenv("SEARCH_TIME_BUDGET", "2"))
+
+# Class groups whose closest class centroid is less similar to the query than this
+# are not searched (see utils/class_centroids.py)
+CLASS_GROUP_MIN_SIMILARITY = float(os.getenv("CLASS_GROUP_MIN_SIMILARITY", "0.1"))
+
+# Diversification of search results: each group fetches SEARCH_CANDIDATE_FACTOR
+# times its allocation, candidates at least SEARCH_DUPLICATE_THRESHOLD similar to a
+# better one are dropped, and the rest are ranked by maximal marginal relevance,
+# weighing relevance against redundancy by SEARCH_MMR_LAMBDA (1 is relevance only)
+SEARCH_DIVERSIFY = os.getenv("SEARCH_DIVERSIFY", "True").lower() == "true"
+SEARCH_CANDIDATE_FACTOR = int(os.getenv("SEARCH_CANDIDATE_FACTOR", "2"))
+SEARCH_DUPLICATE_THRESHOLD = float(os.getenv("SEARCH_DUPLICATE_THRESHOLD", "0.95"))
+SEARCH_MMR_LAMBDA = float(os.getenv("SEARCH_MMR_LAMBDA", "0.7"))
+
+# Class group searches run at once by a batch search, across all of its prompts
+BATCH_SEARCH_CONCURRENCY = int(os.getenv("BATCH_SEARCH_CONCURRENCY", "12"))
+
+# Searches slower than SLOW_SEARCH_MS, or with a class group slower than
+# SLOW_SEARCH_GROUP_MS or failing, are written to the slow search log
+SLOW_SEARCH_MS = float(os.getenv("SLOW_SEARCH_MS", "1500"))
+SLOW_SEARCH_GROUP_MS = float(os.getenv("SLOW_SEARCH_GROUP_MS", "750"))
+
+# One JSON object per slow search, so the log can be filtered and parsed on its own
+slow_search_logger = logging.getLogger("slow_search")
+
+
+def elapsed_ms(start):
+    return round(1000 * (time.monotonic() - start), 1)
+
+
+def score_summary(results):
+    scores = sorted(r["score"] for r in results if "score" in r)
+    if not scores:
+        return None
+    return {
+        "min": round(scores[0], 4),
+        "median": round(scores[len(scores) // 2], 4),
+        "max": round(scores[-1], 4),
+    }
+
+
+def explain_report(report, full_vectors=True):
+    """
+    JSON-safe copy of a search_database report. Unless full_vectors is set, the query
+    vectors of the pipelines are replaced by their length.
+    """
+    explained = json.loads(
+        json_util.dumps(report, json_options=json_util.RELAXED_JSON_OPTIONS)
+    )
+    if not full_vectors:
+        for group in explained.get("groups", {}).values():
+            for stage in group.get("pipeline", []):
+                if "$vectorSearch" in stage:
+                    vector = stage["$vectorSearch"]["queryVector"]
+                    stage["$vectorSearch"]["queryVector"] = f"<{len(vector)} floats>"
+    return explained
+
+
+def log_slow_search(prompt, report):
+    slow_groups = [
+        group_name
+        for group_name, group in report["groups"].items()
+        if group.get("status") != "ok" or group.get("ms", 0) >= SLOW_SEARCH_GROUP_MS
+    ]
+    if report["total_ms"] < SLOW_SEARCH_MS and not slow_groups:
+        return
+    slow_search_logger.warning(
+        json.dumps(
+            {
+                "event": "slow_search",
+                "prompt": prompt,
+                "slow_groups": slow_groups,
+                **explain_report(report, full_vectors=False),
+            }
+        )
+    )
+
+
+def group_similarities(class_groups, centroids, query_emb):
+    """
+    Returns:
+        Dict mapping every class group with files to the cosine similarity between
+        query_emb and the closest centroid of its classes
+    """
+    similarities = class_similarities(centroids, query_emb)
+    groups = {}
+    for group_name, group_info in class_groups.items():
+        scores = [similarities[c] for c in group_info["classes"] if c in similarities]
+        if scores:
+            groups[group_name] = max(scores)
+    return groups
+
+
+def relevant_groups(
+    class_groups, centroids, query_emb, min_similarity=CLASS_GROUP_MIN_SIMILARITY
+):
+    """
+    Names of the class groups worth searching for query_emb. Groups without files, or
+    whose classes are all less similar to the query than min_similarity, are left
+    out. If no group reaches min_similarity, every group with files is kept, and
+    without centroids (or files) every group is.
+    """
+    if not centroids:
+        return list(class_groups)
+    similarities = group_similarities(class_groups, centroids, query_emb)
+    relevant = [g for g, score in similarities.items() if score >= min_similarity]
+    return relevant or list(similarities) or list(class_groups)
+
+
+def diversify(
+    all_results,
+    field,
+    duplicate_threshold=SEARCH_DUPLICATE_THRESHOLD,
+    mmr_lambda=SEARCH_MMR_LAMBDA,
+):
+    """
+    Drop near-duplicate candidates and rank the rest by maximal marginal relevance.
+
+    Candidates of all groups are taken greedily by mmr_lambda * score minus
+    (1 - mmr_lambda) * their highest cosine similarity to a candidate already taken.
+    Once a candidate is taken, those at least duplicate_threshold similar to it are
+    dropped. Candidates without a vector in field are kept and ranked last.
+
+    Returns:
+        all_results with each group's candidates filtered and in rank order, the rank
+        of every kept candidate by its ID, and the number of candidates dropped
+    """
+    candidates = [
+        (group_name, result)
+        for group_name, results in all_results.items()
+        for result in results
+        if result.get(field) is not None
+    ]
+    order = []
+    dropped = 0
+    if candidates:
+        vectors = np.array([r[field] for _, r in candidates], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        # Pairwise cosine similarity of all candidates at once
+        similarity = vectors @ vectors.T
+        relevance = np.array([r.get("score", 0) for _, r in candidates])
+        redundancy = np.zeros(len(candidates))
+        available = np.ones(len(candidates), dtype=bool)
+        while available.any():
+            mmr = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            best = int(np.argmax(np.where(available, mmr, -np.inf)))
+            order.append(best)
+            available[best] = False
+            duplicates = available & (similarity[best] >= duplicate_threshold)
+            dropped += int(duplicates.sum())
+            available &= ~duplicates
+            redundancy = np.maximum(redundancy, similarity[best])
+
+    diversified = {group_name: [] for group_name in all_results}
+    for index in order:
+        group_name, result = candidates[index]
+        diversified[group_name].append(result)
+    for group_name, results in all_results.items():
+        diversified[group_name].extend(r for r in results if r.get(field) is None)
+
+    ranked = [candidates[index][1] for index in order] + [
+        r for results in all_results.values() for r in results if r.get(field) is None
+    ]
+    ranks = {str(r["_id"]): rank for rank, r in enumerate(ranked)}
+    return diversified, ranks, dropped
+
 
 def search_class_group(
     files_collection,
@@ -23,6 +200,10 @@ def search_class_group(
     allocation,
     excluded_ids=[],
     postfilter={},
+    path="embedding",
+    max_time_ms=None,
+    trace=None,
+    include_vector=False,
 ):
     """
     Search for a specific class group.
@@ -35,10 +216,17 @@ def search_class_group(
         allocation: Number of results to fetch
         excluded_ids: List of IDs to exclude
         postfilter: Additional filters to apply
+        path: Document field holding the vectors query_emb was embedded for
+        max_time_ms: Time limit of the aggregation on the server, if any
+        trace: Dict receiving the pipeline, its status, time taken, number of
+            results and their score distribution
+        include_vector: Whether to return the stored vectors (under path) too
 
     Returns:
         List of results from the search
     """
+    trace = {} if trace is None else trace
+    start = time.monotonic()
     try:
         # Create the search filter
         search_filter = {}
@@ -57,9 +245,10 @@ def search_class_group(
         # Create the vector search query
         vs_query = {
             "index": "default",
-            "path": "embedding",
+            "path": path,
             "queryVector": query_emb,
-            "numCandidates": 30,
+            # The index must consider at least as many candidates as it returns
+            "numCandidates": max(30, allocation),
             "limit": allocation,
         }
 
@@ -77,20 +266,31 @@ def search_class_group(
                 "class": 1,
             }
         }
+        if include_vector:
+            project["$project"][path] = 1
+
+        # Let the server stop an aggregation the caller will no longer wait for
+        options = {"maxTimeMS": max_time_ms} if max_time_ms else {}
 
+        pipeline = [new_search_query, project]
         # Apply post-filter if present
         if len(postfilter.keys()) > 0:
-            postFilter = {"$match": postfilter}
-            results = list(
-                files_collection.aggregate([new_search_query, project, postFilter])
-            )
-        else:
-            results = list(files_collection.aggregate([new_search_query, project]))
+            pipeline.append({"$match": postfilter})
+        trace["pipeline"] = pipeline
+
+        results = list(files_collection.aggregate(pipeline, **options))
 
+        trace["status"] = "ok"
+        trace["results"] = len(results)
+        trace["scores"] = score_summary(results)
         return results
     except Exception as e:
         logger.warning(f"Error searching {group_name}: {e}")
+        trace["status"] = "error"
+        trace["error"] = str(e)
         return []
+    finally:
+        trace["ms"] = elapsed_ms(start)
 
 
 def search_database(
@@ -99,11 +299,50 @@ def search_database(
     postfilter={},
     excluded_ids=[],
     topK=10,
+    embedding_version=None,
+    time_budget=None,
+    report=None,
+    centroids=None,
+    query_emb=None,
+    classes=None,
+    executor=None,
+    diversify_results=False,
+    shuffle=True,
 ):
     """
     Search the database for the most relevant image descriptions to prompt.
-    Return a list of image ids
+    Return a list of image ids, in random order or, without shuffle, best first
+
+    A query_emb, e.g. the stored vector of a file, is searched as is and prompt only
+    labels the search in the logs. classes restricts the search to those classes.
+    The class group searches run on executor if given, else on a pool of their own.
+
+    With diversify_results, every group fetches SEARCH_CANDIDATE_FACTOR times its
+    allocation, near-duplicate candidates are dropped and the slots are filled in
+    order of maximal marginal relevance (see diversify) instead of by score alone.
+
+    embedding_version is the entry of EMBEDDING_VERSIONS to query, normally the
+    user's active version; it defaults to the default version.
+
+    With a time_budget (seconds), class groups whose search has not finished within
+    the budget of starting, or by the request's deadline, are skipped and their slots
+    filled from the other groups. The names of skipped groups are stored under
+    "skipped_groups" of the report dict, if one is given.
+
+    With the user's class centroids (see utils/class_centroids.py), groups without
+    files or unrelated to the prompt are not searched and their allocation goes to
+    the others; they are reported under "pruned_groups".
+
+    The report also receives a trace of the search: the embed time and cache hit,
+    the group similarities, and per searched group its pipeline, time, results and
+    score distribution (see explain_report), and the score of every result under
+    "scores". Slow searches are logged with it.
     """
+    started = time.monotonic()
+    report = {} if report is None else report
+    embedding_version = (
+        embedding_version or EMBEDDING_VERSIONS[DEFAULT_EMBEDDING_VERSION]
+    )
     # Define class groups and their allocations
     class_groups = {
         "garment": {"classes": ["garment"], "allocation": 0.2},
@@ -123,31 +362,64 @@ def search_database(
         "creative_inspiration": {"classes": ["art and film"], "allocation": 0.1},
     }
 
-    # Normalize allocations to ensure they sum to 1
-    total_allocation = sum(
-        group_info["allocation"] for group_info in class_groups.values()
-    )
-    normalized_allocations = {}
-
-    for group_name, group_info in class_groups.items():
-        # Normalize the allocation
-        normalized_allocations[group_name] = group_info["allocation"] / total_allocation
-
-    # Calculate the number of results to fetch for each group
-    group_allocations = {}
-    for group_name, normalized_allocation in normalized_allocations.items():
-        allocation = math.ceil(topK * normalized_allocation)
-        # Add 1 extra result per group to handle potential shortfalls
-        group_allocations[group_name] = allocation + 1
+    # Narrow every group to the requested classes, dropping groups left without any
+    if classes is not None:
+        class_groups = {
+            group_name: {
+                **group_info,
+                "classes": [c for c in group_info["classes"] if c in classes],
+            }
+            for group_name, group_info in class_groups.items()
+            if any(c in classes for c in group_info["classes"])
+        }
+        if not class_groups:
+            return [], []
 
     try:
-        # Generate embedding for the query once
-        query_emb = co.embed(
-            texts=[prompt],
-            model="embed-english-v3.0",
-            input_type="search_query",
-            embedding_types=["float"],
-        ).embeddings.float[0]
+        # Generate embedding for the query once, unless it was given
+        if query_emb is None:
+            embed_report = {}
+            query_emb = embed_texts(
+                [prompt],
+                input_type="search_query",
+                model=embedding_version["model"],
+                report=embed_report,
+            )[0]
+            report["embed_cache_hit"] = embed_report.get("cache_hits") == 1
+        report["embed_ms"] = elapsed_ms(started)
+
+        # Only search the groups relevant to the query; the allocations below are
+        # normalized over them, so the others' slots are redistributed
+        searched_groups = relevant_groups(class_groups, centroids, query_emb)
+        pruned_groups = [g for g in class_groups if g not in searched_groups]
+        report["group_similarities"] = (
+            group_similarities(class_groups, centroids, query_emb)
+            if centroids
+            else None
+        )
+        class_groups = {g: class_groups[g] for g in searched_groups}
+
+        # Normalize allocations to ensure they sum to 1
+        total_allocation = sum(
+            group_info["allocation"] for group_info in class_groups.values()
+        )
+        normalized_allocations = {}
+
+        for group_name, group_info in class_groups.items():
+            # Normalize the allocation
+            normalized_allocations[group_name] = (
+                group_info["allocation"] / total_allocation
+            )
+
+        # Calculate the number of results to fetch for each group
+        group_allocations = {}
+        for group_name, normalized_allocation in normalized_allocations.items():
+            allocation = math.ceil(topK * normalized_allocation)
+            # Add 1 extra result per group to handle potential shortfalls
+            group_allocations[group_name] = allocation + 1
+            if diversify_results:
+                # Deeper candidates leave room to drop redundant ones
+                group_allocations[group_name] *= SEARCH_CANDIDATE_FACTOR
 
         # # Execute searches for each class group sequentially
         # all_results = {}
@@ -162,30 +434,137 @@ def search_database(
         #         postfilter
         #     )
 
-        # Execute parallel searches for each class group
+        # Execute parallel searches for each class group, waiting at most the time
+        # budget (cut to the request's deadline) for each
+        time_budget = time_budget or None
+        remaining = time_remaining()
+        # With the deadline used up no group is searched; a zero budget would mean
+        # searching without any limit
+        out_of_time = remaining is not None and remaining <= 0
+        if remaining is not None and not out_of_time:
+            time_budget = min(time_budget or remaining, remaining)
+        max_time_ms = math.ceil(1000 * time_budget) if time_budget else None
+
         all_results = {}
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future_to_group = {
-                executor.submit(
-                    search_class_group,
-                    files_collection,
-                    query_emb,
+        skipped_groups = []
+        group_traces = {
+            group_name: {
+                "classes": group_info["classes"],
+                "allocation": group_allocations[group_name],
+            }
+            for group_name, group_info in class_groups.items()
+        }
+        search_started = time.monotonic()
+        # Each group's budget starts when its search does, not when it is queued,
+        # so searches waiting for a thread of a shared executor are not cut short
+        group_started = {}
+
+        def run_group(group_name, *args):
+            group_started[group_name] = time.monotonic()
+            return search_class_group(files_collection, query_emb, group_name, *args)
+
+        search_deadline = (
+            search_started + max(remaining, 0) if remaining is not None else None
+        )
+        if out_of_time:
+            skipped_groups = list(class_groups)
+            for group_name in class_groups:
+                all_results[group_name] = []
+                group_traces[group_name].update(status="skipped", ms=0)
+            class_groups_to_search = {}
+        else:
+            class_groups_to_search = class_groups
+        group_executor = executor or concurrent.futures.ThreadPoolExecutor()
+        try:
+            pending = {
+                group_executor.submit(
+                    run_group,
                     group_name,
                     group_info["classes"],
                     group_allocations[group_name],
                     excluded_ids,
                     postfilter,
+                    embedding_version["field"],
+                    max_time_ms,
+                    group_traces[group_name],
+                    diversify_results,
                 ): group_name
-                for group_name, group_info in class_groups.items()
+                for group_name, group_info in class_groups_to_search.items()
             }
 
-            for future in concurrent.futures.as_completed(future_to_group):
-                group_name = future_to_group[future]
-                try:
-                    all_results[group_name] = future.result()
-                except Exception as e:
-                    logger.warning(f"Error searching {group_name}: {e}")
+            while pending:
+                timeout = None
+                if time_budget:
+                    now = time.monotonic()
+                    # Groups not started yet are checked again after a budget
+                    deadlines = [now + time_budget] + [
+                        group_started[g] + time_budget
+                        for g in pending.values()
+                        if g in group_started
+                    ]
+                    if search_deadline is not None:
+                        deadlines.append(search_deadline)
+                    timeout = max(min(deadlines) - now, 0)
+                done, _ = concurrent.futures.wait(
+                    pending,
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    group_name = pending.pop(future)
+                    try:
+                        all_results[group_name] = future.result()
+                    except Exception as e:
+                        logger.warning(f"Error searching {group_name}: {e}")
+                        all_results[group_name] = []
+                if not time_budget:
+                    continue
+
+                now = time.monotonic()
+                search_over = search_deadline is not None and now >= search_deadline
+                for future, group_name in list(pending.items()):
+                    started_at = group_started.get(group_name)
+                    if not search_over and (
+                        started_at is None or now < started_at + time_budget
+                    ):
+                        continue
+                    # Searches still queued on a shared executor are not started
+                    future.cancel()
+                    del pending[future]
+                    skipped_groups.append(group_name)
                     all_results[group_name] = []
+                    # A copy, as the still running search keeps writing its trace
+                    group_traces[group_name] = {
+                        **dict(group_traces[group_name]),
+                        "status": "skipped",
+                        "ms": elapsed_ms(started_at or search_started),
+                    }
+
+            if skipped_groups:
+                skipped_groups = [g for g in class_groups if g in skipped_groups]
+                logger.warning(
+                    f"Skipped class groups {skipped_groups} after {time_budget}s"
+                )
+        finally:
+            # Do not wait for skipped groups; their threads end with the aggregation
+            if group_executor is not executor:
+                group_executor.shutdown(wait=False, cancel_futures=True)
+
+        report["time_budget"] = time_budget
+        report["search_ms"] = elapsed_ms(search_started)
+        report["groups"] = group_traces
+        report["pruned_groups"] = pruned_groups
+        report["skipped_groups"] = skipped_groups
+
+        # Rank candidates by relevance and novelty; without diversification the
+        # results of each group are already in score order
+        ranks = None
+        if diversify_results:
+            candidates = sum(len(results) for results in all_results.values())
+            all_results, ranks, dropped = diversify(
+                all_results, embedding_version["field"]
+            )
+            report["diversity"] = {"candidates": candidates, "duplicates": dropped}
 
         # Calculate how many results we should take from each group
         total_results = []
@@ -214,12 +593,26 @@ def search_database(
 
             # Take what we need to reach topK
             if remaining_results:
-                # Sort by vector search score to get best remaining matches
-                remaining_results.sort(key=lambda x: x.get("score", 0), reverse=True)
+                # Sort by vector search score (or diversified rank) to get best
+                # remaining matches
+                if ranks:
+                    remaining_results.sort(key=lambda x: ranks[str(x["_id"])])
+                else:
+                    remaining_results.sort(
+                        key=lambda x: x.get("score", 0), reverse=True
+                    )
                 total_results.extend(remaining_results[:remaining_slots])
 
         # Randomize the order of results
-        random.shuffle(total_results)
+        if shuffle:
+            random.shuffle(total_results)
+        else:
+            total_results.sort(key=lambda x: x.get("score", 0), reverse=True)
+
+        report["results"] = len(total_results)
+        report["scores"] = {str(r["_id"]): r.get("score") for r in total_results}
+        report["total_ms"] = elapsed_ms(started)
+        log_slow_search(prompt, report)
 
         # Extract IDs and URLs in the same format as the original function
         ids, urls = [], []
@@ -232,3 +625,81 @@ def search_database(
     except Exception as e:
         logger.warning(e)
         return []
+
+
+def search_database_batch(
+    files_collection,
+    prompts,
+    topK=10,
+    embedding_version=None,
+    max_concurrency=BATCH_SEARCH_CONCURRENCY,
+    reports=None,
+    **kwargs,
+):
+    """
+    Search several prompts at once, e.g. a theme, a fabric and a location.
+
+    The prompts are embedded together in one call and all their class group searches
+    share a pool of max_concurrency threads. A file found for several prompts is only
+    returned for the prompt it scores best on; every prompt fetches twice topK
+    results, so it usually still has topK left afterwards. Other keyword arguments
+    are passed to search_database, and reports receives its report of each prompt.
+
+    Returns:
+        List of (ids, urls) per prompt, and the number of duplicates removed
+    """
+    embedding_version = (
+        embedding_version or EMBEDDING_VERSIONS[DEFAULT_EMBEDDING_VERSION]
+    )
+    reports = [{} for _ in prompts] if reports is None else reports
+    query_embs = embed_texts(
+        list(prompts), input_type="search_query", model=embedding_version["model"]
+    )
+
+    group_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_concurrency, thread_name_prefix="batch-search"
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(prompts)
+        ) as prompt_executor:
+            futures = [
+                # Each search runs in a copy of the caller's context (its deadline)
+                prompt_executor.submit(
+                    contextvars.copy_context().run,
+                    search_database,
+                    files_collection,
+                    prompt,
+                    topK=2 * topK,
+                    embedding_version=embedding_version,
+                    report=report,
+                    query_emb=query_emb,
+                    executor=group_executor,
+                    **kwargs,
+                )
+                for prompt, query_emb, report in zip(prompts, query_embs, reports)
+            ]
+            results = [future.result() or ([], []) for future in futures]
+    finally:
+        group_executor.shutdown(wait=False, cancel_futures=True)
+
+    # Give every file to the prompt it scores best on, the earlier prompt on a tie
+    best = {}
+    for index, report in enumerate(reports):
+        for file_id, score in report.get("scores", {}).items():
+            if file_id not in best or (score or 0) > best[file_id][0]:
+                best[file_id] = (score or 0, index)
+
+    batched = []
+    duplicates = 0
+    for index, (ids, urls) in enumerate(results):
+        kept = [
+            (i, u) for i, u in zip(ids, urls) if best.get(i, (0, index))[1] == index
+        ]
+        duplicates += len(ids) - len(kept)
+        scores = reports[index].get("scores", {})
+        kept.sort(key=lambda pair: scores.get(pair[0]) or 0, reverse=True)
+        kept = kept[:topK]
+        random.shuffle(kept)
+        batched.append(([i for i, _ in kept], [u for _, u in kept]))
+    return batched, duplicates
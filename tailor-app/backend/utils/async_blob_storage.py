@@ -0,0 +1,349 @@
+"""
+Async variant of AzureBlobStorage on azure.storage.blob.aio.
+
+The client runs on an event loop of its own in a background thread, where every
+operation shares one aiohttp connection pool, so many blob transfers overlap without
+holding a worker thread each. Synchronous code (the Flask routes) hands it coroutines
+through run(); async code can await its methods from any event loop. Either way the
+caller's deadline budget applies, and calls go through azure_dependency like those
+of AzureBlobStorage.
+"""
+
+import os
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import logging
+import threading
+import uuid
+from contextlib import nullcontext
+from pathlib import Path
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient
+from utils.blob_storage import (
+    AZURE_CONNECTION_TIMEOUT,
+    AZURE_READ_TIMEOUT,
+    AzureBlobStorage,
+    azure_dependency,
+    azure_timeouts,
+    encode_blob_metadata,
+)
+from utils.resilience import DeadlineExceeded, deadline_budget, time_remaining
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Size of the shared connection pool
+POOL_SIZE = int(os.getenv("AZURE_BLOB_POOL_SIZE", "100"))
+
+
+async def _in_budget(coro, seconds):
+    """
+    Await coro under a deadline budget of seconds (None for no deadline)
+    """
+    with nullcontext() if seconds is None else deadline_budget(seconds):
+        return await coro
+
+
+def on_storage_loop(method):
+    """
+    Run a coroutine method on the storage's own event loop, whichever loop awaits it
+    """
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        loop = self._get_loop()
+        coro = method(self, *args, **kwargs)
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        future = asyncio.run_coroutine_threadsafe(
+            _in_budget(coro, time_remaining()), loop
+        )
+        return await asyncio.wrap_future(future)
+
+    return wrapper
+
+
+class AsyncAzureBlobStorage:
+    def __init__(self, pool_size=POOL_SIZE):
+        # Connection string
+        self.connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        if not self.connection_string:
+            logger.error(
+                "AZURE_STORAGE_CONNECTION_STRING not set in environment variables"
+            )
+            raise ValueError("Azure Storage connection string not configured")
+
+        # Default container for user uploads
+        self.default_container = os.getenv("AZURE_DEFAULT_CONTAINER", "user-uploads")
+
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._blob_service_client = None
+
+    def _get_loop(self):
+        """
+        The storage's event loop, started in a background thread on first use
+        """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="async-blob-storage",
+                    daemon=True,
+                )
+                self._thread.start()
+            return self._loop
+
+    def _get_blob_service_client(self):
+        """
+        Lazily create the service client and its shared aiohttp session. Both are
+        bound to the storage's loop, the only one they are used on.
+        """
+        if self._blob_service_client is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, limit_per_host=self.pool_size
+                )
+            )
+            transport = AioHttpTransport(session=self._session, session_owner=False)
+            # Retries are left to azure_dependency, which keeps them within the deadline
+            self._blob_service_client = BlobServiceClient.from_connection_string(
+                self.connection_string,
+                transport=transport,
+                connection_timeout=AZURE_CONNECTION_TIMEOUT,
+                read_timeout=AZURE_READ_TIMEOUT,
+                retry_total=0,
+            )
+        return self._blob_service_client
+
+    def get_container_client(self, container_name=None):
+        """
+        Get a container client for the specified container or the default one
+        """
+        container = container_name or self.default_container
+        return self._get_blob_service_client().get_container_client(container)
+
+    def run(self, coro):
+        """
+        Run one of this storage's coroutines from synchronous code and return its
+        result, within the caller's deadline budget
+
+        Raises:
+            DeadlineExceeded: The budget ran out before the coroutine finished
+        """
+        remaining = time_remaining()
+        future = asyncio.run_coroutine_threadsafe(
+            _in_budget(coro, remaining), self._get_loop()
+        )
+        try:
+            return future.result(None if remaining is None else max(remaining, 0))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise DeadlineExceeded("Request deadline exceeded calling blob storage")
+
+    @on_storage_loop
+    async def upload_file(
+        self, file_data, original_filename, container_name=None, metadata=None
+    ):
+        """
+        Upload a file to Azure Blob Storage
+
+        Returns:
+            Dict with blob_url, blob_name
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+
+            # Generate a unique blob name to avoid collisions
+            file_extension = Path(original_filename).suffix
+            blob_name = f"{uuid.uuid4()}{file_extension}"
+
+            upload_kwargs = {}
+            if metadata:
+                upload_kwargs["metadata"] = encode_blob_metadata(metadata)
+            await azure_dependency.call_async(
+                lambda: container_client.upload_blob(
+                    name=blob_name,
+                    data=file_data,
+                    overwrite=True,
+                    **upload_kwargs,
+                    **azure_timeouts(),
+                )
+            )
+
+            blob_url = f"{container_client.url}/{blob_name}"
+            logger.info(f"File uploaded successfully: {blob_url}")
+
+            return {
+                "blob_name": blob_name,
+                "blob_url": blob_url,
+                "container": container_client.container_name,
+                "size": len(file_data),
+            }
+
+        except Exception as e:
+            logger.error(f"Error uploading file to Azure Blob Storage: {e}")
+            raise
+
+    @on_storage_loop
+    async def upload_files(self, files, container_name=None):
+        """
+        Upload several files at once over the shared connection pool
+
+        Args:
+            files: Dicts of upload_file's file_data, original_filename and metadata
+            container_name: Optional container name, uses default if not specified
+
+        Returns:
+            One result per file: upload_file's dict, or the exception it raised
+        """
+        return await asyncio.gather(
+            *(
+                self.upload_file(container_name=container_name, **file)
+                for file in files
+            ),
+            return_exceptions=True,
+        )
+
+    @on_storage_loop
+    async def delete_blob(self, blob_name, container_name=None):
+        """
+        Delete a blob from Azure Blob Storage
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            await azure_dependency.call_async(
+                lambda: container_client.delete_blob(blob_name, **azure_timeouts())
+            )
+            logger.info(f"Blob '{blob_name}' deleted successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting blob from Azure Blob Storage: {e}")
+            return False
+
+    @on_storage_loop
+    async def update_blob(self, blob_name, new_file_data, container_name=None):
+        """
+        Update a blob in Azure Blob Storage
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            blob_client = container_client.get_blob_client(blob_name)
+            await azure_dependency.call_async(
+                lambda: blob_client.upload_blob(
+                    new_file_data, overwrite=True, **azure_timeouts()
+                )
+            )
+            logger.info(f"Blob '{blob_name}' updates successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error updating blob in Azure Blob Storage: {e}")
+            return False
+
+    @on_storage_loop
+    async def set_blob_metadata(self, blob_name, metadata, container_name=None):
+        """
+        Replace the metadata of a blob without rewriting its content
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            blob_client = container_client.get_blob_client(blob_name)
+            await azure_dependency.call_async(
+                lambda: blob_client.set_blob_metadata(
+                    metadata=encode_blob_metadata(metadata), **azure_timeouts()
+                )
+            )
+            logger.info(f"Blob '{blob_name}' metadata updated successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob metadata in Azure Blob Storage: {e}")
+            return False
+
+    @on_storage_loop
+    async def set_blob_tags(self, blob_name, tags, container_name=None):
+        """
+        Replace the index tags of a blob without rewriting its content
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            blob_client = container_client.get_blob_client(blob_name)
+            await azure_dependency.call_async(
+                lambda: blob_client.set_blob_tags(tags, **azure_timeouts())
+            )
+            logger.info(f"Blob '{blob_name}' tags updated successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob tags in Azure Blob Storage: {e}")
+            return False
+
+    async def _close_pool(self):
+        if self._blob_service_client is not None:
+            await self._blob_service_client.close()
+        if self._session is not None:
+            await self._session.close()
+        self._blob_service_client = None
+        self._session = None
+
+    def close(self):
+        """
+        Close the shared connection pool and stop the storage's event loop. A later
+        call starts both afresh.
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close_pool(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+_async_blob_storage = None
+_async_blob_storage_lock = threading.Lock()
+
+
+def get_async_blob_storage():
+    """
+    Return the process-wide async blob storage, created on first use
+    """
+    global _async_blob_storage
+    with _async_blob_storage_lock:
+        if _async_blob_storage is None:
+            _async_blob_storage = AsyncAzureBlobStorage()
+            atexit.register(_async_blob_storage.close)
+        return _async_blob_storage
+
+
+def upload_files(storage, files):
+    """
+    Upload several files from synchronous code. Azure uploads overlap on the async
+    client's shared connection pool; other backends upload one file after another.
+
+    Args:
+        storage: The blob storage backend (see utils/blob_storage.py)
+        files: Dicts of upload_file's file_data, original_filename and metadata
+
+    Returns:
+        One result per file: upload_file's dict, or the exception it raised
+    """
+    if isinstance(storage, AzureBlobStorage):
+        async_storage = get_async_blob_storage()
+        return async_storage.run(async_storage.upload_files(files))
+    results = []
+    for file in files:
+        try:
+            results.append(storage.upload_file(**file))
+        except Exception as e:
+            results.append(e)
+    return results
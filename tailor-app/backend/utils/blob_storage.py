@@ -1,9 +1,20 @@
 import os
+import json
 import logging
+import math
+import tempfile
 import uuid
 from pathlib import Path
+from urllib.parse import quote
+from azure.core.exceptions import (
+    HttpResponseError,
+    ServiceRequestError,
+    ServiceResponseError,
+)
 from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
+from werkzeug.security import safe_join
+from utils.resilience import Dependency, call_timeout
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +25,35 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 root_env = BASE_DIR.parent / ".env"
 load_dotenv(dotenv_path=root_env, override=True)
 
+# Seconds to connect to Azure and to wait for a response; per-call timeouts are also
+# cut to the request's deadline budget
+AZURE_CONNECTION_TIMEOUT = float(os.getenv("AZURE_CONNECTION_TIMEOUT", "5"))
+AZURE_READ_TIMEOUT = float(os.getenv("AZURE_READ_TIMEOUT", "20"))
+
+# Statuses worth a retry: request timeout, throttling and server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def is_retryable_azure_error(error):
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    return (
+        isinstance(error, HttpResponseError) and error.status_code in RETRYABLE_STATUSES
+    )
+
+
+def azure_timeouts():
+    """
+    Timeouts of one Azure operation: the server-side timeout and the client's read
+    timeout, both within the deadline budget left.
+    """
+    timeout = call_timeout(AZURE_READ_TIMEOUT)
+    return {"timeout": max(math.ceil(timeout), 1), "read_timeout": timeout}
+
+
+# Retries and circuit breaking of every Azure call (see utils/resilience.py)
+azure_dependency = Dependency("azure", is_retryable_azure_error)
+
 
 class AzureBlobStorage:
     def __init__(self):
@@ -25,8 +65,12 @@ class AzureBlobStorage:
             )
             raise ValueError("Azure Storage connection string not configured")
 
+        # Retries are left to azure_dependency, which keeps them within the deadline
         self.blob_service_client = BlobServiceClient.from_connection_string(
-            self.connection_string
+            self.connection_string,
+            connection_timeout=AZURE_CONNECTION_TIMEOUT,
+            read_timeout=AZURE_READ_TIMEOUT,
+            retry_total=0,
         )
 
         # Default container for user uploads
@@ -39,7 +83,9 @@ class AzureBlobStorage:
         container = container_name or self.default_container
         return self.blob_service_client.get_container_client(container)
 
-    def upload_file(self, file_data, original_filename, container_name=None):
+    def upload_file(
+        self, file_data, original_filename, container_name=None, metadata=None
+    ):
         """
         Upload a file to Azure Blob Storage
 
@@ -47,6 +93,7 @@ class AzureBlobStorage:
             file_data: The file data (e.g., from request.files)
             original_filename: Original filename
             container_name: Optional container name, uses default if not specified
+            metadata: Optional dict of metadata to store alongside the blob
 
         Returns:
             Dict with blob_url, blob_name
@@ -59,8 +106,19 @@ class AzureBlobStorage:
             file_extension = Path(original_filename).suffix
             blob_name = f"{uuid.uuid4()}{file_extension}"
 
-            # Upload the file
-            container_client.upload_blob(name=blob_name, data=file_data, overwrite=True)
+            # Upload the file, mirroring metadata in the same request if given
+            upload_kwargs = {}
+            if metadata:
+                upload_kwargs["metadata"] = encode_blob_metadata(metadata)
+            azure_dependency.call(
+                lambda: container_client.upload_blob(
+                    name=blob_name,
+                    data=file_data,
+                    overwrite=True,
+                    **upload_kwargs,
+                    **azure_timeouts(),
+                )
+            )
 
             # Generate the URL for the uploaded blob
             blob_url = f"{container_client.url}/{blob_name}"
@@ -78,13 +136,33 @@ class AzureBlobStorage:
             logger.error(f"Error uploading file to Azure Blob Storage: {e}")
             raise
 
+    def download_blob(self, blob_name, container_name=None):
+        """
+        Read the content of a blob from Azure Blob Storage
+
+        Returns:
+            The blob's bytes
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            return azure_dependency.call(
+                lambda: container_client.download_blob(
+                    blob_name, **azure_timeouts()
+                ).readall()
+            )
+        except Exception as e:
+            logger.error(f"Error downloading blob from Azure Blob Storage: {e}")
+            raise
+
     def delete_blob(self, blob_name, container_name=None):
         """
         Delete a blob from Azure Blob Storage
         """
         try:
             container_client = self.get_container_client(container_name)
-            container_client.delete_blob(blob_name)
+            azure_dependency.call(
+                lambda: container_client.delete_blob(blob_name, **azure_timeouts())
+            )
             logger.info(f"Blob '{blob_name}' deleted successfully")
             return True
         except Exception as e:
@@ -98,13 +176,243 @@ class AzureBlobStorage:
         try:
             container_client = self.get_container_client(container_name)
             blob_client = container_client.get_blob_client(blob_name)
-            blob_client.upload_blob(new_file_data, overwrite=True)
+            azure_dependency.call(
+                lambda: blob_client.upload_blob(
+                    new_file_data, overwrite=True, **azure_timeouts()
+                )
+            )
             logger.info(f"Blob '{blob_name}' updates successfully")
             return True
         except Exception as e:
             logger.error(f"Error deleting blob from Azure Blob Storage: {e}")
             return False
 
+    def set_blob_metadata(self, blob_name, metadata, container_name=None):
+        """
+        Replace the metadata of a blob without rewriting its content.
+        This is a single header-only request, so it is cheap regardless of blob size.
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            blob_client = container_client.get_blob_client(blob_name)
+            azure_dependency.call(
+                lambda: blob_client.set_blob_metadata(
+                    metadata=encode_blob_metadata(metadata), **azure_timeouts()
+                )
+            )
+            logger.info(f"Blob '{blob_name}' metadata updated successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob metadata in Azure Blob Storage: {e}")
+            return False
+
+    def set_blob_tags(self, blob_name, tags, container_name=None):
+        """
+        Replace the index tags of a blob without rewriting its content.
+        Tags are queryable with find_blobs_by_tags, unlike metadata.
+        """
+        try:
+            container_client = self.get_container_client(container_name)
+            blob_client = container_client.get_blob_client(blob_name)
+            azure_dependency.call(
+                lambda: blob_client.set_blob_tags(tags, **azure_timeouts())
+            )
+            logger.info(f"Blob '{blob_name}' tags updated successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob tags in Azure Blob Storage: {e}")
+            return False
+
+
+class LocalBlobStorage:
+    """
+    Blob storage backed by a local directory, with the same interface as AzureBlobStorage.
+    Used for development, CI and edge nodes without Azure access. Blobs are served by
+    the /api/blobs route, which lets the web server send them with X-Sendfile.
+    """
+
+    METADATA_DIR = ".metadata"
+
+    def __init__(self, root_dir=None, base_url=None):
+        self.root_dir = Path(
+            root_dir or os.getenv("LOCAL_BLOB_ROOT", BASE_DIR / "local_blobs")
+        ).resolve()
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+
+        backend_url = os.getenv("VITE_BACKEND_URL", "http://localhost:8000")
+        self.base_url = (
+            base_url or os.getenv("LOCAL_BLOB_BASE_URL", f"{backend_url}/api/blobs")
+        ).rstrip("/")
+
+        # Default container for user uploads
+        self.default_container = os.getenv("AZURE_DEFAULT_CONTAINER", "user-uploads")
+
+    def get_blob_path(self, blob_name, container_name=None):
+        """
+        Resolve the on-disk path of a blob, or None if the name escapes the container
+        """
+        container = container_name or self.default_container
+        if container.startswith(".") or blob_name.startswith("."):
+            return None
+        path = safe_join(str(self.root_dir), container, blob_name)
+        return Path(path) if path else None
+
+    def _metadata_path(self, blob_name, container_name=None):
+        container = container_name or self.default_container
+        path = safe_join(
+            str(self.root_dir), self.METADATA_DIR, container, f"{blob_name}.json"
+        )
+        return Path(path) if path else None
+
+    @staticmethod
+    def _write_atomic(path, data):
+        # Write to a temporary file first so readers never see a partial blob
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _update_sidecar(self, blob_name, container_name, key, values):
+        path = self._metadata_path(blob_name, container_name)
+        sidecar = json.loads(path.read_text()) if path.exists() else {}
+        sidecar[key] = values
+        self._write_atomic(path, json.dumps(sidecar))
+
+    def upload_file(
+        self, file_data, original_filename, container_name=None, metadata=None
+    ):
+        """
+        Write a file to the local blob directory
+
+        Returns:
+            Dict with blob_url, blob_name
+        """
+        try:
+            container = container_name or self.default_container
+            blob_name = f"{uuid.uuid4()}{Path(original_filename).suffix}"
+            path = self.get_blob_path(blob_name, container)
+            if path is None:
+                raise ValueError(f"Invalid container name: {container}")
+
+            self._write_atomic(path, file_data)
+            if metadata:
+                self._update_sidecar(blob_name, container, "metadata", metadata)
+
+            blob_url = f"{self.base_url}/{container}/{blob_name}"
+            logger.info(f"File stored locally: {path}")
+
+            return {
+                "blob_name": blob_name,
+                "blob_url": blob_url,
+                "container": container,
+                "size": len(file_data),
+            }
+
+        except Exception as e:
+            logger.error(f"Error writing file to local blob storage: {e}")
+            raise
+
+    def download_blob(self, blob_name, container_name=None):
+        """
+        Read the content of a blob from the local blob directory
+
+        Returns:
+            The blob's bytes
+        """
+        try:
+            path = self.get_blob_path(blob_name, container_name)
+            if path is None:
+                raise ValueError(f"Invalid blob name: {blob_name}")
+            return path.read_bytes()
+        except Exception as e:
+            logger.error(f"Error reading blob from local blob storage: {e}")
+            raise
+
+    def delete_blob(self, blob_name, container_name=None):
+        """
+        Delete a blob and its metadata from the local blob directory
+        """
+        try:
+            path = self.get_blob_path(blob_name, container_name)
+            if path is None:
+                raise ValueError(f"Invalid blob name: {blob_name}")
+            path.unlink()
+            metadata_path = self._metadata_path(blob_name, container_name)
+            if metadata_path and metadata_path.exists():
+                metadata_path.unlink()
+            logger.info(f"Blob '{blob_name}' deleted successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting blob from local blob storage: {e}")
+            return False
+
+    def update_blob(self, blob_name, new_file_data, container_name=None):
+        """
+        Replace the content of a blob in the local blob directory
+        """
+        try:
+            path = self.get_blob_path(blob_name, container_name)
+            if path is None:
+                raise ValueError(f"Invalid blob name: {blob_name}")
+            self._write_atomic(path, new_file_data)
+            logger.info(f"Blob '{blob_name}' updates successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error updating blob in local blob storage: {e}")
+            return False
+
+    def set_blob_metadata(self, blob_name, metadata, container_name=None):
+        """
+        Replace the metadata of a blob, stored in a JSON sidecar file
+        """
+        try:
+            self._update_sidecar(blob_name, container_name, "metadata", metadata)
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob metadata in local blob storage: {e}")
+            return False
+
+    def set_blob_tags(self, blob_name, tags, container_name=None):
+        """
+        Replace the index tags of a blob, stored in a JSON sidecar file
+        """
+        try:
+            self._update_sidecar(blob_name, container_name, "tags", tags)
+            return True
+        except Exception as e:
+            logger.error(f"Error setting blob tags in local blob storage: {e}")
+            return False
+
+
+def encode_blob_metadata(metadata):
+    """
+    Make metadata values safe to send as HTTP headers.
+    Azure only accepts ASCII header values, so anything else is percent-encoded.
+    """
+    return {
+        key: quote(str(value), safe=" !#$&'()*+,-./:;=?@_~")
+        for key, value in metadata.items()
+    }
+
+
+def create_blob_storage():
+    """
+    Build the blob storage backend selected by BLOB_STORAGE_BACKEND ("azure" or "local")
+    """
+    backend = os.getenv("BLOB_STORAGE_BACKEND", "azure").lower()
+    if backend == "local":
+        return LocalBlobStorage()
+    if backend != "azure":
+        raise ValueError(f"Unknown BLOB_STORAGE_BACKEND: {backend}")
+    return AzureBlobStorage()
+
 
 # Create a singleton instance
-blob_storage = AzureBlobStorage()
+blob_storage = create_blob_storage()
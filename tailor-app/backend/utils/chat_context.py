@@ -0,0 +1,244 @@
+"""
+Token-budgeted context for multi-turn chat sessions.
+
+The turns of a session are replayed to the chat model newest first for as long as they
+fit the token budget. Once they no longer fit, the older ones are folded into a rolling
+summary (one extra chat call), which is cached per session so later turns only send the
+summary and the turns after it. Prompt size therefore stays bounded however long the
+conversation gets.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from tokenizers import Tokenizer
+from init_mongo import get_user_collection
+from utils.cohere_client import CHAT_TIMEOUT, co
+from utils.conversation_log import conversation_log
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Tokens of history (summary and replayed turns) sent with each prompt
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "2000"))
+# Length cap of a session summary
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "250"))
+# Sessions whose summary is kept in memory
+CHAT_SUMMARY_CACHE_SIZE = int(os.getenv("CHAT_SUMMARY_CACHE_SIZE", "1024"))
+# Local tokenizer.json of the chat model; downloaded from Cohere when not set
+CHAT_TOKENIZER_PATH = os.getenv("CHAT_TOKENIZER_PATH")
+
+# Estimate used when no tokenizer can be loaded
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation between a user and a fashion assistant below for the "
+    "assistant's own reference. Keep the user's preferences, constraints and any "
+    "decisions or recommendations, and drop small talk. Answer with the summary only."
+)
+
+
+class TokenCounter:
+    """
+    Counts tokens with the chat model's tokenizer, loaded on first use. Falls back to
+    a characters-per-token estimate when the tokenizer is unavailable.
+    """
+
+    def __init__(self, model, path=CHAT_TOKENIZER_PATH):
+        self.model = model
+        self.path = path
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if not self._loaded:
+                try:
+                    if self.path:
+                        self._tokenizer = Tokenizer.from_file(self.path)
+                    else:
+                        self._tokenizer = co.fetch_tokenizer(model=self.model)
+                except Exception as e:
+                    logger.warning(f"Estimating token counts, no tokenizer: {e}")
+                self._loaded = True
+        return self._tokenizer
+
+    def count(self, text):
+        if not text:
+            return 0
+        tokenizer = self._tokenizer if self._loaded else self._load()
+        if tokenizer is None:
+            return len(text) // CHARS_PER_TOKEN + 1
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def turn_text(turn):
+    return f"User: {turn['prompt']}\nAssistant: {turn.get('response', '')}"
+
+
+def load_turns(user_id, session_id, after=None):
+    """
+    Turns of a session oldest first, including ones the write-behind conversation log
+    has not written yet.
+
+    Args:
+        after: Only return turns with a later timestamp
+    """
+    query = {"session_id": session_id}
+    if after is not None:
+        query["timestamp"] = {"$gt": after}
+    stored = list(
+        get_user_collection(user_id, "conversations").find(query).sort("timestamp", 1)
+    )
+    stored_ids = {turn["_id"] for turn in stored}
+    buffered = [
+        turn
+        for turn in conversation_log.buffered(user_id)
+        if turn.get("session_id") == session_id
+        and turn["_id"] not in stored_ids
+        and (after is None or turn["timestamp"] > after)
+    ]
+    return sorted(stored + buffered, key=lambda turn: turn["timestamp"])
+
+
+class SessionContext:
+    """
+    Builds chat messages for a session within a token budget, folding turns that no
+    longer fit into a rolling summary cached per session.
+    """
+
+    def __init__(
+        self,
+        model,
+        budget=CHAT_CONTEXT_TOKENS,
+        summary_tokens=CHAT_SUMMARY_TOKENS,
+        cache_size=CHAT_SUMMARY_CACHE_SIZE,
+    ):
+        self.model = model
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.cache_size = cache_size
+        self.tokens = TokenCounter(model)
+        self.stats = {"summaries": 0, "summary_failures": 0}
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_summary(self, key):
+        with self._lock:
+            entry = self._summaries.get(key)
+            if entry:
+                self._summaries.move_to_end(key)
+            return entry
+
+    def _cache_summary(self, key, summary, through):
+        with self._lock:
+            self._summaries[key] = {"summary": summary, "through": through}
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+    def summarize(self, summary, turns):
+        """
+        Fold turns into the previous summary with one chat call.
+        """
+        sections = []
+        if summary:
+            sections.append(f"Summary so far:\n{summary}")
+        sections.append("\n\n".join(turn_text(turn) for turn in turns))
+        response = co.chat(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n\n".join(sections)},
+            ],
+            temperature=0.2,
+            max_tokens=self.summary_tokens,
+            request_options={"timeout_in_seconds": CHAT_TIMEOUT},
+        )
+        self.stats["summaries"] += 1
+        return response.message.content[0].text
+
+    def _roll(self, key, summary, turns):
+        """
+        Summarize the oldest turns so the rest fit half the budget, leaving room for
+        several more turns before the next summary is needed.
+
+        Returns:
+            The new summary and the turns still replayed verbatim
+        """
+        keep_budget = (self.budget - self.summary_tokens) // 2
+        kept, used = [], 0
+        for turn in reversed(turns):
+            used += self.tokens.count(turn_text(turn))
+            if used > keep_budget:
+                break
+            kept.append(turn)
+        kept.reverse()
+        folded = turns[: len(turns) - len(kept)]
+
+        # Fold in chunks that fit the budget so a long uncached history never
+        # produces an oversized summary request
+        chunk, used = [], 0
+        for turn in folded:
+            size = self.tokens.count(turn_text(turn))
+            if chunk and used + size > self.budget:
+                summary = self.summarize(summary, chunk)
+                chunk, used = [], 0
+            chunk.append(turn)
+            used += size
+        summary = self.summarize(summary, chunk)
+
+        self._cache_summary(key, summary, folded[-1]["timestamp"])
+        return summary, kept
+
+    def history(self, user_id, session_id):
+        """
+        Returns:
+            The session summary (or None) and the turns to replay, oldest first
+        """
+        key = (user_id, session_id)
+        cached = self._cached_summary(key)
+        summary = cached["summary"] if cached else None
+        turns = load_turns(user_id, session_id, cached["through"] if cached else None)
+
+        available = self.budget - self.tokens.count(summary)
+        if sum(self.tokens.count(turn_text(turn)) for turn in turns) <= available:
+            return summary, turns
+
+        try:
+            return self._roll(key, summary, turns)
+        except Exception as e:
+            # Without a summary the newest turns that fit are still replayed
+            logger.warning(f"Could not summarize session {session_id}: {e}")
+            self.stats["summary_failures"] += 1
+            kept, used = [], 0
+            for turn in reversed(turns):
+                used += self.tokens.count(turn_text(turn))
+                if used > available:
+                    break
+                kept.append(turn)
+            return summary, kept[::-1]
+
+    def build_messages(self, user_id, session_id, system_prompt, prompt):
+        """
+        Chat messages for the next prompt of a session: the system prompt (with the
+        session summary), the replayed turns, then the prompt.
+        """
+        summary, turns = self.history(user_id, session_id)
+        if summary:
+            system_prompt = (
+                f"{system_prompt}\n\nSummary of the earlier conversation:\n{summary}"
+            )
+        messages = [{"role": "system", "content": system_prompt}]
+        for turn in turns:
+            messages.append({"role": "user", "content": turn["prompt"]})
+            if turn.get("response"):
+                messages.append({"role": "assistant", "content": turn["response"]})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "cached_sessions": len(self._summaries)}
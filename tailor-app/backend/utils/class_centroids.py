@@ -0,0 +1,235 @@
+"""
+Per-user centroids of the stored file vectors of each class.
+
+A user's "centroids" collection holds, for every embedding field and class, the sum
+and count of the vectors of the user's files of that class. Inserting, re-embedding,
+reclassifying or deleting a file adjusts them with $inc, so they stay current
+without rereading the library. Searches compare the query embedding with the
+centroids to skip class groups that are empty or unrelated to the prompt (see
+usecases/text_prompt.py).
+
+The incremental updates are not idempotent: a change that crashes between writing a
+file and updating the centroids, or an update that lands while a rebuild is summing
+the library, leaves them slightly off. Centroids are therefore summed from scratch in
+a background job when they are read and older than CENTROID_REBUILD_INTERVAL, and for
+libraries stored before they existed, which are searched without pruning meanwhile.
+An embedding migration rebuilds them for its new field at cutover.
+"""
+
+import os
+import logging
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from init_mongo import get_user_collection
+from utils.embedding_models import EMBEDDING_VERSIONS
+from utils.jobs import job_queue
+from utils.semantic_cache import normalize
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How long a process keeps using centroids it read before reading them again
+CENTROID_CACHE_TTL = float(os.getenv("CENTROID_CACHE_TTL", "30"))
+# Seconds after which centroids are summed from the whole library again
+CENTROID_REBUILD_INTERVAL = float(os.getenv("CENTROID_REBUILD_INTERVAL", "3600"))
+
+# Marks a centroids collection that was summed from the whole library
+META_ID = "meta"
+
+_centroid_cache = {}
+_centroid_lock = threading.Lock()
+# Users whose rebuild job is queued or running in this process
+_rebuilding = set()
+
+
+def centroid_id(field, file_class):
+    return f"{field}:{file_class}"
+
+
+def _accumulate(sums, documents, sign):
+    """Add sign times the vectors of documents to sums, keyed by (field, class)."""
+    for document in documents:
+        file_class = document.get("class")
+        if not file_class:
+            continue
+        for version in EMBEDDING_VERSIONS.values():
+            vector = document.get(version["field"])
+            if vector is None:
+                continue
+            key = (version["field"], file_class)
+            total, count = sums.get(key, (0.0, 0))
+            sums[key] = (
+                total + sign * np.asarray(vector, dtype=np.float64),
+                count + sign,
+            )
+    return sums
+
+
+def update_centroids(user_id, added=(), removed=()):
+    """
+    Add the vectors of the added documents to the centroids of their classes and take
+    those of the removed documents out. A changed file is passed as both its old
+    (removed) and new (added) version; a retried change then nets out to nothing.
+
+    Failures are only logged: searches just prune with slightly stale centroids.
+    """
+    try:
+        sums = _accumulate({}, added, 1)
+        _accumulate(sums, removed, -1)
+        collection = get_user_collection(user_id, "centroids")
+        for (field, file_class), (total, count) in sums.items():
+            if not count and not np.any(total):
+                continue
+            increments = {f"sum.{i}": float(value) for i, value in enumerate(total)}
+            collection.update_one(
+                {"_id": centroid_id(field, file_class)},
+                {
+                    "$set": {"field": field, "class": file_class},
+                    "$inc": {"count": count, **increments},
+                },
+                upsert=True,
+            )
+    except Exception as e:
+        logger.warning(f"Could not update class centroids of user {user_id}: {e}")
+    clear_centroid_cache(user_id)
+
+
+def rebuild_centroids(user_id):
+    """
+    Sum the centroids of every class and field from the user's whole library.
+
+    Returns:
+        Dict mapping (field, class) to the (sum, count) stored
+    """
+    fields = [version["field"] for version in EMBEDDING_VERSIONS.values()]
+    files = get_user_collection(user_id, "files").find(
+        {"class": {"$nin": ["", None]}}, {"class": 1, **dict.fromkeys(fields, 1)}
+    )
+    sums = {}
+    for document in files:
+        _accumulate(sums, [document], 1)
+
+    collection = get_user_collection(user_id, "centroids")
+    ids = [META_ID]
+    for (field, file_class), (total, count) in sums.items():
+        ids.append(centroid_id(field, file_class))
+        collection.replace_one(
+            {"_id": ids[-1]},
+            {
+                "field": field,
+                "class": file_class,
+                "count": count,
+                "sum": {str(i): float(value) for i, value in enumerate(total)},
+            },
+            upsert=True,
+        )
+    collection.delete_many({"_id": {"$nin": ids}})
+    collection.update_one(
+        {"_id": META_ID}, {"$set": {"built_at": datetime.utcnow()}}, upsert=True
+    )
+    logger.info(f"Rebuilt {len(sums)} class centroids of user {user_id}")
+    clear_centroid_cache(user_id)
+    return sums
+
+
+def _rebuild_job(user_id):
+    try:
+        return {"centroids": len(rebuild_centroids(user_id))}
+    finally:
+        with _centroid_lock:
+            _rebuilding.discard(user_id)
+
+
+job_queue.register("rebuild_centroids", _rebuild_job)
+
+
+def schedule_rebuild(user_id):
+    """
+    Rebuild the user's centroids in a background job, unless one is under way.
+    """
+    with _centroid_lock:
+        if user_id in _rebuilding:
+            return
+        _rebuilding.add(user_id)
+
+    try:
+        job_queue.enqueue(user_id, "rebuild_centroids")
+    except Exception as e:
+        with _centroid_lock:
+            _rebuilding.discard(user_id)
+        logger.warning(f"Could not schedule centroid rebuild of user {user_id}: {e}")
+
+
+def _unit_centroids(sums, field):
+    centroids = {}
+    for (sum_field, file_class), (total, count) in sums.items():
+        if sum_field == field and count > 0:
+            centroids[file_class] = {"vector": normalize(total), "count": count}
+    return centroids
+
+
+def class_centroids(user_id, field):
+    """
+    Returns:
+        Dict mapping every class with files to its unit-length centroid "vector" and
+        file "count", for the vectors stored in field; None if they cannot be read
+        or have never been built (a rebuild is then scheduled)
+    """
+    now = time.monotonic()
+    with _centroid_lock:
+        cached = _centroid_cache.get((user_id, field))
+        if cached and now - cached[0] < CENTROID_CACHE_TTL:
+            return cached[1]
+
+    try:
+        documents = list(get_user_collection(user_id, "centroids").find({}))
+    except Exception as e:
+        logger.warning(f"Could not read class centroids of user {user_id}: {e}")
+        return None
+
+    meta = next((d for d in documents if d["_id"] == META_ID), None)
+    built_at = meta.get("built_at") if meta else None
+    if (
+        built_at is None
+        or (datetime.utcnow() - built_at).total_seconds() >= CENTROID_REBUILD_INTERVAL
+    ):
+        schedule_rebuild(user_id)
+
+    centroids = None
+    if meta:
+        sums = {}
+        for document in documents:
+            if document["_id"] == META_ID:
+                continue
+            total = document.get("sum") or {}
+            sums[(document["field"], document["class"])] = (
+                np.array([total[str(i)] for i in range(len(total))]),
+                document.get("count", 0),
+            )
+        centroids = _unit_centroids(sums, field)
+    with _centroid_lock:
+        _centroid_cache[(user_id, field)] = (now, centroids)
+    return centroids
+
+
+def clear_centroid_cache(user_id=None):
+    with _centroid_lock:
+        if user_id is None:
+            _centroid_cache.clear()
+        else:
+            for key in [k for k in _centroid_cache if k[0] == user_id]:
+                del _centroid_cache[key]
+
+
+def class_similarities(centroids, query_emb):
+    """
+    Returns:
+        Dict mapping each class of centroids to its cosine similarity with query_emb
+    """
+    if not centroids:
+        return {}
+    classes = list(centroids)
+    scores = np.stack([centroids[c]["vector"] for c in classes]) @ normalize(query_emb)
+    return {c: float(score) for c, score in zip(classes, scores)}
@@ -0,0 +1,174 @@
+"""
+Shared Cohere client used by every route, usecase and script.
+
+One client per process means one httpx connection pool. Its keep-alive connections are
+reused across requests, so the TCP and TLS handshakes happen once per connection
+instead of once per module or per request. Connection reuse is measured with
+httpcore trace events and reported by /api/metrics.
+
+Model calls of the shared client are admitted by the ModelScheduler of
+utils/model_scheduler.py, which bounds their concurrency and queues them fairly, and
+run under the deadline, retry and circuit breaker policy of utils/resilience.py.
+"""
+
+import os
+import logging
+import threading
+import cohere
+import httpx
+from cohere.errors import (
+    GatewayTimeoutError,
+    InternalServerError,
+    ServiceUnavailableError,
+    TooManyRequestsError,
+)
+from utils.model_scheduler import ModelQueueTimeout, ScheduledClient, model_scheduler
+from utils.resilience import Dependency, Hedger
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Connection pool limits; keep-alive connections idle longer than the expiry are closed
+COHERE_MAX_CONNECTIONS = int(os.getenv("COHERE_MAX_CONNECTIONS", "50"))
+COHERE_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("COHERE_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+COHERE_KEEPALIVE_EXPIRY = float(os.getenv("COHERE_KEEPALIVE_EXPIRY", "60"))
+
+# Default timeout of a call in seconds, and the per-call timeouts of each kind of call
+COHERE_TIMEOUT = float(os.getenv("COHERE_TIMEOUT", "60"))
+EMBED_TIMEOUT = float(os.getenv("COHERE_EMBED_TIMEOUT", "15"))
+CHAT_TIMEOUT = float(os.getenv("COHERE_CHAT_TIMEOUT", "60"))
+VISION_TIMEOUT = float(os.getenv("COHERE_VISION_TIMEOUT", "120"))
+
+# Milliseconds before a slow embed call is hedged with a second one; 0 disables hedging
+EMBED_HEDGE_AFTER_MS = float(os.getenv("EMBED_HEDGE_AFTER_MS", "1000"))
+
+# Sentinel of a chat stream that ended without events
+_END = object()
+
+
+class ConnectionMetrics:
+    """
+    Count requests against the new connections and TLS handshakes they needed.
+    A request that opened no connection reused a pooled keep-alive connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.new_connections = 0
+            self.tls_handshakes = 0
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self.trace
+
+    def trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+        elif event_name == "connection.start_tls.complete":
+            with self._lock:
+                self.tls_handshakes += 1
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0,
+            }
+
+
+def is_retryable_cohere_error(error):
+    """
+    Rate limiting, server errors, timeouts and dropped connections are worth a retry
+    and count against Cohere's health; other errors (e.g. bad requests) are not.
+    """
+    return isinstance(
+        error,
+        (
+            TooManyRequestsError,
+            InternalServerError,
+            ServiceUnavailableError,
+            GatewayTimeoutError,
+            httpx.TimeoutException,
+            httpx.TransportError,
+        ),
+    )
+
+
+class ResilientClient:
+    """
+    Cohere client wrapper running calls through a Dependency: chat and embed calls
+    are retried within the request deadline and fail fast while Cohere's circuit is
+    open. Only opening a chat stream is retried; a stream that breaks off after
+    events were relayed is not.
+    """
+
+    def __init__(self, client, dependency):
+        self._client = client
+        self._dependency = dependency
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def chat(self, **kwargs):
+        return self._dependency.call(lambda: self._client.chat(**kwargs))
+
+    def embed(self, **kwargs):
+        return self._dependency.call(lambda: self._client.embed(**kwargs))
+
+    def chat_stream(self, **kwargs):
+        def open_stream():
+            stream = iter(self._client.chat_stream(**kwargs))
+            return stream, next(stream, _END)
+
+        stream, first = self._dependency.call(open_stream)
+        if first is not _END:
+            yield first
+            yield from stream
+
+
+def create_cohere_client(metrics=None):
+    """
+    Build a Cohere client on a tuned, keep-alive httpx connection pool.
+    """
+    httpx_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=COHERE_MAX_CONNECTIONS,
+            max_keepalive_connections=COHERE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=COHERE_KEEPALIVE_EXPIRY,
+        ),
+        timeout=COHERE_TIMEOUT,
+        event_hooks={"request": [metrics.on_request]} if metrics else None,
+    )
+    return cohere.ClientV2(
+        api_key=os.getenv("COHERE_API_KEY"),
+        httpx_client=httpx_client,
+        # Cohere passes this to every call, overriding the httpx client default
+        timeout=COHERE_TIMEOUT,
+    )
+
+
+# Shared client, its connection metrics and its resilience policy
+cohere_metrics = ConnectionMetrics()
+# A call that timed out waiting for a slot never reached Cohere
+cohere_dependency = Dependency(
+    "cohere", is_retryable_cohere_error, local_errors=(ModelQueueTimeout,)
+)
+embed_hedger = Hedger(EMBED_HEDGE_AFTER_MS / 1000)
+# Embeds are hedged inside their scheduler slot (see ScheduledClient)
+co = ResilientClient(
+    ScheduledClient(create_cohere_client(cohere_metrics), model_scheduler, embed_hedger),
+    cohere_dependency,
+)
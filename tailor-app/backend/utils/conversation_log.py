@@ -0,0 +1,148 @@
+"""
+Write-behind log of chat turns.
+
+Each turn (prompt and response) is one document in the user's "conversations"
+collection. Documents are buffered and written with insert_many by a background thread,
+so no MongoDB round trip sits on the chat request path. The buffer is flushed every
+flush_interval seconds, as soon as max_batch_size turns are waiting, and at shutdown.
+"""
+
+import os
+import atexit
+import logging
+import threading
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+from init_mongo import get_user_collection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "1"))
+CONVERSATION_FLUSH_SIZE = int(os.getenv("CONVERSATION_FLUSH_SIZE", "100"))
+# Past this many buffered turns, log() writes synchronously instead of buffering
+CONVERSATION_MAX_BUFFERED = int(os.getenv("CONVERSATION_MAX_BUFFERED", "10000"))
+
+
+class ConversationLogWriter:
+    def __init__(
+        self,
+        flush_interval=CONVERSATION_FLUSH_INTERVAL,
+        max_batch_size=CONVERSATION_FLUSH_SIZE,
+        max_buffered=CONVERSATION_MAX_BUFFERED,
+    ):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_buffered = max_buffered
+        self.stats = {"logged": 0, "written": 0, "failed_flushes": 0, "dropped": 0}
+        self._condition = threading.Condition()
+        self._buffer = []
+        self._pid = None
+
+    def _ensure_started(self):
+        # Called with the condition held. Threads do not survive a fork, and turns
+        # buffered by the parent are the parent's to write.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._buffer = []
+        self._thread = threading.Thread(
+            target=self._run, name="conversation-log", daemon=True
+        )
+        self._thread.start()
+
+    def log(self, user_id, document):
+        """
+        Queue a conversation turn for writing.
+
+        Returns:
+            The id the document will be stored under
+        """
+        document = {"_id": ObjectId(), **document}
+        with self._condition:
+            self._ensure_started()
+            self.stats["logged"] += 1
+            overflow = len(self._buffer) >= self.max_buffered
+            if not overflow:
+                self._buffer.append((user_id, document))
+                if len(self._buffer) >= self.max_batch_size:
+                    self._condition.notify()
+
+        if overflow:
+            logger.warning("Conversation log buffer full, writing synchronously")
+            self._write([(user_id, document)], requeue=False)
+        return str(document["_id"])
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # A batch that filled up before this thread started waiting is not
+                # left for the next interval
+                if len(self._buffer) < self.max_batch_size:
+                    self._condition.wait(self.flush_interval)
+                records, self._buffer = self._buffer, []
+            if records:
+                self._write(records)
+
+    def flush(self):
+        """
+        Write every buffered turn now.
+        """
+        with self._condition:
+            records, self._buffer = self._buffer, []
+        if records:
+            self._write(records)
+
+    def _write(self, records, requeue=True):
+        by_user = {}
+        for user_id, document in records:
+            by_user.setdefault(user_id, []).append(document)
+
+        for user_id, documents in by_user.items():
+            try:
+                get_user_collection(user_id, "conversations").insert_many(
+                    documents, ordered=False
+                )
+                written = len(documents)
+            except BulkWriteError as e:
+                # Documents already inserted by an earlier, partly failed flush
+                # come back as duplicate keys and count as written. Any other write
+                # error rejects the document itself (e.g. validation), so writing it
+                # again would fail the same way: it is logged and dropped.
+                errors = e.details.get("writeErrors", [])
+                rejected = [err for err in errors if err["code"] != 11000]
+                written = len(documents) - len(rejected)
+                if rejected:
+                    logger.error(
+                        f"Dropped {len(rejected)} conversation turns of user "
+                        f"{user_id} rejected by MongoDB: {rejected}"
+                    )
+                    with self._condition:
+                        self.stats["failed_flushes"] += 1
+                        self.stats["dropped"] += len(rejected)
+            except Exception as e:
+                # The write itself failed (e.g. a network error); all turns are retried
+                logger.error(f"Could not write conversation turns: {e}")
+                written = 0
+                with self._condition:
+                    self.stats["failed_flushes"] += 1
+                    if requeue:
+                        self._buffer[:0] = [(user_id, doc) for doc in documents]
+            with self._condition:
+                self.stats["written"] += written
+
+    def buffered(self, user_id):
+        """
+        Turns of the user logged but not written yet.
+        """
+        with self._condition:
+            return [document for uid, document in self._buffer if uid == user_id]
+
+    def snapshot(self):
+        with self._condition:
+            return {**self.stats, "buffered": len(self._buffer)}
+
+
+# Shared writer used by the chat routes; buffered turns are drained on shutdown
+conversation_log = ConversationLogWriter()
+atexit.register(conversation_log.flush)
@@ -0,0 +1,21 @@
+"""
+Embedding versions: the model producing the vectors and the file document field (and
+vector index path) they are stored in. Moving a user to another version is done with
+migrate_embeddings.py, which backfills the new field before cutover.
+
+Kept free of other imports so the database layer can read it without loading the
+Cohere client.
+"""
+
+import os
+
+EMBEDDING_VERSIONS = {
+    "v3": {"model": "embed-english-v3.0", "field": "embedding", "dimensions": 1024},
+    "v4": {"model": "embed-v4.0", "field": "embedding_v4", "dimensions": 1536},
+}
+
+# Version used by users that have never been migrated
+DEFAULT_EMBEDDING_VERSION = os.getenv("EMBEDDING_VERSION", "v3")
+
+# Model used for both stored document vectors and search queries
+EMBED_MODEL = EMBEDDING_VERSIONS[DEFAULT_EMBEDDING_VERSION]["model"]
@@ -0,0 +1,111 @@
+"""
+Per-user embedding version state, used to migrate stored vectors to a new model.
+
+Each user's "settings" collection holds an "embedding" document naming the active
+version, which searches read, and, while a backfill runs, the target version whose
+shadow field is being filled. Users without the document are on the default version.
+"""
+
+import os
+import logging
+import threading
+import time
+from datetime import datetime
+from init_mongo import find_documents, get_user_collection
+from utils.embedding_models import DEFAULT_EMBEDDING_VERSION, EMBEDDING_VERSIONS
+from utils.embeddings import document_hash, embed_file_documents
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How long a process keeps using a cached state before reading it again
+EMBEDDING_STATE_TTL = float(os.getenv("EMBEDDING_STATE_TTL", "30"))
+
+_state_cache = {}
+_state_lock = threading.Lock()
+
+
+def get_embedding_state(user_id):
+    """
+    Returns:
+        Dict with the "active" version name and the "target" version name or None
+    """
+    now = time.monotonic()
+    with _state_lock:
+        cached = _state_cache.get(user_id)
+        if cached and now - cached[0] < EMBEDDING_STATE_TTL:
+            return cached[1]
+
+    documents = list(find_documents(user_id, "settings", {"name": "embedding"}))
+    state = {
+        "active": DEFAULT_EMBEDDING_VERSION,
+        "target": None,
+    }
+    if documents:
+        state["active"] = documents[0].get("active", DEFAULT_EMBEDDING_VERSION)
+        state["target"] = documents[0].get("target")
+
+    with _state_lock:
+        _state_cache[user_id] = (now, state)
+    return state
+
+
+def set_embedding_state(user_id, active, target=None):
+    for version in (active, target):
+        if version is not None and version not in EMBEDDING_VERSIONS:
+            raise ValueError(f"Unknown embedding version '{version}'")
+
+    get_user_collection(user_id, "settings").update_one(
+        {"name": "embedding"},
+        {
+            "$set": {
+                "active": active,
+                "target": target,
+                "updated_at": datetime.utcnow(),
+            }
+        },
+        upsert=True,
+    )
+    clear_state_cache(user_id)
+
+
+def clear_state_cache(user_id=None):
+    with _state_lock:
+        if user_id is None:
+            _state_cache.clear()
+        else:
+            _state_cache.pop(user_id, None)
+
+
+def active_embedding_version(user_id):
+    """
+    The version searches must query: its model embeds the prompt and its field is
+    the vector search path. This stays on the old version until cutover.
+    """
+    return EMBEDDING_VERSIONS[get_embedding_state(user_id)["active"]]
+
+
+def embedding_fields(user_id, files):
+    """
+    Embed file metadata dicts for storage.
+
+    Vectors are written for the active version and, while a backfill is running, for
+    its target version too, so files written mid-migration are never missed.
+
+    Returns:
+        List of dicts, one per file, mapping each vector field and "embedding_hash"
+        to the value to store
+    """
+    state = get_embedding_state(user_id)
+    versions = [state["active"]]
+    if state["target"] and state["target"] != state["active"]:
+        versions.append(state["target"])
+
+    fields = [{"embedding_hash": document_hash(f)} for f in files]
+    for version in versions:
+        vectors = embed_file_documents(
+            files, model=EMBEDDING_VERSIONS[version]["model"]
+        )
+        for file_fields, vector in zip(fields, vectors):
+            file_fields[EMBEDDING_VERSIONS[version]["field"]] = vector
+    return fields
@@ -0,0 +1,307 @@
+"""
+Build the embeddings stored on file documents and used by the vector search.
+
+All embed calls go through a shared EmbeddingBatcher, which coalesces the texts of
+concurrent requests into as few Cohere embed calls as possible.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
+from utils.cohere_client import EMBED_TIMEOUT, co
+from utils.embedding_models import EMBED_MODEL
+from utils.model_scheduler import current_caller, model_caller
+from utils.resilience import (
+    DeadlineExceeded,
+    current_deadline,
+    deadline_budget,
+    time_remaining,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Maximum number of texts the Cohere embed endpoint accepts per request
+MAX_EMBED_BATCH = 96
+
+# How long a partially filled batch waits for more texts before it is sent
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+# Number of vectors kept in the in-process embedding cache
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+
+
+def compose_document_text(description, file_class="", colour=""):
+    """
+    Compose the single text that represents a file in the vector index.
+
+    Search only queries the "embedding" field, so every field that should influence
+    relevance is folded into one string and embedded once.
+    """
+    parts = []
+    if description:
+        parts.append(description.strip())
+    if file_class:
+        parts.append(f"Category: {file_class}.")
+    if colour:
+        parts.append(f"Colours: {colour}.")
+    return " ".join(parts)
+
+
+def text_hash(text, input_type="search_document", model=EMBED_MODEL):
+    """
+    Content hash identifying the vector a text embeds to.
+    The model and input type are part of the key since both change the vector.
+    """
+    return hashlib.sha256(f"{model}\0{input_type}\0{text}".encode("utf-8")).hexdigest()
+
+
+def document_hash(file_doc):
+    """
+    Hash of the composed text embedded for a file document.
+    Stored as "embedding_hash" so unchanged metadata can skip re-embedding. Only the
+    text is hashed: whether the vector of the active model exists is checked apart,
+    so an embedding cutover does not re-embed unchanged files.
+    """
+    text = compose_document_text(
+        file_doc.get("description", ""),
+        file_doc.get("class", ""),
+        file_doc.get("colour", ""),
+    )
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of embedding vectors keyed by text hash.
+    """
+
+    def __init__(self, max_size=EMBED_CACHE_SIZE):
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0}
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is None:
+                self.stats["misses"] += 1
+                return None
+            self._vectors.move_to_end(key)
+            self.stats["hits"] += 1
+            return vector
+
+    def put(self, key, vector):
+        with self._lock:
+            self._vectors[key] = vector
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self.max_size:
+                self._vectors.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._vectors.clear()
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching front end for the Cohere embed endpoint.
+
+    Texts submitted by concurrent callers are queued per (model, input_type, lane). A
+    queue is flushed as one embed request once it holds max_batch_size texts or its
+    oldest text has waited max_wait_ms, and each vector is delivered to its caller's
+    future. Queuing per lane keeps interactive queries out of ingestion batches, and
+    the flush is scheduled as the lane (and the user, when all texts are theirs).
+    Each text carries its caller's deadline; a batch is sent under the tightest one.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_batch_size=MAX_EMBED_BATCH,
+        max_wait_ms=EMBED_BATCH_WAIT_MS,
+        flush_workers=4,
+    ):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.flush_workers = flush_workers
+        self.stats = {"texts": 0, "requests": 0}
+        self._condition = threading.Condition()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Called with the condition held. Threads do not survive a fork, so a
+        # worker process (e.g. gunicorn with preload) starts its own.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queues = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.flush_workers, thread_name_prefix="embed-flush"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="embed-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, texts, input_type="search_document", model=EMBED_MODEL):
+        """
+        Queue texts for embedding.
+
+        Returns:
+            List of futures resolving to one float vector per text
+        """
+        futures = [Future() for _ in texts]
+        now = time.monotonic()
+        user_id, lane, _ = current_caller()
+        deadline = current_deadline()
+        with self._condition:
+            self._ensure_started()
+            queue = self._queues.setdefault((model, input_type, lane), [])
+            queue.extend(
+                (now, text, future, user_id, deadline)
+                for text, future in zip(texts, futures)
+            )
+            self._condition.notify()
+        return futures
+
+    def embed(self, texts, input_type="search_document", model=EMBED_MODEL):
+        """
+        Embed texts, blocking until every vector is available or the caller's
+        deadline budget runs out.
+
+        Raises:
+            DeadlineExceeded: The vectors were not ready within the budget
+        """
+        vectors = []
+        for future in self.submit(texts, input_type, model):
+            try:
+                vectors.append(future.result(timeout=time_remaining()))
+            except FutureTimeoutError:
+                raise DeadlineExceeded("Request deadline exceeded waiting to embed")
+        return vectors
+
+    def _take_ready_batches(self, now):
+        batches = []
+        for key, queue in self._queues.items():
+            while queue and (
+                len(queue) >= self.max_batch_size or now - queue[0][0] >= self.max_wait
+            ):
+                batches.append((key, queue[: self.max_batch_size]))
+                del queue[: self.max_batch_size]
+        return batches
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                batches = self._take_ready_batches(now)
+                if not batches:
+                    deadlines = [
+                        q[0][0] + self.max_wait for q in self._queues.values() if q
+                    ]
+                    timeout = max(min(deadlines) - now, 0) if deadlines else None
+                    self._condition.wait(timeout)
+                    continue
+            for key, items in batches:
+                self._executor.submit(self._flush, key, items)
+
+    def _flush(self, key, items):
+        model, input_type, lane = key
+        # Callers whose budget ran out while queued have stopped waiting
+        now = time.monotonic()
+        for _, _, future, _, deadline in items:
+            if deadline is not None and deadline <= now:
+                future.set_exception(
+                    DeadlineExceeded("Request deadline exceeded before embedding")
+                )
+        items = [item for item in items if not item[2].done()]
+        if not items:
+            return
+
+        futures = [future for _, _, future, _, _ in items]
+        users = {user_id for _, _, _, user_id, _ in items}
+        # The batch runs as long as its most patient caller waits; a caller with a
+        # shorter budget gives up on its own future (see embed)
+        deadlines = [deadline for *_, deadline in items]
+        budget = (
+            nullcontext()
+            if None in deadlines
+            else deadline_budget(max(deadlines) - now)
+        )
+        try:
+            with model_caller(users.pop() if len(users) == 1 else None, lane), budget:
+                vectors = self.client.embed(
+                    texts=[text for _, text, _, _, _ in items],
+                    model=model,
+                    input_type=input_type,
+                    embedding_types=["float"],
+                    request_options={"timeout_in_seconds": EMBED_TIMEOUT},
+                ).embeddings.float
+            with self._condition:
+                self.stats["requests"] += 1
+                self.stats["texts"] += len(items)
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+            # Never leave a caller waiting if the response is short
+            for future in futures[len(vectors) :]:
+                future.set_exception(ValueError("Embed response is missing vectors"))
+        except Exception as e:
+            logger.warning(f"Error embedding batch of {len(items)} texts: {e}")
+            for future in futures:
+                future.set_exception(e)
+
+
+# Shared embedding service and cache used by every route
+embedding_service = EmbeddingBatcher(co)
+embedding_cache = EmbeddingCache()
+
+
+def embed_texts(texts, input_type="search_document", model=EMBED_MODEL, report=None):
+    """
+    Embed texts through the shared batching service.
+    Texts embedded before are served from the cache; only the rest reach Cohere.
+    The number of cache hits is stored under "cache_hits" of the report dict, if any.
+
+    Returns:
+        List of float vectors in the same order as texts
+    """
+    keys = [text_hash(text, input_type, model) for text in texts]
+    vectors = [embedding_cache.get(key) for key in keys]
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if report is not None:
+        report["cache_hits"] = len(texts) - len(missing)
+    if missing:
+        embedded = embedding_service.embed(
+            [texts[i] for i in missing], input_type=input_type, model=model
+        )
+        for i, vector in zip(missing, embedded):
+            embedding_cache.put(keys[i], vector)
+            vectors[i] = vector
+
+    return vectors
+
+
+def embed_file_documents(files, model=EMBED_MODEL):
+    """
+    Embed file metadata dicts (description, class, colour) in batched calls.
+
+    Returns:
+        List of float vectors, one per file
+    """
+    texts = [
+        compose_document_text(
+            f.get("description", ""), f.get("class", ""), f.get("colour", "")
+        )
+        for f in files
+    ]
+    return embed_texts(texts, model=model)
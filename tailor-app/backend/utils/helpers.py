@@ -4,6 +4,20 @@ from flask import session
 # Define allowed file extensions for security
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 
+# Define valid file classes
+VALID_CLASSES = {
+    "art and film",
+    "fabric",
+    "fashion illustration",
+    "garment",
+    "historical photograph",
+    "location photograph",
+    "nature",
+    "runway",
+    "street style photograph",
+    "texture",
+}
+
 
 # Define max image size for Aya
 MAX_IMAGE_SIZE = 20 * 1024 * 1024  # 20 MB in bytes
@@ -0,0 +1,248 @@
+"""
+Background job queue for work that should not hold a request worker, such as
+embedding and analysing uploaded files. Job state is persisted in each user's
+"jobs" collection so any worker process can answer status polls.
+
+A job document holds everything needed to run it (its type and details), never the
+work itself, so a job survives the process that queued it: a periodic sweep runs
+pending and running jobs again once they have not moved for JOB_STALE_AFTER seconds,
+e.g. after a worker was restarted mid-job.
+"""
+
+import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from init_mongo import (
+    get_user_collection,
+    insert_document,
+    list_user_ids,
+    update_document,
+)
+from utils.model_scheduler import BACKGROUND, model_caller
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Job statuses
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Seconds after which a pending or running job counts as abandoned, and seconds
+# between sweeps for such jobs
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "900"))
+JOB_SWEEP_INTERVAL = float(os.getenv("JOB_SWEEP_INTERVAL", "300"))
+
+
+class JobQueue:
+    """
+    Run jobs on background worker threads with retries and persisted status.
+
+    Each job type has a handler, registered once per process, that is called with the
+    user id and the job's details as keyword arguments; its return value is stored
+    as the job result. Failed attempts are retried with exponential backoff, and
+    abandoned jobs are run again by the sweep, so handlers must be safe to run more
+    than once. The type's on_failure is called with the user id, the last exception
+    and the details once all attempts are used up.
+    """
+
+    def __init__(
+        self,
+        max_workers=int(os.getenv("JOB_WORKERS", "4")),
+        max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        retry_delay=float(os.getenv("JOB_RETRY_DELAY", "1")),
+    ):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._handlers = {}
+        self._sweeper_pid = None
+
+    def _get_executor(self):
+        # Worker threads do not survive a fork, so each process starts its own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="job-worker"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def register(self, job_type, handler, on_failure=None):
+        """
+        Set the handler of a job type.
+
+        Args:
+            job_type: Short name of the kind of work, e.g. "ingest_file"
+            handler: Callable taking the user id and the job's details as keywords
+            on_failure: Optional callable given the user id, the exception after the
+                last attempt and the details
+        """
+        self._handlers[job_type] = (handler, on_failure)
+
+    def enqueue(self, user_id, job_type, details=None):
+        """
+        Persist a pending job and schedule it on a worker thread.
+
+        Args:
+            user_id: Owner of the job
+            job_type: A registered job type
+            details: Optional dict of the handler's arguments, stored on the job
+                document, e.g. the file id
+
+        Returns:
+            The job id
+        """
+        if job_type not in self._handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        now = datetime.utcnow()
+        job_document = {
+            "type": job_type,
+            "status": PENDING,
+            "attempts": 0,
+            "details": details or {},
+            "created_at": now,
+            "updated_at": now,
+        }
+        job_id = insert_document(user_id, "jobs", job_document)
+        self._get_executor().submit(
+            self._run, user_id, job_id, job_type, details or {}
+        )
+        return job_id
+
+    def requeue_stale_jobs(self, stale_after=JOB_STALE_AFTER):
+        """
+        Run pending and running jobs again that have not moved for stale_after
+        seconds. Each job is claimed with a conditional update, so only one process
+        requeues it.
+
+        Returns:
+            Number of jobs requeued
+        """
+        cutoff = datetime.utcfromtimestamp(time.time() - stale_after)
+        requeued = 0
+        for user_id in list_user_ids("jobs"):
+            collection = get_user_collection(user_id, "jobs")
+            stale_jobs = collection.find(
+                {
+                    "status": {"$in": [PENDING, RUNNING]},
+                    "updated_at": {"$lt": cutoff},
+                    "type": {"$in": list(self._handlers)},
+                }
+            )
+            for job in stale_jobs:
+                claimed = collection.update_one(
+                    {"_id": job["_id"], "updated_at": job["updated_at"]},
+                    {"$set": {"status": PENDING, "updated_at": datetime.utcnow()}},
+                )
+                if not claimed.modified_count:
+                    continue
+                logger.info(f"Requeuing stale {job['type']} job {job['_id']}")
+                self._get_executor().submit(
+                    self._run,
+                    user_id,
+                    str(job["_id"]),
+                    job["type"],
+                    job.get("details", {}),
+                    job.get("attempts", 0),
+                )
+                requeued += 1
+        return requeued
+
+    def _sweep(self, interval):
+        while True:
+            try:
+                self.requeue_stale_jobs()
+            except Exception as e:
+                logger.warning(f"Error sweeping for stale jobs: {e}")
+            time.sleep(interval)
+
+    def start_sweeper(self, interval=JOB_SWEEP_INTERVAL):
+        """
+        Sweep for stale jobs now and every interval seconds on a daemon thread,
+        once per process.
+        """
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(
+            target=self._sweep, args=(interval,), name="job-sweeper", daemon=True
+        ).start()
+
+    def _run(self, user_id, job_id, job_type, details, attempts_used=0):
+        handler, on_failure = self._handlers[job_type]
+        # A job abandoned during its last attempt is not run again
+        if attempts_used >= self.max_attempts:
+            self._fail(
+                user_id,
+                job_id,
+                RuntimeError("Job was abandoned during its last attempt"),
+                on_failure,
+                details,
+            )
+            return
+        for attempt in range(attempts_used + 1, self.max_attempts + 1):
+            try:
+                update_document(
+                    user_id,
+                    "jobs",
+                    job_id,
+                    {
+                        "status": RUNNING,
+                        "attempts": attempt,
+                        "started_at": datetime.utcnow(),
+                        "updated_at": datetime.utcnow(),
+                    },
+                )
+                # Model calls of jobs queue behind interactive requests
+                with model_caller(user_id, BACKGROUND):
+                    result = handler(user_id, **details)
+                update_document(
+                    user_id,
+                    "jobs",
+                    job_id,
+                    {
+                        "status": COMPLETED,
+                        "result": result,
+                        "finished_at": datetime.utcnow(),
+                        "updated_at": datetime.utcnow(),
+                    },
+                )
+                return
+            except Exception as e:
+                logger.warning(f"Job {job_id} attempt {attempt} failed: {e}")
+                if attempt < self.max_attempts:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                    continue
+                self._fail(user_id, job_id, e, on_failure, details)
+
+    def _fail(self, user_id, job_id, error, on_failure, details):
+        logger.error(f"Job {job_id} failed: {error}", exc_info=error)
+        update_document(
+            user_id,
+            "jobs",
+            job_id,
+            {
+                "status": FAILED,
+                "error": str(error),
+                "finished_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+            },
+        )
+        if on_failure:
+            try:
+                on_failure(user_id, error, **details)
+            except Exception as failure_error:
+                logger.error(f"Error handling failure of job {job_id}: {failure_error}")
+
+
+# Shared queue used by every route
+job_queue = JobQueue()
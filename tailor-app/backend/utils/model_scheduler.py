@@ -0,0 +1,330 @@
+"""
+Admission control for outbound Cohere model calls.
+
+Every chat, chat_stream and embed call of the shared client waits for a slot of the
+ModelScheduler, which caps calls in flight globally and per model. Waiting calls are
+admitted by priority lane first (interactive requests before background ingestion) and
+then by weighted fair queuing across users, so one user's bulk upload cannot take every
+slot while others wait. Background calls can only hold a share of the slots, keeping
+headroom for interactive calls.
+
+The caller (user and lane) of a call is taken from a context variable: app.py starts
+every request as the session user in the interactive lane, and model_caller() is set
+around jobs and scripts. Threads running work for a request (pipeline stages, embed
+batches) carry the caller with a copy of the request's context; code with no caller
+is background work.
+"""
+
+import os
+import contextvars
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from utils.resilience import call_timeout, time_remaining
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Priority lanes, highest first
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BACKGROUND)
+
+# Calls in flight across all models
+COHERE_MAX_CONCURRENCY = int(os.getenv("COHERE_MAX_CONCURRENCY", "16"))
+# Per-model caps as "model=limit" pairs, e.g. "c4ai-aya-vision-8b=4,embed-v4.0=8"
+COHERE_MODEL_CONCURRENCY = os.getenv("COHERE_MODEL_CONCURRENCY", "c4ai-aya-vision-8b=4")
+# Share of the global slots background calls may hold at once
+COHERE_BACKGROUND_SHARE = float(os.getenv("COHERE_BACKGROUND_SHARE", "0.75"))
+# Seconds a call may wait for a slot before failing
+COHERE_QUEUE_TIMEOUT = float(os.getenv("COHERE_QUEUE_TIMEOUT", "30"))
+
+# Queue times kept per lane for the metrics
+QUEUE_TIME_SAMPLES = 1000
+
+_caller = contextvars.ContextVar("model_caller", default=None)
+
+
+class ModelQueueTimeout(Exception):
+    """Raised when a model call waited longer than the queue timeout for a slot."""
+
+
+def parse_model_limits(value):
+    limits = {}
+    for pair in filter(None, (p.strip() for p in value.split(","))):
+        model, limit = pair.split("=")
+        limits[model.strip()] = int(limit)
+    return limits
+
+
+def start_model_caller(user_id, lane=INTERACTIVE, weight=1.0):
+    """
+    Attribute the model calls of the current context to a user and lane. A user with
+    twice the weight gets twice the share of contended slots.
+
+    Returns:
+        Token for end_model_caller
+    """
+    return _caller.set((user_id, lane, weight))
+
+
+def end_model_caller(token):
+    _caller.reset(token)
+
+
+@contextmanager
+def model_caller(user_id, lane=INTERACTIVE, weight=1.0):
+    """
+    Attribute the model calls made inside the block to a user and lane.
+    """
+    token = start_model_caller(user_id, lane, weight)
+    try:
+        yield
+    finally:
+        end_model_caller(token)
+
+
+def current_caller():
+    """
+    Returns:
+        (user_id, lane, weight) of the calling code
+    """
+    return _caller.get() or (None, BACKGROUND, 1.0)
+
+
+class ModelScheduler:
+    def __init__(
+        self,
+        max_concurrency=COHERE_MAX_CONCURRENCY,
+        model_limits=None,
+        background_share=COHERE_BACKGROUND_SHARE,
+        queue_timeout=COHERE_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.model_limits = (
+            parse_model_limits(COHERE_MODEL_CONCURRENCY)
+            if model_limits is None
+            else model_limits
+        )
+        self.background_limit = max(math.ceil(max_concurrency * background_share), 1)
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._reset()
+
+    def _reset(self):
+        self._waiting = []
+        self._in_flight = 0
+        self._model_in_flight = {}
+        self._lane_in_flight = dict.fromkeys(LANES, 0)
+        # Self-clocked fair queuing: the virtual time is the finish tag of the last
+        # admitted call and each user's calls are tagged after their previous one
+        self._virtual_time = 0.0
+        self._finish_tags = {}
+        self._queue_times = {lane: deque(maxlen=QUEUE_TIME_SAMPLES) for lane in LANES}
+        self._admitted = dict.fromkeys(LANES, 0)
+        self._timeouts = dict.fromkeys(LANES, 0)
+
+    def reset(self):
+        with self._condition:
+            self._reset()
+
+    def _has_capacity(self, ticket):
+        limit = self.model_limits.get(ticket["model"])
+        if limit is not None and self._model_in_flight.get(ticket["model"], 0) >= limit:
+            return False
+        if ticket["lane"] == BACKGROUND:
+            return self._lane_in_flight[BACKGROUND] < self.background_limit
+        return True
+
+    def _next_ticket(self):
+        if self._in_flight >= self.max_concurrency:
+            return None
+        eligible = [t for t in self._waiting if self._has_capacity(t)]
+        if not eligible:
+            return None
+        return min(
+            eligible,
+            key=lambda t: (LANES.index(t["lane"]), t["finish"], t["sequence"]),
+        )
+
+    def _admit(self, ticket):
+        self._waiting.remove(ticket)
+        self._in_flight += 1
+        self._model_in_flight[ticket["model"]] = (
+            self._model_in_flight.get(ticket["model"], 0) + 1
+        )
+        self._lane_in_flight[ticket["lane"]] += 1
+        self._virtual_time = max(self._virtual_time, ticket["finish"])
+        # A tag at or behind the virtual time no longer affects the user's next call
+        if self._finish_tags.get(ticket["user_id"], 0) <= self._virtual_time:
+            self._finish_tags.pop(ticket["user_id"], None)
+        self._admitted[ticket["lane"]] += 1
+        self._queue_times[ticket["lane"]].append(time.monotonic() - ticket["queued_at"])
+
+    def _release(self, ticket):
+        with self._condition:
+            self._in_flight -= 1
+            self._model_in_flight[ticket["model"]] -= 1
+            self._lane_in_flight[ticket["lane"]] -= 1
+            self._condition.notify_all()
+
+    def try_acquire(self, model, cost=1.0):
+        """
+        Take a slot for one call to model only if one is free and no call is waiting.
+
+        Returns:
+            Callable releasing the slot, or None if none was taken
+        """
+        user_id, lane, weight = current_caller()
+        with self._condition:
+            if self._waiting or self._in_flight >= self.max_concurrency:
+                return None
+            ticket = {
+                "model": model,
+                "user_id": user_id,
+                "lane": lane,
+                "finish": max(self._virtual_time, self._finish_tags.get(user_id, 0))
+                + cost / weight,
+                "sequence": next(self._sequence),
+                "queued_at": time.monotonic(),
+            }
+            if not self._has_capacity(ticket):
+                return None
+            self._finish_tags[user_id] = ticket["finish"]
+            self._waiting.append(ticket)
+            self._admit(ticket)
+        return lambda: self._release(ticket)
+
+    @contextmanager
+    def slot(self, model, cost=1.0):
+        """
+        Hold a slot for one call to model for the duration of the block.
+
+        Raises:
+            ModelQueueTimeout: No slot became free within the queue timeout
+        """
+        user_id, lane, weight = current_caller()
+        now = time.monotonic()
+        # Waiting for a slot counts against the request's deadline budget
+        remaining = time_remaining()
+        deadline = now + (
+            self.queue_timeout
+            if remaining is None
+            else min(self.queue_timeout, remaining)
+        )
+        with self._condition:
+            start = max(self._virtual_time, self._finish_tags.get(user_id, 0))
+            ticket = {
+                "model": model,
+                "user_id": user_id,
+                "lane": lane,
+                "finish": start + cost / weight,
+                "sequence": next(self._sequence),
+                "queued_at": now,
+            }
+            self._finish_tags[user_id] = ticket["finish"]
+            self._waiting.append(ticket)
+
+            while self._next_ticket() is not ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    self._timeouts[lane] += 1
+                    raise ModelQueueTimeout(
+                        f"No {model} slot free after {self.queue_timeout:.0f}s"
+                    )
+                self._condition.wait(remaining)
+            self._admit(ticket)
+            # Another waiter may fit in the capacity still free
+            self._condition.notify_all()
+
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def snapshot(self):
+        with self._condition:
+            lanes = {}
+            for lane in LANES:
+                samples = sorted(self._queue_times[lane])
+                lanes[lane] = {
+                    "waiting": sum(1 for t in self._waiting if t["lane"] == lane),
+                    "in_flight": self._lane_in_flight[lane],
+                    "admitted": self._admitted[lane],
+                    "timeouts": self._timeouts[lane],
+                    "queue_ms_mean": (
+                        round(1000 * sum(samples) / len(samples), 1) if samples else 0
+                    ),
+                    "queue_ms_p95": (
+                        round(1000 * samples[int(0.95 * (len(samples) - 1))], 1)
+                        if samples
+                        else 0
+                    ),
+                }
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "models": dict(self._model_in_flight),
+                "lanes": lanes,
+            }
+
+
+def with_deadline(kwargs):
+    """
+    Cut the timeout of a Cohere call to the deadline budget left once it has a slot.
+    """
+    if time_remaining() is None:
+        return kwargs
+    options = dict(kwargs.get("request_options") or {})
+    options["timeout_in_seconds"] = call_timeout(
+        options.get("timeout_in_seconds", float("inf"))
+    )
+    return {**kwargs, "request_options": options}
+
+
+class ScheduledClient:
+    """
+    Cohere client wrapper admitting chat, chat_stream and embed calls through a
+    ModelScheduler. Every other attribute is the wrapped client's.
+
+    Embed calls, which are idempotent, can be hedged (see utils/resilience.py). The
+    hedge timer starts once the call holds its slot, so time spent queued never
+    triggers a hedge, and the hedge only runs if a second slot is free at once.
+    """
+
+    def __init__(self, client, scheduler, hedger=None):
+        self._client = client
+        self._scheduler = scheduler
+        self._hedger = hedger
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def chat(self, **kwargs):
+        with self._scheduler.slot(kwargs.get("model")):
+            return self._client.chat(**with_deadline(kwargs))
+
+    def embed(self, **kwargs):
+        model = kwargs.get("model")
+        with self._scheduler.slot(model):
+            if self._hedger is None:
+                return self._client.embed(**with_deadline(kwargs))
+            return self._hedger.call(
+                lambda: self._client.embed(**with_deadline(kwargs)),
+                acquire=lambda: self._scheduler.try_acquire(model),
+            )
+
+    def chat_stream(self, **kwargs):
+        # The slot is held until the stream is consumed or closed
+        with self._scheduler.slot(kwargs.get("model")):
+            yield from self._client.chat_stream(**with_deadline(kwargs))
+
+
+# Shared scheduler of the Cohere client (see utils/cohere_client.py)
+model_scheduler = ModelScheduler()
@@ -0,0 +1,101 @@
+"""
+A small dependency-driven pipeline for running independent I/O-bound steps concurrently.
+"""
+
+import concurrent.futures
+import contextvars
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    Run named stages on a thread pool as soon as the stages they depend on have finished.
+
+    Each stage function is called with the results of its dependencies as keyword
+    arguments. If any stage fails, pending stages are cancelled and the compensation
+    handler of every stage that did complete is called with its result, in reverse
+    completion order, before the original exception is re-raised.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name, func, depends_on=(), compensate=None):
+        """
+        Register a stage.
+
+        Args:
+            name: Unique name of the stage, also the key of its result
+            func: Callable receiving the dependency results as keyword arguments
+            depends_on: Names of the stages that must finish first
+            compensate: Optional callable to undo the stage, given its result
+        """
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Unknown dependency '{dependency}' for '{name}'")
+        self.stages[name] = {
+            "func": func,
+            "depends_on": tuple(depends_on),
+            "compensate": compensate,
+        }
+        return self
+
+    def run(self, executor):
+        """
+        Execute every stage on the given executor.
+
+        Returns:
+            Dict of stage name to result
+        """
+        results = {}
+        completed = []
+        running = {}
+        waiting = dict(self.stages)
+
+        try:
+            while waiting or running:
+                # Submit every stage whose dependencies are all satisfied
+                for name, stage in list(waiting.items()):
+                    if all(dep in results for dep in stage["depends_on"]):
+                        kwargs = {dep: results[dep] for dep in stage["depends_on"]}
+                        # Stages run in a copy of the caller's context, so model
+                        # calls keep the request's deadline and model caller
+                        future = executor.submit(
+                            contextvars.copy_context().run, stage["func"], **kwargs
+                        )
+                        running[future] = name
+                        del waiting[name]
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    completed.append(name)
+        except Exception:
+            # Stages that can still complete must be awaited so they can be undone
+            for future, name in running.items():
+                if not future.cancel() and self.stages[name]["compensate"]:
+                    try:
+                        results[name] = future.result()
+                        completed.append(name)
+                    except Exception:
+                        pass
+            self._compensate(completed, results)
+            raise
+
+        return results
+
+    def _compensate(self, completed, results):
+        for name in reversed(completed):
+            compensate = self.stages[name]["compensate"]
+            if compensate is None:
+                continue
+            try:
+                compensate(results[name])
+            except Exception as e:
+                logger.error(f"Error compensating pipeline stage {name}: {e}")
@@ -0,0 +1,332 @@
+"""
+Deadlines, retries and circuit breaking for outbound calls (Cohere and Azure).
+
+A request gets a deadline budget when it starts (see app.py). Every outbound call
+clamps its timeout to the budget left, and failed calls are retried with jittered
+exponential backoff only while the budget still covers the wait. Each dependency has
+a circuit breaker. After a run of consecutive failures it fails calls immediately for
+reset_timeout seconds, then lets a single trial call through to probe recovery.
+Idempotent calls can also be hedged: if the first attempt is slow, a second one is
+sent and whichever answers first wins.
+"""
+
+import os
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds a request may spend, including every outbound call and retry. Below
+# gunicorn's 30s worker timeout, so the request can still answer with an error.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "25"))
+# Consecutive failures that open a circuit, and seconds it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the request's deadline budget is used up before a call."""
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose circuit is open."""
+
+
+def start_deadline(seconds=REQUEST_DEADLINE):
+    """
+    Give the current context a deadline budget; a tighter existing one is kept.
+
+    Returns:
+        Token for end_deadline
+    """
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    return _deadline.set(deadline if current is None else min(current, deadline))
+
+
+def end_deadline(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline_budget(seconds):
+    token = start_deadline(seconds)
+    try:
+        yield
+    finally:
+        end_deadline(token)
+
+
+def current_deadline():
+    """
+    Returns:
+        Monotonic time the deadline budget runs out, or None without a deadline
+    """
+    return _deadline.get()
+
+
+def time_remaining():
+    """
+    Returns:
+        Seconds left of the deadline budget, or None without a deadline
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def call_timeout(default):
+    """
+    Timeout of a call: its default, cut to the budget left.
+
+    Raises:
+        DeadlineExceeded: No budget is left
+    """
+    remaining = time_remaining()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return min(default, remaining)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.stats = {"rejected": 0, "opened": 0}
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: The circuit is open, or its trial call is under way
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            # A trial call that never reported back is replaced after another
+            # reset_timeout, so the circuit cannot stay half open
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Circuit of {self.name} opened")
+                    self.stats["opened"] += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, **self.stats}
+
+
+class Dependency:
+    """
+    An outbound dependency: calls pass its circuit breaker and are retried on the
+    errors is_retryable accepts, with jittered backoff, while the deadline allows.
+    Other errors (e.g. a bad request) are raised at once and do not count against
+    the dependency's health. Neither do local_errors, raised before a call reached
+    the dependency (e.g. while waiting for a model slot); they leave it unchanged.
+    """
+
+    def __init__(
+        self, name, is_retryable, max_attempts=3, base_delay=0.25, local_errors=()
+    ):
+        self.name = name
+        self.is_retryable = is_retryable
+        self.local_errors = tuple(local_errors)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.breaker = CircuitBreaker(name)
+        self.stats = {"calls": 0, "retries": 0, "failures": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _before_attempt(self):
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"Request deadline exceeded calling {self.name}")
+        self.breaker.before_call()
+
+    def _retry_delay(self, error, attempt, attempts):
+        """
+        Record a failed attempt and decide whether to retry it.
+
+        Returns:
+            Seconds to wait before the next attempt, or None to raise error
+        """
+        if isinstance(error, (DeadlineExceeded, CircuitOpenError, *self.local_errors)):
+            return None
+        if not self.is_retryable(error):
+            self.breaker.record_success()
+            return None
+        self.breaker.record_failure()
+        delay = self.base_delay * 2**attempt * (0.5 + random.random())
+        remaining = time_remaining()
+        if attempt == attempts - 1 or (remaining is not None and delay >= remaining):
+            self._count("failures")
+            return None
+        logger.warning(f"{self.name} call failed ({error}), retrying in {delay:.2f}s")
+        self._count("retries")
+        return delay
+
+    def call(self, func, retry=True):
+        """
+        Call func (taking no arguments) under the breaker and retry policy.
+        """
+        attempts = self.max_attempts if retry else 1
+        self._count("calls")
+        for attempt in range(attempts):
+            self._before_attempt()
+            try:
+                result = func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, attempts)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def call_async(self, func, retry=True):
+        """
+        Await func (a coroutine function taking no arguments) under the breaker and
+        retry policy, backing off without blocking the event loop.
+        """
+        attempts = self.max_attempts if retry else 1
+        self._count("calls")
+        for attempt in range(attempts):
+            self._before_attempt()
+            try:
+                result = await func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, attempts)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return {**stats, "circuit": self.breaker.snapshot()}
+
+
+class Hedger:
+    """
+    Runs idempotent calls with a hedge: when the first attempt has not answered
+    after hedge_after seconds, an identical second attempt is started and the first
+    successful answer is returned.
+
+    A call can pass acquire, which reserves capacity for the hedge without waiting
+    and returns a callable releasing it, or None when there is none free; the hedge
+    is then skipped rather than queued behind other calls.
+    """
+
+    def __init__(self, hedge_after, max_workers=8):
+        self.hedge_after = hedge_after
+        self.max_workers = max_workers
+        self.stats = {"hedged": 0, "hedge_wins": 0, "skipped": 0}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Worker threads do not survive a fork, so each process starts its own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="hedge"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def call(self, func, acquire=None):
+        if not self.hedge_after:
+            return func()
+        executor = self._get_executor()
+        # Each attempt runs in a copy of the caller's context (deadline, model caller)
+        first = executor.submit(contextvars.copy_context().run, func)
+        done, _ = concurrent.futures.wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        release = acquire() if acquire else None
+        if acquire and release is None:
+            with self._lock:
+                self.stats["skipped"] += 1
+            return first.result()
+
+        def hedge():
+            try:
+                return func()
+            finally:
+                if release:
+                    release()
+
+        second = executor.submit(contextvars.copy_context().run, hedge)
+        with self._lock:
+            self.stats["hedged"] += 1
+        error = None
+        for future in concurrent.futures.as_completed([first, second]):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is second:
+                with self._lock:
+                    self.stats["hedge_wins"] += 1
+            return result
+        raise error
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
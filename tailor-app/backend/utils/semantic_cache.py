@@ -0,0 +1,109 @@
+"""
+Semantic cache of chat responses.
+
+A response is stored under the embedding of the prompt that produced it, and a new
+prompt is answered from the cache when a stored prompt of the same namespace (the user
+and chat template) is similar enough. Entries expire after a TTL and the least recently used
+ones are evicted once a namespace is full.
+"""
+
+import os
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The cache is opt-in; templates also have to enable it (see TEMPLATES in chat_routes)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "False").lower() == "true"
+
+# Entries kept per namespace, seconds an entry lives, and minimum cosine similarity
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    Thread-safe nearest-neighbour cache of responses keyed by prompt embeddings.
+    """
+
+    def __init__(
+        self,
+        enabled=SEMANTIC_CACHE_ENABLED,
+        max_entries=SEMANTIC_CACHE_SIZE,
+        ttl=SEMANTIC_CACHE_TTL,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+    ):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.stats = {"hits": 0, "misses": 0}
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, namespace, vector, threshold=None):
+        """
+        Returns:
+            The response cached for the most similar prompt of the namespace, or None
+            when no live entry reaches the threshold
+        """
+        threshold = self.threshold if threshold is None else threshold
+        query = normalize(vector)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if entries:
+                for key in [k for k, e in entries.items() if e["expires_at"] <= now]:
+                    del entries[key]
+            if entries:
+                keys = list(entries)
+                # Cosine similarity of the query against every cached prompt at once
+                scores = np.stack([entries[k]["vector"] for k in keys]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= threshold:
+                    entries.move_to_end(keys[best])
+                    self.stats["hits"] += 1
+                    return entries[keys[best]]["response"]
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, namespace, vector, response):
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            entries[uuid.uuid4().hex] = {
+                "vector": normalize(vector),
+                "response": response,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._namespaces.clear()
+            self.stats = {"hits": 0, "misses": 0}
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0,
+                "entries": {name: len(e) for name, e in self._namespaces.items()},
+            }
+
+
+# Shared cache used by the chat routes
+semantic_cache = SemanticCache()
@@ -0,0 +1,37 @@
+"""
+Server-Sent Events helpers for relaying streamed Cohere chat output to the browser.
+"""
+
+import json
+from flask import Response, stream_with_context
+
+# Stop proxies (e.g. nginx) and browsers from buffering or caching the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def format_sse(data, event=None):
+    """
+    Encode one SSE message with a JSON payload, optionally as a named event.
+    """
+    message = f"event: {event}\n" if event else ""
+    return f"{message}data: {json.dumps(data)}\n\n"
+
+
+def stream_chat_text(events):
+    """
+    Yield the text of each content-delta event of a Cohere chat_stream.
+    """
+    for event in events:
+        if event.type == "content-delta":
+            yield event.delta.message.content.text
+
+
+def sse_response(messages):
+    """
+    Stream an iterable of formatted SSE messages, keeping the request context alive.
+    """
+    return Response(
+        stream_with_context(messages),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
@@ -5,6 +5,7 @@ const Chat = () => {
   const [messages, setMessages] = useState([])
   const [input, setInput] = useState('')
   const [isLoading, setIsLoading] = useState(false)
+  const [sessionId, setSessionId] = useState(null)
   const API_URL = getBackendUrl()
   console.log(API_URL)
 
@@ -29,7 +30,8 @@ const Chat = () => {
         },
         body: JSON.stringify({
           prompt: input.trim(),
-          template: 'basic_chat'
+          template: 'basic_chat',
+          session_id: sessionId
         })
       })
 
@@ -38,6 +40,7 @@ const Chat = () => {
       if (data.error) {
         throw new Error(data.error)
       }
+      setSessionId(data.session_id)
 
       const assistantMessage = {
         role: 'assistant',